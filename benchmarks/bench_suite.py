@@ -0,0 +1,173 @@
+"""Benchmark core routines and full pipelines on synthetic images.
+
+Every case is timed on fresh inputs (best of `--repeats` runs) and its peak
+memory is measured with tracemalloc in one extra run. Results can be saved
+as a baseline and later runs compared against it; the script exits with
+status 1 when a case is slower than the baseline by more than the
+tolerance.
+
+Usage:
+    python benchmarks/bench_suite.py --size small --save baseline.json
+    python benchmarks/bench_suite.py --size small --compare baseline.json
+    python benchmarks/bench_suite.py --filter retinex --dtypes float32
+"""
+
+from __future__ import division
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import numpy as np
+from iphigen import core, utils
+from iphigen.pipeline import Pipeline
+
+# Shapes of the synthetic inputs: 2D RGB images and NIfTI-shaped volumes
+# with files as channels (3D with one file, 4D with two files).
+SIZES = {
+    'small': {'rgb': (256, 384, 3), 'nifti3d': (48, 48, 32, 1),
+              'nifti4d': (48, 48, 32, 2)},
+    'medium': {'rgb': (1024, 1536, 3), 'nifti3d': (128, 128, 96, 1),
+               'nifti4d': (128, 128, 96, 2)},
+    'large': {'rgb': (3000, 4000, 3), 'nifti3d': (256, 256, 192, 1),
+              'nifti4d': (256, 256, 192, 2)},
+}
+SCALES = {'rgb': [15, 80, 250], 'nifti3d': [1, 3, 10],
+          'nifti4d': [1, 3, 10]}
+
+
+def synthetic_image(shape, seed=0):
+    """Smooth random image with a zero background, values in 0-255."""
+    rng = np.random.RandomState(seed)
+    data = rng.random_sample(shape) * 200
+    grid = np.meshgrid(*[np.linspace(0, 1, n) for n in shape[:-1]],
+                       indexing='ij')
+    data += 55 * np.sum(grid, axis=0)[..., None] / len(grid)
+    # Background border, like masked MRI or letterboxed photos
+    border = tuple(slice(0, max(n // 16, 1)) for n in shape[:-1])
+    data[border] = 0
+    return data
+
+
+def make_cases(size, dtypes):
+    """Benchmark cases as (name, setup, function) tuples.
+
+    `setup` returns fresh arguments for `function`, so in-place routines are
+    timed on unmodified inputs.
+    """
+    cases = []
+    for kind, shape in sorted(SIZES[size].items()):
+        image = synthetic_image(shape)
+        inten = np.sum(image, axis=-1)
+        bary = image / np.where(inten == 0, 1, inten)[..., None]
+        scales = SCALES[kind]
+        msr = core.multi_scale_retinex(inten, scales=scales, verbose=False)
+
+        for dtype in dtypes:
+            cases.append((
+                'multi_scale_retinex[{},{}]'.format(kind, dtype),
+                lambda inten=inten: (inten,),
+                lambda x, scales=scales, dtype=dtype: core.multi_scale_retinex(
+                    x, scales=scales, verbose=False, dtype=dtype)))
+        cases += [
+            ('scale_approx[{}]'.format(kind),
+             lambda msr=msr, inten=inten: (msr.copy(), inten),
+             core.scale_approx),
+            ('truncate_range[{}]'.format(kind),
+             lambda inten=inten: (inten.copy(),),
+             utils.truncate_range),
+            ('set_range[{}]'.format(kind),
+             lambda inten=inten: (inten.copy(),),
+             utils.set_range),
+            ('simplest_color_balance[{}]'.format(kind),
+             lambda image=image: (image.copy(),),
+             core.simplest_color_balance)]
+        if shape[-1] > 1:
+            # Compositions need at least two parts
+            cases.append((
+                'simplex_color_balance[{}]'.format(kind),
+                lambda bary=bary: (bary.copy(),),
+                core.simplex_color_balance))
+        pipeline = Pipeline(intensity_balance=(kind == 'rgb'), retinex=True,
+                            scales=scales, simplest_color_balance=True,
+                            verbose=False)
+        cases.append((
+            'pipeline[{}]'.format(kind), lambda image=image: (image,),
+            pipeline.run))
+    return cases
+
+
+def measure(setup, function, repeats):
+    """Best wall time in seconds and peak traced memory in bytes."""
+    timings = []
+    for _ in range(repeats):
+        args = setup()
+        start = time.time()
+        function(*args)
+        timings.append(time.time() - start)
+    args = setup()
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(timings), peak
+
+
+def main():
+    """Run the benchmark cases, optionally saving or comparing results."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=str, default='small',
+                        choices=sorted(SIZES))
+    parser.add_argument('--dtypes', nargs='+', type=str,
+                        default=['float64', 'float32'])
+    parser.add_argument('--filter', type=str, default=None,
+                        help='Only run cases whose name contains this.')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--save', type=str, default=None,
+                        help='Write results to this JSON file.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Compare results with this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative slowdown against baseline.')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print('Size: {}, repeats: {}'.format(args.size, args.repeats))
+    print('{:<40} {:>10} {:>10} {:>10}'.format(
+        'case', 'seconds', 'peak MB', 'vs base'))
+    results, regressions = {}, []
+    for name, setup, function in make_cases(args.size, args.dtypes):
+        if args.filter and args.filter not in name:
+            continue
+        seconds, peak = measure(setup, function, args.repeats)
+        results[name] = {'seconds': seconds, 'peak_mb': peak / 2**20}
+        ratio = ''
+        if name in baseline:
+            ratio = seconds / baseline[name]['seconds']
+            if ratio > 1 + args.tolerance:
+                regressions.append(name)
+            ratio = '{:.2f}x'.format(ratio)
+        print('{:<40} {:>10.3f} {:>10.1f} {:>10}'.format(
+            name, seconds, peak / 2**20, ratio))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'size': args.size, 'numpy': np.__version__,
+                       'results': results}, f, indent=2, sort_keys=True)
+        print('Results are saved to {}'.format(args.save))
+    if regressions:
+        print('Slower than baseline by more than {:.0%}:'.format(
+            args.tolerance))
+        for name in regressions:
+            print('  {}'.format(name))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Benchmark threaded multi-scale retinex against the number of workers.
+
+Usage:
+    python benchmarks/bench_workers.py --shape 4000 6000 --max_workers 16
+"""
+
+from __future__ import division
+import argparse
+import time
+import numpy as np
+from iphigen.core import multi_scale_retinex
+
+
+def main():
+    """Time multi_scale_retinex for 1, 2, 4, ... max_workers threads."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', nargs='+', type=int, default=[2000, 3000])
+    parser.add_argument('--scales', nargs='+', type=float,
+                        default=[15, 80, 250])
+    parser.add_argument('--blur', type=str, default='exact')
+    parser.add_argument('--max_workers', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    image = np.random.random(args.shape) * 765
+    print('Shape: {}, scales: {}, blur: {}'.format(
+        args.shape, args.scales, args.blur))
+    print('{:>8} {:>10} {:>8}'.format('workers', 'seconds', 'speedup'))
+    workers, reference = 1, None
+    while workers <= args.max_workers:
+        timings = []
+        for _ in range(args.repeats):
+            start = time.time()
+            multi_scale_retinex(image, scales=args.scales, verbose=False,
+                                blur=args.blur, workers=workers)
+            timings.append(time.time() - start)
+        best = min(timings)
+        if reference is None:
+            reference = best
+        print('{:>8} {:>10.2f} {:>8.2f}'.format(workers, best,
+                                                reference / best))
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
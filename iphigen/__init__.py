@@ -1,5 +1,11 @@
 """For having the version."""
 
-import pkg_resources
+try:
+    from importlib.metadata import version
+except ImportError:  # Python < 3.8
+    from pkg_resources import get_distribution
 
-__version__ = pkg_resources.require("iphigen")[0].version
+    def version(name):
+        return get_distribution(name).version
+
+__version__ = version("iphigen")
@@ -0,0 +1,109 @@
+"""Deviation of reduced precision processing from float64 processing.
+
+Usage:
+    python -m iphigen.accuracy image.png --retinex --simplest_color_balance
+    python -m iphigen.accuracy t1.nii.gz pd.nii.gz --retinex --scales 1 3 10
+"""
+
+from __future__ import division
+import argparse
+import numpy as np
+from iphigen.pipeline import Pipeline, STAGES
+
+
+def precision_report(data, dtype=np.float32, q=(50., 99., 99.9),
+                     **kwargs):
+    """Compare processing in `dtype` with float64 processing, per stage.
+
+    For each selected stage, the pipeline up to and including that stage is
+    run in float64 and in `dtype`, so deviations accumulate as they do in a
+    full run.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Image with channels in the last dimension.
+    dtype: numpy dtype
+        Reduced precision to evaluate.
+    q: list of floats
+        Percentiles of the absolute deviation to report.
+    **kwargs
+        `Pipeline` settings, eg. `retinex=True, scales=[15, 80, 250]`.
+
+    Returns
+    -------
+    report: list of dicts
+        One entry per stage with 'stage', 'max' (maximum absolute
+        deviation), 'percentiles' (absolute deviation at `q`), 'range'
+        (range of the float64 output) and 'nan_mismatch' (number of
+        elements that are NaN in only one of the outputs). Deviations and
+        range are NaN when no element is finite in both outputs.
+
+    """
+    stages = Pipeline(**kwargs).stages
+    report = []
+    for k, stage in enumerate(stages):
+        settings = dict(kwargs, verbose=False)
+        settings.update({s: s in stages[:k+1] for s in STAGES})
+        reference = Pipeline(dtype=np.float64, **settings).run(data)
+        output = Pipeline(dtype=dtype, **settings).run(data)
+        nan_ref, nan_out = np.isnan(reference), np.isnan(output)
+        valid = ~(nan_ref | nan_out)
+        deviation = np.abs(output[valid] - reference[valid])
+        if deviation.size:
+            summary = (float(np.max(deviation)),
+                       np.percentile(deviation, q).tolist(),
+                       float(np.ptp(reference[valid])))
+        else:
+            summary = np.nan, [np.nan] * len(q), np.nan
+        report.append({
+            'stage': stage,
+            'max': summary[0],
+            'percentiles': dict(zip(q, summary[1])),
+            'range': summary[2],
+            'nan_mismatch': int(np.sum(nan_ref != nan_out))})
+    return report
+
+
+def main():
+    """Print the precision report of the selected stages for an image."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'filename', metavar='path', nargs='+',
+        help="2D image, or nifti images used as channels.")
+    parser.add_argument('--dtype', type=str, default='float32')
+    parser.add_argument('--scales', nargs='+', type=float, default=None)
+    for stage in STAGES:
+        parser.add_argument('--' + stage, action='store_true')
+    args = parser.parse_args()
+
+    if args.filename[0].endswith(('.nii', '.nii.gz')):
+        import nibabel as nb
+        data = np.stack([np.squeeze(nb.load(f).get_fdata())
+                         for f in args.filename], axis=-1)
+        scales = args.scales or [1, 3, 10]
+    else:
+        import cv2
+        data = cv2.imread(args.filename[0])
+        scales = args.scales or [15, 80, 250]
+    settings = {s: getattr(args, s) for s in STAGES}
+    if not any(settings.values()):
+        settings.update(retinex=True, simplest_color_balance=True)
+
+    report = precision_report(data, dtype=np.dtype(args.dtype),
+                              scales=scales, **settings)
+    q = sorted(report[0]['percentiles'])
+    print('Deviation of {} from float64, cumulative over stages:'.format(
+        args.dtype))
+    print('{:<24} {:>11} {}{:>11} {:>6}'.format(
+        'stage', 'max', ''.join('{:>11}'.format('p{:g}'.format(p))
+                                for p in q), 'range', 'nans'))
+    for r in report:
+        print('{:<24} {:>11.3g} {}{:>11.4g} {:>6}'.format(
+            r['stage'], r['max'],
+            ''.join('{:>11.3g}'.format(r['percentiles'][p]) for p in q),
+            r['range'], r['nan_mismatch']))
+
+
+if __name__ == "__main__":
+    main()
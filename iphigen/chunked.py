@@ -0,0 +1,194 @@
+"""Out-of-core processing of NIfTI images in slabs along the third axis."""
+
+from __future__ import division
+import os
+import gzip
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nb
+from iphigen import core, quantiles, utils
+
+
+def process_nifti_chunked(in_paths, out_paths, chunk_size=16, retinex=False,
+                          scales=None, blur='exact', cascade=False, workers=1,
+                          simplest_color_balance=False,
+                          simplest_perc=(1., 99.), tmp_dir=None,
+                          exact_size=10**7, dtype=np.float64,
+                          voxel_size=None, compresslevel=6):
+    """Multi-scale retinex and simplest color balance for large images.
+
+    Inputs are memory mapped through nibabel proxies and processed in slabs
+    of `chunk_size` slices along the third axis. Retinex slabs are extended
+    by a halo of 4 times the largest scale, so with the exact blur the
+    result is identical to processing the whole volume. Outputs are written
+    into memory-mapped NIfTI files. Peak memory is set by the chunk size,
+    not by the volume size.
+
+    Parameters
+    ----------
+    in_paths: list of strings
+        Input NIfTI images, treated as channels. Should have the same shape.
+    out_paths: list of strings
+        Output paths, one for each input. '.nii.gz' outputs are written
+        uncompressed first and then compressed.
+    chunk_size: int
+        Number of slices in each slab.
+    retinex: bool
+        Apply multi-scale retinex with barycenter preservation.
+    scales: list
+        Retinex scales, see `core.multi_scale_retinex`.
+    blur: string
+        Gaussian blur engine, see `core.multi_scale_retinex`.
+    cascade: bool
+        Cascaded surrounds, see `core.multi_scale_retinex`.
+    workers: int
+        Number of threads, see `core.multi_scale_retinex`.
+    simplest_color_balance: bool
+        Apply simplest color balance.
+    simplest_perc: list
+        Percentiles for simplest color balance.
+    tmp_dir: string
+        Directory for temporary files. Should have space for one volume.
+        Defaults to the directory of the first output.
+    exact_size: int
+        Percentiles are exact up to this many voxels, and are estimated with
+        bounded error beyond, see `quantiles.QuantileSketch`.
+    dtype: numpy dtype
+        Floating point type of slabs, of the temporary retinex volume and of
+        the outputs.
+    voxel_size: list, optional
+        Voxel size of the three axes. Scales are then in the same unit (eg.
+        mm), see `core.multi_scale_retinex`. The halo is measured in slices
+        of the third axis.
+    compresslevel: int
+        gzip compression level of '.nii.gz' outputs, 1 to 9.
+
+    """
+    if scales is None:
+        scales = [1, 3, 10]
+    niis = [nb.load(f, mmap=True) for f in in_paths]
+    shape = niis[0].shape[:3]
+    for nii, f in zip(niis, in_paths):
+        if nii.shape[:3] != shape or np.prod(nii.shape[3:]) != 1:
+            raise ValueError('{} should be a 3D image of shape {}.'.format(
+                f, shape))
+    nr_slices = shape[2]
+    chunks = [(z0, min(z0 + chunk_size, nr_slices))
+              for z0 in range(0, nr_slices, chunk_size)]
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(out_paths[0]))
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        new_inten, scale_factor = None, None
+        if retinex:
+            print('  Retinex pass...')
+            new_inten = np.memmap(os.path.join(tmp, 'msr.dat'), mode='w+',
+                                  dtype=dtype, shape=shape, order='F')
+            if voxel_size is None:
+                halo = int(4 * max(scales) + 0.5)
+            else:
+                halo = int(core._axis_sigma(4 * max(scales), 3,
+                                            voxel_size=voxel_size)[2] + 0.5)
+            old_sketch = quantiles.QuantileSketch(exact_size=exact_size)
+            new_sketch = quantiles.QuantileSketch(exact_size=exact_size)
+            for i, (z0, z1) in enumerate(chunks):
+                print('    Slab {}/{} (slices {}-{})'.format(
+                    i+1, len(chunks), z0, z1-1))
+                h0, h1 = max(z0 - halo, 0), min(z1 + halo, nr_slices)
+                inten = np.sum(_read_slab(niis, h0, h1, dtype), axis=-1)
+                msr = core.multi_scale_retinex(
+                    inten, scales=scales, verbose=False, dtype=dtype,
+                    blur=blur, cascade=cascade, workers=workers,
+                    voxel_size=voxel_size)
+                msr = msr[:, :, z0-h0:z1-h0]
+                new_inten[:, :, z0:z1] = msr
+                old_sketch.update(inten[:, :, z0-h0:z1-h0])
+                new_sketch.update(msr)
+            scale_factor = core.scale_approx_factor(
+                new_sketch.percentile(core.SCALE_APPROX_PERC),
+                old_sketch.percentile(core.SCALE_APPROX_PERC))
+
+        thresholds = None
+        if simplest_color_balance:
+            print('  Color balance statistics pass...')
+            sketches = [quantiles.QuantileSketch(exact_size=exact_size)
+                        for _ in niis]
+            for z0, z1 in chunks:
+                data = _compose_slab(niis, new_inten, scale_factor, z0, z1,
+                                     dtype)
+                for d, sketch in enumerate(sketches):
+                    temp = data[..., d]
+                    sketch.update(temp[quantiles.nonzero_mask(temp)])
+            thresholds = [s.percentile(simplest_perc) for s in sketches]
+
+        print('  Writing pass...')
+        outputs = [_create_nifti_memmap(_uncompressed_path(f, tmp), shape,
+                                        nii.affine, dtype)
+                   for f, nii in zip(out_paths, niis)]
+        for z0, z1 in chunks:
+            data = _compose_slab(niis, new_inten, scale_factor, z0, z1,
+                                 dtype)
+            for d, out in enumerate(outputs):
+                temp = data[..., d]
+                if thresholds is not None:
+                    temp = utils.clip_and_scale(temp, *thresholds[d])
+                out[:, :, z0:z1] = temp
+        for out in outputs:
+            out.flush()
+        outputs, new_inten = None, None
+        _compress_outputs(out_paths, tmp, compresslevel)
+
+
+def _read_slab(niis, z0, z1, dtype=np.float64):
+    """Read slices z0:z1 of every image, stacked along the last axis."""
+    slabs = []
+    for nii in niis:
+        temp = np.asarray(nii.dataobj[:, :, z0:z1], dtype=dtype)
+        slabs.append(temp.reshape(nii.shape[:2] + (z1 - z0,)))
+    return np.stack(slabs, axis=-1)
+
+
+def _compose_slab(niis, new_inten, scale_factor, z0, z1, dtype=np.float64):
+    """Channels of a slab with the retinex intensity put back in."""
+    data = _read_slab(niis, z0, z1, dtype)
+    if new_inten is not None:
+        # Barycentric coordinates times the new intensity
+        inten = np.sum(data, axis=-1)
+        data /= inten[..., None]
+        data *= new_inten[:, :, z0:z1, None]
+        data *= scale_factor
+    return data
+
+
+def _uncompressed_path(path, tmp):
+    """Path of the memory-mapped file that backs an output."""
+    if path.endswith('.gz'):
+        return os.path.join(tmp, os.path.basename(path)[:-3])
+    return path
+
+
+def _compress_outputs(out_paths, tmp, compresslevel=6):
+    """Write '.nii.gz' outputs from their uncompressed temporary files."""
+    for f in out_paths:
+        temp_path = _uncompressed_path(f, tmp)
+        if temp_path != f:
+            with open(temp_path, 'rb') as f_in:
+                with gzip.open(f, 'wb', compresslevel=compresslevel) as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+
+
+def _create_nifti_memmap(path, shape, affine, dtype=np.float64):
+    """Create a NIfTI file and memory map its (empty) data block."""
+    hdr = nb.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(dtype)
+    hdr.set_qform(affine, code=1)
+    hdr.set_sform(affine, code=1)
+    with open(path, 'wb') as f:
+        hdr.write_to(f)
+        offset = f.tell()
+        # Extend the file without writing the data block
+        f.truncate(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.memmap(path, mode='r+', dtype=dtype, offset=offset,
+                     shape=shape, order='F')
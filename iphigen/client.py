@@ -0,0 +1,83 @@
+"""Thin client of the iphigen server.
+
+Only the standard library is imported, so a request costs a few
+milliseconds on top of the processing done by the warm server.
+
+Usage:
+    iphigen_server &
+    iphigen_client -- image.png --retinex --simplest_color_balance
+    iphigen_client --nifti -- t1.nii.gz --retinex --scales 1 3 10
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+
+
+def default_socket_path():
+    """Per-user Unix socket path of the server."""
+    return os.path.join(tempfile.gettempdir(),
+                        'iphigen-{}.sock'.format(os.getuid()))
+
+
+def send_request(request, socket_path=None):
+    """Send one request to the server and wait for its response.
+
+    Parameters
+    ----------
+    request: dict
+        Request, see `iphigen.server.handle_request`.
+    socket_path: string, optional
+        Server socket. Defaults to `default_socket_path()`.
+
+    Returns
+    -------
+    response: dict
+
+    """
+    if socket_path is None:
+        socket_path = default_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rw') as f:
+            f.write(json.dumps(request) + '\n')
+            f.flush()
+            line = f.readline()
+    if not line:
+        raise ConnectionError('Server closed the connection.')
+    return json.loads(line)
+
+
+def main():
+    """Send command line arguments to the server as one job."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, metavar='path',
+                        default=default_socket_path())
+    parser.add_argument('--nifti', action='store_true',
+                        help="Run iphigen_nifti instead of iphigen.")
+    parser.add_argument('--shutdown', action='store_true',
+                        help="Stop the server.")
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help="Arguments of iphigen or iphigen_nifti after --.")
+    args = parser.parse_args()
+    if args.shutdown:
+        request = {'command': 'shutdown'}
+    else:
+        job_args = args.args[1:] if args.args[:1] == ['--'] else args.args
+        request = {'command': 'iphigen_nifti' if args.nifti else 'iphigen',
+                   'args': job_args, 'cwd': os.getcwd()}
+    try:
+        response = send_request(request, args.socket)
+    except (OSError, ConnectionError) as e:
+        sys.exit('Cannot reach the server at {}: {}'.format(args.socket, e))
+    sys.stdout.write(response.get('log', ''))
+    for error in response.get('errors', []):
+        sys.stderr.write('Error: {}\n'.format(error))
+    sys.exit(0 if response.get('ok') else 1)
+
+
+if __name__ == "__main__":
+    main()
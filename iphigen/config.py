@@ -2,6 +2,21 @@
 
 filename = None
 out_dir = None
+jobs = 1  # number of worker processes for batches of 2D images
+read_ahead = 2  # inputs loaded ahead of processing
+write_behind = 2  # outputs waiting to be saved
+chunk_size = None  # slices per slab for out-of-core nifti processing
+series = False  # process 4D nifti images volume by volume
+mask = None  # nifti foreground mask path, or 'auto'
+tile_size = None  # tile size in pixels for large 2D images
+stream = False  # inputs are videos or numbered image sequences
+prefetch = 8  # decoded frames waiting to be processed in stream mode
+temporal_smoothing = None  # weight of the current frame in percentiles
+stats_interval = 1  # compute percentiles every N frames in stream mode
+profile = False  # print per-stage timings
+metrics_json = None  # path of the per-stage timings JSON file
+cache_dir = None  # directory of cached retinex surrounds, None to disable
+cache_size = 4096  # cache size bound in megabytes
 
 retinex = False
 intensity_balance = False
@@ -11,6 +26,24 @@ simplex_color_balance = False
 # retinex defaults
 scales = [15, 80, 250]
 scales_nifti = [1, 3, 10]
+scales_mm = False  # nifti scales in millimetres instead of voxels
+blur = 'exact'  # gaussian blur engine
+cascade = False  # build each surround from the previous scale
+workers = 1  # threads used inside multi-scale retinex
+
+# parameter sweep, lists of retinex scale sets and simplest percentile pairs
+sweep_scales = None
+sweep_perc = None
+
+# floating point precision of working arrays, 'float64' or 'float32'
+precision = 'float64'
+
+# outputs, None for uint8 (2D) or the working precision (nifti)
+output_dtype = None
+compress_level = 6  # gzip level of .nii.gz outputs, 1 (fast) to 9 (small)
+
+# percentile computation, 'exact' or 'histogram'
+percentile_method = 'exact'
 
 # intensity balance defaults
 int_bal_perc = [1., 99.]  # intensity balance percentiles
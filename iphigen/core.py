@@ -1,15 +1,20 @@
 """Core functions of Iphigen package."""
 
 from __future__ import division
-import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import compoda.core as coda
-from scipy.ndimage import gaussian_filter
-from iphigen.utils import truncate_range, set_range
+from iphigen import metrics, quantiles
+from iphigen.filters import gaussian_blur
 np.seterr(divide='ignore', invalid='ignore')
 
+SCALE_APPROX_PERC = [2.5, 97.5]  # percentiles matched by scale_approx
+MIN_AXIS_SIGMA = 0.3  # voxels, axes with smaller sigma are not filtered
 
-def multi_scale_retinex(image, scales=None, verbose=True):
+
+def multi_scale_retinex(image, scales=None, verbose=True, dtype=np.float64,
+                        blur='exact', cascade=False, workers=1,
+                        disk_cache=None, mask=None, batch=False,
+                        voxel_size=None):
     """Multi scale retinex (MSR).
 
     Parameters
@@ -23,13 +28,63 @@ def multi_scale_retinex(image, scales=None, verbose=True):
         be found in [2].
     verbose: bool
         Print intermediate information. Useful to track progress when
-        processing large images.
+        processing large images. Timings are always sent to the
+        `iphigen.metrics` hooks, per scale ('retinex_scale') and in total
+        ('multi_scale_retinex').
+    dtype: numpy dtype
+        Floating point type of the working buffers and the output. Use
+        `np.float32` to halve the memory footprint.
+    blur: string
+        Gaussian blur engine used for the surrounds. One of
+        `iphigen.filters.BLUR_METHODS`. Approximate engines ('iir', 'box',
+        'fft', 'pyramid') are much faster for large scales, see
+        `iphigen.filters.gaussian_blur` for their error bounds.
+    cascade: bool
+        Sort the scales and build each surround from the previous one by
+        blurring it with the incremental sigma sqrt(s_k**2 - s_(k-1)**2).
+        Smaller kernels make the exact blur cheaper when scales are closely
+        spaced, at the cost of one more image-sized buffer.
+    workers: int
+        Number of threads. Independent scales are filtered concurrently and
+        large filters are split into slabs (see
+        `iphigen.filters.gaussian_blur`). The result is bit-identical to
+        `workers=1`. Each concurrent scale needs its own surround buffer.
+    disk_cache: iphigen.diskcache.DiskCache, optional
+        Reuse surrounds and the retinex output of earlier runs on the same
+        image, keyed by image content, scale, blur engine and dtype. New
+        results are stored.
+    mask: np.ndarray, optional
+        Boolean foreground mask, eg. the head in MRI. Only the bounding box
+        of the mask plus a halo of 4 times the largest scale is processed,
+        and surrounds are computed by normalized convolution (blurred masked
+        image divided by blurred mask), so background does not darken the
+        surround near the edges of the foreground. Output is 0 outside the
+        mask. `cascade` and `disk_cache` are not used with a mask.
+    batch: bool
+        The first axis of `image` (and `mask`) indexes a stack of
+        independent images, eg. (N, H, W). Surrounds are blurred along the
+        other axes only, with sigma 0 on the first axis, so the whole stack
+        is filtered with one call per scale.
+    voxel_size: list, optional
+        Voxel size along each (non-batch) axis, eg. from the NIfTI header
+        zooms. Scales are then in the same unit (eg. mm) and are divided by
+        the voxel size of each axis. Axes whose sigma is below
+        `MIN_AXIS_SIGMA` voxels are not filtered at all, which saves the
+        blur of thick-slice axes at small scales.
 
     Returns
     -------
     msr: 3d numpy array
         Corrected image.
 
+    Notes
+    -----
+    Scales are accumulated into a single running sum instead of being stacked,
+    and all post-processing is done in place. Peak memory is therefore about
+    three image-sized buffers of `dtype` (log image, surround, running sum)
+    regardless of the number of scales, plus one surround buffer for each
+    additional concurrent scale when `workers > 1`.
+
     References
     ----------
     [1] https://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.gaussian_filter.html
@@ -43,48 +98,370 @@ def multi_scale_retinex(image, scales=None, verbose=True):
     if scales is None:  # default parameters
         scales = [1, 5, 10]
 
-    start = time.time()
+    with metrics.measure('multi_scale_retinex', image,
+                         scales=[float(s) for s in scales], blur=blur,
+                         cascade=cascade, workers=workers,
+                         masked=mask is not None, batch=batch,
+                         voxel_size=voxel_size) as record:
+        if voxel_size is not None:
+            voxel_size = [float(v) for v in voxel_size]
+            if len(voxel_size) != image.ndim - int(batch):
+                raise ValueError('Expected {} voxel sizes, got {}.'.format(
+                    image.ndim - int(batch), len(voxel_size)))
+        if mask is not None:
+            msr = _masked_multi_scale_retinex(image, mask, scales, verbose,
+                                              dtype, blur, workers, batch,
+                                              voxel_size)
+        elif disk_cache is None:
+            msr = _multi_scale_retinex(image, scales, verbose, dtype, blur,
+                                       cascade, workers, batch=batch,
+                                       voxel_size=voxel_size)
+        else:
+            digest = disk_cache.digest(image)
+            # Geometry only in keys that need it, so earlier entries stay
+            # valid
+            extra = _geometry_key(batch, voxel_size)
+            key = disk_cache.key(digest, kind='msr',
+                                 scales=[float(s) for s in scales],
+                                 blur=blur, cascade=cascade,
+                                 dtype=np.dtype(dtype).name, **extra)
+            msr = disk_cache.get(key)
+            record['cached'] = msr is not None
+            if msr is None:
+                msr = _multi_scale_retinex(image, scales, verbose, dtype,
+                                           blur, cascade, workers,
+                                           disk_cache, digest, batch,
+                                           voxel_size)
+                disk_cache.put(key, msr)
+    if verbose:
+        print('  Took {0:.1f} seconds.'.format(record['wall']))
+    return msr
+
+
+def _multi_scale_retinex(image, scales, verbose, dtype, blur, cascade,
+                         workers, disk_cache=None, digest=None, batch=False,
+                         voxel_size=None):
+    """Multi-scale retinex computation, see `multi_scale_retinex`."""
+    def surround_key(sigma, **params):
+        if disk_cache is None:
+            return None
+        params.update(_geometry_key(batch, voxel_size))
+        return disk_cache.key(digest, kind='surround', sigma=float(sigma),
+                              blur=blur, dtype=np.dtype(dtype).name,
+                              **params)
+
     if verbose:
         print('Applying multi-scale retinex...')
     scales = np.array(scales)  # sigma values
-    msr = np.zeros(image.shape + (scales.size,))
 
+    # log(image + 1), computed once and reused for every scale
+    log_image = np.array(image, dtype=dtype)
+    np.log1p(log_image, out=log_image)
+    msr = np.zeros(image.shape, dtype=dtype)
+
+    if cascade:
+        scales = np.sort(scales)
+        # Gaussian blurs compose, only the missing variance is added
+        steps = np.sqrt(np.diff(np.concatenate([[0], scales**2])))
+        surround = np.empty(image.shape, dtype=dtype)
+        blurred = np.empty(image.shape, dtype=dtype)
+        for i, (sigma, step) in enumerate(zip(scales, steps)):
+            if verbose:
+                print('  Processing scale {} (sigma={})...'.format(i+1, sigma))
+            key = surround_key(sigma, cascade=scales[:i+1].tolist())
+            with metrics.measure('retinex_scale', image, sigma=float(sigma),
+                                 step=float(step)):
+                _cached_blur(image if i == 0 else blurred,
+                             _axis_sigma(step, image.ndim, batch, voxel_size),
+                             blur,
+                             surround, workers, disk_cache, key)
+                blurred[...] = surround
+                msr += _log_ratio(log_image, surround)
+        surround, blurred = None, None
+    else:
+        # Scales are independent, up to `workers` of them run at once
+        nr_concurrent = max(1, min(workers, scales.size))
+        blur_workers = max(1, workers // nr_concurrent)
+        buffers = [np.empty(image.shape, dtype=dtype)
+                   for _ in range(nr_concurrent)]
+        with ThreadPoolExecutor(nr_concurrent) as pool:
+            for j in range(0, scales.size, nr_concurrent):
+                futures = []
+                for k, sigma in enumerate(scales[j:j + nr_concurrent]):
+                    if verbose:
+                        print('  Processing scale {} (sigma={})...'.format(
+                            j+k+1, sigma))
+                    futures.append(pool.submit(
+                        _surround_log_ratio, image, log_image,
+                        _axis_sigma(sigma, image.ndim, batch, voxel_size),
+                        blur,
+                        buffers[k], blur_workers, disk_cache,
+                        surround_key(sigma)))
+                # Sum in scale order so the result does not depend on workers
+                for future in futures:
+                    msr += future.result()
+        buffers = None
+    log_image = None
+
+    # average
+    msr /= scales.size
+    msr = np.nan_to_num(msr, copy=False)
+    # return from logarithmic space
+    msr -= 1
+    np.exp(msr, out=msr)
+    return msr
+
+
+def multi_scale_retinex_sweep(image, scale_sets, verbose=True,
+                              dtype=np.float64, blur='exact', workers=1,
+                              voxel_size=None):
+    """Multi scale retinex for several sets of scales at once.
+
+    Every distinct sigma of all sets is blurred once, in increasing order,
+    each surround built from the previous one with the incremental sigma
+    (see `cascade` in `multi_scale_retinex`). Its log ratio is added to the
+    running sum of every set containing it.
+
+    Parameters
+    ----------
+    image : 2d or 3d numpy array
+
+    scale_sets : list of lists
+        Retinex scales of each output, see `multi_scale_retinex`.
+    verbose: bool
+        Print intermediate information.
+    dtype: numpy dtype
+        Floating point type of the working buffers and the outputs.
+    blur: string
+        Gaussian blur engine, see `multi_scale_retinex`.
+    workers: int
+        Number of threads of each blur, see `iphigen.filters.gaussian_blur`.
+    voxel_size: list, optional
+        Scales in physical units, see `multi_scale_retinex`.
+
+    Returns
+    -------
+    outputs: list of numpy arrays
+        Retinex output of each set of scales, same as `multi_scale_retinex`
+        with `cascade=True`.
+
+    Notes
+    -----
+    Peak memory is one image-sized buffer per set of scales plus three (log
+    image, surround, previous surround). The number of blurs is the number
+    of distinct sigmas instead of the total number of scales.
+
+    """
+    sigmas = np.unique(np.concatenate([np.asarray(s, dtype=float)
+                                       for s in scale_sets]))
+    with metrics.measure('multi_scale_retinex_sweep', image,
+                         sigmas=sigmas.tolist(), sets=len(scale_sets),
+                         blur=blur, workers=workers) as record:
+        if verbose:
+            print('Applying multi-scale retinex to {} sets of scales '
+                  '({} distinct)...'.format(len(scale_sets), sigmas.size))
+        log_image = np.array(image, dtype=dtype)
+        np.log1p(log_image, out=log_image)
+        outputs = [np.zeros(image.shape, dtype=dtype) for _ in scale_sets]
+        # Outputs using each sigma, and how many times (repeated scales)
+        members = [[(j, np.count_nonzero(np.asarray(s, dtype=float) == sigma))
+                    for j, s in enumerate(scale_sets)] for sigma in sigmas]
+
+        steps = np.sqrt(np.diff(np.concatenate([[0], sigmas**2])))
+        surround = np.empty(image.shape, dtype=dtype)
+        blurred = np.empty(image.shape, dtype=dtype)
+        for i, (sigma, step) in enumerate(zip(sigmas, steps)):
+            if verbose:
+                print('  Processing scale {} (sigma={})...'.format(i+1, sigma))
+            with metrics.measure('retinex_scale', image, sigma=float(sigma),
+                                 step=float(step)):
+                gaussian_blur(image if i == 0 else blurred,
+                              _axis_sigma(step, image.ndim,
+                                          voxel_size=voxel_size),
+                              method=blur, output=surround, workers=workers)
+                blurred[...] = surround
+                _log_ratio(log_image, surround)
+                for j, count in members[i]:
+                    if count == 1:
+                        outputs[j] += surround
+                    elif count > 1:
+                        outputs[j] += count * surround
+        surround, blurred, log_image = None, None, None
+
+        for msr, scales in zip(outputs, scale_sets):
+            # average
+            msr /= len(scales)
+            np.nan_to_num(msr, copy=False)
+            # return from logarithmic space
+            msr -= 1
+            np.exp(msr, out=msr)
+    if verbose:
+        print('  Took {0:.1f} seconds.'.format(record['wall']))
+    return outputs
+
+
+def _masked_multi_scale_retinex(image, mask, scales, verbose, dtype, blur,
+                                workers, batch=False, voxel_size=None):
+    """Multi-scale retinex inside a mask, see `multi_scale_retinex`."""
+    if verbose:
+        print('Applying multi-scale retinex inside the mask...')
+    msr = np.zeros(image.shape, dtype=dtype)
+    if not np.any(mask):
+        return msr
+    # Bounding box of the mask, extended by the kernel radius (4 sigma), so
+    # blurs near the box edges see the same zeros as on the full image
+    halos = _axis_sigma(4 * max(scales), image.ndim, batch, voxel_size)
+    box = []
+    for ax, halo in enumerate(np.broadcast_to(halos, image.ndim)):
+        halo = int(halo + 0.5)
+        other = tuple(a for a in range(image.ndim) if a != ax)
+        idx = np.flatnonzero(np.any(mask, axis=other))
+        box.append(slice(max(idx[0] - halo, 0),
+                         min(idx[-1] + 1 + halo, image.shape[ax])))
+    box = tuple(box)
+    crop_mask = np.asarray(mask[box], dtype=bool)
+
+    weights = crop_mask.astype(dtype)
+    weighted = np.array(image[box], dtype=dtype)
+    weighted *= weights
+    log_image = np.log1p(weighted)
+    out = np.zeros(weighted.shape, dtype=dtype)
+    surround = np.empty(weighted.shape, dtype=dtype)
+    norm = np.empty(weighted.shape, dtype=dtype)
     for i, sigma in enumerate(scales):
         if verbose:
             print('  Processing scale {} (sigma={})...'.format(i+1, sigma))
-        temp = gaussian_filter(image, sigma, mode="reflect")
-        msr[..., i] = np.log(image + 1) - np.log(temp + 1)
-    temp = None
+        with metrics.measure('retinex_scale', weighted, sigma=float(sigma),
+                             masked=True):
+            # Normalized convolution, surround of foreground voxels only
+            sigmas = _axis_sigma(sigma, image.ndim, batch, voxel_size)
+            gaussian_blur(weighted, sigmas, method=blur, output=surround,
+                          workers=workers)
+            gaussian_blur(weights, sigmas, method=blur, output=norm,
+                          workers=workers)
+            surround /= norm
+            out += _log_ratio(log_image, surround)
+    surround, norm, log_image, weighted, weights = None, None, None, None, None
 
-    # remove nans
-    msr = np.nan_to_num(msr)
     # average
-    msr = np.mean(msr, axis=-1)
-    msr = np.nan_to_num(msr)
+    out /= len(scales)
+    out = np.nan_to_num(out, copy=False)
     # return from logarithmic space
-    msr = np.exp(msr - 1)
+    out -= 1
+    np.exp(out, out=out)
+    out[~crop_mask] = 0
+    msr[box] = out
+    return msr
 
-    duration = time.time() - start
-    print('  Took {0:.1f} seconds.'.format(duration))
 
-    return msr
+def _axis_sigma(sigma, ndim, batch=False, voxel_size=None):
+    """Sigma, or sigma per axis in voxels with 0 on the batch axis."""
+    if not batch and voxel_size is None:
+        return sigma
+    sigmas = np.full(ndim, float(sigma))
+    if voxel_size is not None:
+        sigmas[int(batch):] /= voxel_size
+        sigmas[sigmas < MIN_AXIS_SIGMA] = 0
+    if batch:
+        sigmas[0] = 0
+    return tuple(sigmas)
+
+
+def _geometry_key(batch, voxel_size):
+    """Disk cache key parameters of non-default geometry."""
+    params = {}
+    if batch:
+        params['batch'] = True
+    if voxel_size is not None:
+        params['voxel_size'] = voxel_size
+    return params
+
+
+def _log_ratio(log_image, surround):
+    """Compute log(image + 1) - log(surround + 1) in place of surround."""
+    np.log1p(surround, out=surround)
+    np.subtract(log_image, surround, out=surround)
+    # remove nans
+    np.nan_to_num(surround, copy=False)
+    return surround
+
+
+def _surround_log_ratio(image, log_image, sigma, blur, output, workers,
+                        disk_cache=None, key=None):
+    """Blur the image into output and convert it to a log ratio."""
+    with metrics.measure('retinex_scale', image, sigma=float(np.max(sigma))):
+        _cached_blur(image, sigma, blur, output, workers, disk_cache, key)
+        return _log_ratio(log_image, output)
+
 
+def _cached_blur(image, sigma, blur, output, workers, disk_cache, key):
+    """Gaussian blur into output, through the disk cache if given."""
+    if disk_cache is not None:
+        cached = disk_cache.get(key)
+        if cached is not None:
+            output[...] = cached
+            return output
+    gaussian_blur(image, sigma, method=blur, output=output, workers=workers)
+    if disk_cache is not None:
+        disk_cache.put(key, output)
+    return output
 
-def scale_approx(new_image, old_image):
+
+def scale_approx(new_image, old_image, method='exact', cache=None,
+                 mask=None, batch=False):
     """Scale new data approximately to original dynamic range.
 
+    Percentile method, cache and mask (of voxels considered) are passed to
+    `quantiles.percentile`. With `batch`, the first axis indexes independent
+    images, each scaled with its own percentiles.
+
     TODO: replace percentile with gradient based percentile
     """
-    opmin, opmax = np.nanpercentile(old_image, [2.5, 97.5])
-    npmin, npmax = np.nanpercentile(new_image, [2.5, 97.5])
+    if batch:
+        old_perc, new_perc = [quantiles.channel_percentiles(
+            image, SCALE_APPROX_PERC, mask=mask, method=method, cache=cache,
+            axis=0) for image in (old_image, new_image)]
+        factor = scale_approx_factor(new_perc, old_perc)
+        new_image *= factor.reshape((-1,) + (1,) * (new_image.ndim - 1))
+    else:
+        old_perc = quantiles.percentile(old_image, SCALE_APPROX_PERC,
+                                        mask=mask, method=method, cache=cache)
+        new_perc = quantiles.percentile(new_image, SCALE_APPROX_PERC,
+                                        mask=mask, method=method, cache=cache)
+        new_image *= scale_approx_factor(new_perc, old_perc)
+    if cache is not None:
+        cache.invalidate(new_image)
+    return new_image
+
+
+def scale_approx_factor(new_perc, old_perc):
+    """Scaling factor used by `scale_approx`.
+
+    Separate from `scale_approx` so that the factor can be computed from
+    percentiles of images that do not fit in memory.
+
+    Parameters
+    ----------
+    new_perc: list or np.ndarray
+        `SCALE_APPROX_PERC` percentiles of the new image, or of every image
+        of a stack in the last dimension.
+    old_perc: list or np.ndarray
+        `SCALE_APPROX_PERC` percentiles of the original image(s).
+
+    Returns
+    -------
+    scale_factor: float or np.ndarray
+
+    """
+    opmin, opmax = np.moveaxis(np.asarray(old_perc), -1, 0)
+    npmin, npmax = np.moveaxis(np.asarray(new_perc), -1, 0)
     # print('old:{} {}'.format(opmin, opmax))
     # print('new:{} {}'.format(npmin, npmax))
-    scale_factor = opmax - opmin / (npmax - npmin)
-    new_image *= scale_factor
-    return new_image
+    return opmax - opmin / (npmax - npmin)
 
 
-def simplest_color_balance(image, pmin=1., pmax=99.):
+def simplest_color_balance(image, pmin=1., pmax=99., method='exact',
+                           cache=None, mask=None, batch=False):
     """Simplest color balance.
 
     Parameters
@@ -95,6 +472,24 @@ def simplest_color_balance(image, pmin=1., pmax=99.):
         Percent minimum.
     pmax: float
         Percent maximum.
+    method: string
+        Percentile method, see `quantiles.percentile`.
+    cache: quantiles.PercentileCache, optional
+        Percentile results of the current run.
+    mask: np.ndarray, optional
+        Boolean foreground mask (without the channel dimension), used
+        instead of the non-zero voxels of each channel.
+    batch: bool
+        The first axis indexes independent images, eg. (N, H, W, C). Every
+        channel of every image gets its own percentiles.
+
+    Notes
+    -----
+    Equivalent to `truncate_range` followed by `set_range` on each channel,
+    with all channels handled at once: percentiles come from one
+    `quantiles.channel_percentiles` call, and since the minimum and maximum
+    of a truncated channel are its thresholds, clipping and scaling are
+    broadcast over the last dimension in place.
 
     Reference
     ---------
@@ -103,10 +498,26 @@ def simplest_color_balance(image, pmin=1., pmax=99.):
     http://doi.org/10.5201/ipol.2011.llmps-scb
 
     """
-    dims = image.shape
-    for d in range(dims[-1]):
-        image[..., d] = truncate_range(image[..., d], pmin=pmin, pmax=pmax)
-        image[..., d] = set_range(image[..., d], zero_to=255)
+    if mask is not None:
+        valid = np.broadcast_to(np.asarray(mask, dtype=bool)[..., None],
+                                image.shape)
+    else:
+        valid = quantiles.nonzero_mask(image)
+    axis = (0, -1) if batch else -1
+    thr = quantiles.channel_percentiles(image, [pmin, pmax], mask=valid,
+                                        method=method, cache=cache, axis=axis)
+    if batch:
+        # Thresholds of (image, channel) pairs broadcast over the pixels
+        thr = thr.reshape((thr.shape[0],) + (1,) * (image.ndim - 2)
+                          + thr.shape[1:])
+    thr_min, thr_max = thr[..., 0], thr[..., 1]
+    # truncate min and max, NaNs are kept
+    np.clip(image, thr_min, thr_max, out=image)
+    image -= thr_min
+    image *= 255 / (thr_max - thr_min)
+    image[~valid] = 0  # put back masked out voxels
+    if cache is not None:
+        cache.invalidate(image)
     return image
 
 
@@ -138,52 +549,59 @@ def simplex_color_balance(bary, center=True, standardize=False,
 
     """
     dims = bary.shape
-    bary = bary.reshape([np.prod(dims[:-1]), dims[-1]])
-    bary = np.nan_to_num(bary)
+    bary = np.nan_to_num(bary.reshape([-1, dims[-1]]))
 
     # Do not consider values <= 0
-    mask = np.prod(bary, axis=-1)
-    mask = mask > 0
-    temp = bary[mask]
+    idx = np.flatnonzero(np.prod(bary, axis=-1) > 0)
+    if idx.size == 0:
+        return bary.reshape(dims)
+
+    # Work on centered log-ratio (clr) coordinates of the valid compositions.
+    # Perturbation and powering are translation and scaling in clr space, so
+    # every step below is done in place on this single buffer, and closure is
+    # only needed once when going back to the simplex.
+    clr = np.log(bary[idx])
+    clr -= np.mean(clr, axis=-1, keepdims=True)
+    if center or standardize:
+        # clr of the sample center (closed geometric mean)
+        clr_center = np.mean(clr, axis=0)
 
     # Interpretation of centering: Compositions cover the simplex space more
     # balanced across components. Similar to de-mean data.
     if center:
-        sample_center = coda.sample_center(temp)
-        temp2 = np.full(temp.shape, sample_center)
-        temp = coda.perturb(temp, temp2**-1.)
-        temp2 = None
+        clr -= clr_center
 
     # Interpretation of standardization: Centered compositions cover the
     # dynamic range of simplex space more.
-    if standardize:  # Standardize
-        totvar = coda.sample_total_variance(temp, sample_center)
-        temp = coda.power(temp, np.power(totvar, -1./2.))
+    if standardize:
+        # Mean squared Aitchison distance to the sample center, expanded as
+        # mean(|x|^2) - 2 mean(x).c + |c|^2 to avoid a difference array
+        totvar = (np.einsum('ij,ij->', clr, clr) / idx.size
+                  - 2 * np.dot(np.mean(clr, axis=0), clr_center)
+                  + np.dot(clr_center, clr_center))
+        clr *= np.power(totvar, -1./2.)
 
     # Interpretation of max truncation: Pull the exterme compositions to
     # threshold distance by using scaling. Scaling factor is determined for
     # each outlier composition to pull more extreme compositions more strongly.
     if trunc_max:
-        # Use Aitchison norm and powering to truncate extreme compositions
-        anorm = coda.aitchison_norm(temp)
+        # Aitchison norm is the Euclidean norm of clr coordinates
+        anorm = np.sqrt(np.einsum('ij,ij->i', clr, clr))
         anorm_thr_min, anorm_thr_max = np.percentile(anorm, [1., 99.])
-        # Max truncate
-        idx_trunc = anorm > anorm_thr_max
-        truncation_power = anorm[idx_trunc] / anorm_thr_max
-        correction = np.ones(anorm.shape)
-        correction[idx_trunc] = truncation_power
-        temp = coda.power(temp, correction[:, None])
-        # min truncate
-        idx_trunc = anorm < anorm_thr_min
-        truncation_power = anorm[idx_trunc] / anorm_thr_min
+        # Max and min truncation powers in one pass
         correction = np.ones(anorm.shape)
-        correction[idx_trunc] = truncation_power
-        temp = coda.power(temp, correction[:, None])
+        np.divide(anorm, anorm_thr_max, out=correction,
+                  where=anorm > anorm_thr_max)
+        np.divide(anorm, anorm_thr_min, out=correction,
+                  where=anorm < anorm_thr_min)
+        clr *= correction[:, None]
     # TODO: Implement this similar to truncate and scpe function but for
     # simplex space. Proportion of dynamic range to the distance of between
     # aitchison norm percentiles gives the global scaling factor. This should
     # be done after truncation though.
 
-    # Put back processed composition
-    bary[mask] = temp
+    # Put back processed composition, closed
+    np.exp(clr, out=clr)
+    clr /= np.sum(clr, axis=-1, keepdims=True)
+    bary[idx] = clr
     return bary.reshape(dims)
@@ -0,0 +1,162 @@
+"""On-disk cache of intermediate arrays shared between runs."""
+
+from __future__ import division
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import numpy as np
+
+
+def default_cache_dir():
+    """Per-user cache directory, following XDG_CACHE_HOME."""
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'iphigen')
+
+
+class DiskCache(object):
+    """Directory of arrays keyed by input content and parameters.
+
+    Entries are `.npy` files named after a hash of the input array (shape,
+    dtype and bytes) and of the parameters that produced them. The total
+    size is bounded: after every write the least recently used entries are
+    removed until the directory is smaller than `max_bytes`. Writes go
+    through a temporary file and an atomic rename, so several processes can
+    share a directory.
+
+    Parameters
+    ----------
+    directory: string
+        Cache directory, created if needed.
+    max_bytes: int
+        Size bound of the directory.
+
+    Attributes
+    ----------
+    hits, misses: int
+        Number of successful and failed lookups.
+    write_errors: int
+        Number of entries that could not be stored, eg. on a full disk.
+
+    Examples
+    --------
+    >>> cache = DiskCache('/tmp/iphigen')
+    >>> key = cache.key(cache.digest(image), kind='surround', sigma=80)
+    >>> surround = cache.get(key)
+    >>> if surround is None:
+    ...     surround = gaussian_filter(image, 80)
+    ...     cache.put(key, surround)
+
+    """
+
+    def __init__(self, directory, max_bytes=4 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits, self.misses, self.write_errors = 0, 0, 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def digest(data):
+        """Content hash of an array, including its shape and dtype."""
+        data = np.ascontiguousarray(data)
+        h = hashlib.blake2b(digest_size=20)
+        h.update('{}{}'.format(data.shape, data.dtype.str).encode())
+        h.update(memoryview(data).cast('B'))
+        return h.hexdigest()
+
+    @staticmethod
+    def key(digest, **params):
+        """Entry key of an input digest and JSON serializable parameters."""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(digest.encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Cached array, or None."""
+        path = self._path(key)
+        try:
+            data = np.load(path)
+            # Mark as recently used
+            os.utime(path, None)
+        except (OSError, ValueError):
+            # Missing, or removed by another process while reading
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Store an array and evict old entries beyond the size bound.
+
+        Write errors, eg. a full disk, are counted in `write_errors` instead
+        of failing the computation.
+        """
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp',
+                                             dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, data)
+            os.replace(temp_path, self._path(key))
+            self.evict()
+        except OSError:
+            with self._lock:
+                self.write_errors += 1
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def evict(self):
+        """Remove least recently used entries beyond `max_bytes`."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all entries."""
+        self.max_bytes, max_bytes = 0, self.max_bytes
+        self.evict()
+        self.max_bytes = max_bytes
+
+    def stats(self):
+        """Hit, miss and write error counts as a string."""
+        lookups = self.hits + self.misses
+        stats = '{} hits, {} misses ({:.0%} hit rate)'.format(
+            self.hits, self.misses, self.hits / lookups if lookups else 0)
+        if self.write_errors:
+            stats += ', {} write errors'.format(self.write_errors)
+        return stats
+
+    def __getstate__(self):
+        # Locks cannot be pickled, eg. when sent to worker processes
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
@@ -0,0 +1,309 @@
+"""Gaussian blur engines used to compute retinex surrounds."""
+
+from __future__ import division
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
+
+# scipy modules are imported where they are used, importing scipy.signal
+# alone takes about half a second and slows down the command line help.
+
+BLUR_METHODS = ('exact', 'iir', 'box', 'fft', 'pyramid')
+
+
+def gaussian_blur(image, sigma, method='exact', output=None, workers=1):
+    """Gaussian blur with selectable engine.
+
+    All engines use reflected boundaries, same as `mode="reflect"` in
+    `scipy.ndimage.gaussian_filter`.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Image to be blurred.
+    sigma : float or sequence of floats
+        Standard deviation of the Gaussian kernel. A sequence gives one value
+        per axis. Axes with sigma 0 are not filtered.
+    method : string
+        One of `BLUR_METHODS`:
+            'exact': Truncated convolution kernel (scipy). Cost grows linearly
+                with sigma.
+            'iir': Recursive Young & van Vliet (1995) filter. Cost does not
+                depend on sigma. Max. error is below 4% of the image range
+                (mean below 0.5%) for sigma >= 2, up to 7% for smaller sigma.
+            'box': Three stacked box filters (Kovesi, 2010). Cost does not
+                depend on sigma. Max. error is below 4% of the image range
+                (mean below 0.6%) for sigma >= 2. Not suitable for sigma < 2.
+            'fft': Multiplication with the Gaussian transfer function on a
+                mirrored image. Cost does not depend on sigma but the working
+                array is 2**ndim times larger than the image. Max. error is
+                below 0.2% of the image range for sigma >= 1.
+            'pyramid': Block-average downsampling by a power of two, residual
+                exact blur at the reduced resolution and linear upsampling.
+                The reduced image keeps at least 4 pixels per sigma, so the
+                speedup grows with sigma. Small sigmas fall back to 'exact'.
+                Max. error is below 0.2% of the image range.
+        Errors are measured against 'exact' on noise, smooth and step images,
+        see `approximation_error`.
+    output : np.ndarray, optional
+        Array in which to place the result.
+    workers : int
+        Number of threads. 'exact', 'iir' and 'box' filter one axis at a time
+        and split the image into slabs along another axis, so the result is
+        bit-identical to the serial one. 'fft' passes the number to
+        `scipy.fft`. 'pyramid' is always serial.
+
+    Returns
+    -------
+    output : np.ndarray
+        Blurred image. Without `output`, of the floating point type of the
+        image (at least float32) for all methods.
+
+    References
+    ----------
+    Young, I. T., & van Vliet, L. J. (1995). Recursive implementation of the
+    Gaussian filter. Signal Processing, 44(2), 139-151.
+    DOI: 10.1016/0165-1684(95)00020-E
+
+    Kovesi, P. (2010). Fast almost-Gaussian filtering. International
+    Conference on Digital Image Computing: Techniques and Applications,
+    121-125. DOI: 10.1109/DICTA.2010.30
+
+    """
+    sigmas = _sigma_per_axis(sigma, image.ndim)
+    dtype = np.result_type(image.dtype, np.float32)
+    if method == 'exact':
+        from scipy.ndimage import gaussian_filter
+        if output is None:
+            output = np.zeros(image.shape, dtype=dtype)
+        if workers == 1:
+            return gaussian_filter(image, sigmas, output=output,
+                                   mode="reflect")
+        return _separable_blur(_exact_blur_axis, image, sigmas, output,
+                               workers)
+    elif method in ('iir', 'box'):
+        if output is None:
+            output = np.zeros(image.shape, dtype=dtype)
+        axis_filter = _iir_blur_axis if method == 'iir' else _box_blur_axis
+        return _separable_blur(axis_filter, image, sigmas, output, workers)
+    elif method == 'fft':
+        result = _fft_blur(image, sigmas, workers)
+    elif method == 'pyramid':
+        result = _pyramid_blur(image, sigmas)
+    else:
+        raise ValueError('Unknown blur method "{}", choose one of {}.'.format(
+            method, ', '.join(BLUR_METHODS)))
+    if output is None:
+        return result.astype(dtype, copy=False)
+    output[...] = result
+    return output
+
+
+def approximation_error(image, sigma, method):
+    """Measure the error of a blur method against the exact filter.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Image to be blurred.
+    sigma : float or sequence of floats
+        Standard deviation of the Gaussian kernel.
+    method : string
+        One of `BLUR_METHODS`.
+
+    Returns
+    -------
+    max_error : float
+        Maximum absolute error relative to the range of the input image.
+    mean_error : float
+        Mean absolute error relative to the range of the input image.
+
+    """
+    image = np.asarray(image, dtype=float)
+    exact = gaussian_blur(image, sigma, 'exact')
+    approx = gaussian_blur(image, sigma, method)
+    data_range = np.ptp(image)
+    if data_range == 0:
+        data_range = 1.
+    diff = np.abs(approx - exact)
+    return np.max(diff) / data_range, np.mean(diff) / data_range
+
+
+def _sigma_per_axis(sigma, ndim):
+    """Expand scalar sigma to one value per axis."""
+    sigmas = np.atleast_1d(np.asarray(sigma, dtype=float))
+    if sigmas.size == 1:
+        sigmas = np.repeat(sigmas, ndim)
+    if sigmas.size != ndim:
+        raise ValueError('Expected {} sigma values, got {}.'.format(
+            ndim, sigmas.size))
+    return sigmas
+
+
+def _separable_blur(axis_filter, image, sigmas, output, workers):
+    """Apply a one dimensional filter along every axis with sigma > 0."""
+    axes = [(axis, sigma) for axis, sigma in enumerate(sigmas) if sigma > 0]
+    if not axes:
+        output[...] = image
+        return output
+    source = image
+    for axis, sigma in axes:
+        _run_on_slabs(partial(axis_filter, sigma=sigma, axis=axis), source,
+                      output, axis, workers)
+        source = output
+    return output
+
+
+def _run_on_slabs(func, data, output, axis, workers):
+    """Run func(data, output) on slabs split along an axis other than axis.
+
+    Lines along `axis` are filtered independently, so slabs need no overlap.
+    """
+    other_axes = [ax for ax in range(data.ndim) if ax != axis]
+    if workers == 1 or not other_axes:
+        func(data, output)
+        return
+    split = max(other_axes, key=lambda ax: data.shape[ax])
+    bounds = np.linspace(0, data.shape[split],
+                         min(workers, data.shape[split]) + 1).astype(int)
+    slabs = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        idx = [slice(None)] * data.ndim
+        idx[split] = slice(start, stop)
+        slabs.append(tuple(idx))
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(lambda idx: func(data[idx], output[idx]), slabs))
+
+
+def _exact_blur_axis(data, output, sigma, axis):
+    """Truncated Gaussian kernel along one axis (scipy)."""
+    from scipy.ndimage import gaussian_filter1d
+    gaussian_filter1d(data, sigma, axis, output=output, mode="reflect")
+
+
+def _iir_blur_axis(data, output, sigma, axis):
+    """Forward and backward third order recursion along one axis."""
+    from scipy.signal import lfilter, lfilter_zi
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * np.sqrt(1 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q**2 + 0.422205 * q**3
+    b1 = 2.44413 * q + 2.85619 * q**2 + 1.26661 * q**3
+    b2 = -(1.4281 * q**2 + 1.26661 * q**3)
+    b3 = 0.422205 * q**3
+    b = [1 - (b1 + b2 + b3) / b0]
+    a = [1, -b1 / b0, -b2 / b0, -b3 / b0]
+
+    # Reflected margins so the recursion has settled once it enters the image
+    pad = int(np.ceil(4 * sigma))
+    n = data.shape[axis]
+    pad_width = [(0, 0)] * data.ndim
+    pad_width[axis] = (pad, pad)
+    data = np.pad(data, pad_width, mode='symmetric')
+
+    # Start each pass from steady state on the edge value
+    zi_shape = [1] * data.ndim
+    zi_shape[axis] = len(a) - 1
+    zi = lfilter_zi(b, a).reshape(zi_shape)
+
+    edge = np.take(data, [0], axis=axis)
+    data, _ = lfilter(b, a, data, axis=axis, zi=zi * edge)
+    data = np.flip(data, axis)
+    edge = np.take(data, [0], axis=axis)
+    data, _ = lfilter(b, a, data, axis=axis, zi=zi * edge)
+    data = np.flip(data, axis)
+    output[...] = np.take(data, np.arange(pad, pad + n), axis=axis)
+
+
+def _box_widths(sigma, nr_boxes=3):
+    """Box filter widths that approximate a Gaussian of given sigma."""
+    w_ideal = np.sqrt(12 * sigma**2 / nr_boxes + 1)
+    w_low = int(np.floor(w_ideal))
+    if w_low % 2 == 0:
+        w_low -= 1
+    w_up = w_low + 2
+    m = (12 * sigma**2 - nr_boxes * w_low**2 - 4 * nr_boxes * w_low
+         - 3 * nr_boxes) / (-4 * w_low - 4)
+    m = int(np.round(m))
+    return [w_low] * m + [w_up] * (nr_boxes - m)
+
+
+def _box_blur_axis(data, output, sigma, axis):
+    """Stacked running-average filters along one axis."""
+    from scipy.ndimage import uniform_filter1d
+    for w in _box_widths(sigma):
+        uniform_filter1d(data, w, axis=axis, output=output, mode="reflect")
+        data = output
+
+
+def _fft_blur(image, sigmas, workers=1):
+    """Gaussian transfer function applied on a mirrored image."""
+    import scipy.fft
+    data = np.asarray(image, dtype=float)
+    axes = [ax for ax, s in enumerate(sigmas) if s > 0]
+    if not axes:
+        return data.copy()
+    # Periodic extension of [image, flipped image] equals reflected boundaries
+    for ax in axes:
+        data = np.concatenate([data, np.flip(data, ax)], axis=ax)
+    shape = [data.shape[ax] for ax in axes]
+    spec = scipy.fft.rfftn(data, axes=axes, workers=workers)
+    data = None
+    for i, ax in enumerate(axes):
+        if i == len(axes) - 1:
+            freq = scipy.fft.rfftfreq(shape[i])
+        else:
+            freq = scipy.fft.fftfreq(shape[i])
+        bcast = [1] * spec.ndim
+        bcast[ax] = freq.size
+        spec *= np.exp(-2 * (np.pi * sigmas[ax] * freq)**2).reshape(bcast)
+    data = scipy.fft.irfftn(spec, s=shape, axes=axes, workers=workers)
+    for ax in axes:
+        data = np.take(data, np.arange(image.shape[ax]), axis=ax)
+    return data
+
+
+def _pyramid_blur(image, sigmas, min_sigma=4):
+    """Blur at reduced resolution and upsample back."""
+    from scipy.ndimage import gaussian_filter, zoom
+    # Power of two downsampling factors that keep min_sigma pixels per sigma
+    factors = []
+    for sigma in sigmas:
+        if sigma >= 2 * min_sigma:
+            factors.append(2**int(np.floor(np.log2(sigma / min_sigma))))
+        else:
+            factors.append(1)
+    if max(factors) == 1:
+        return gaussian_filter(image, sigmas, mode="reflect")
+
+    # Reflected margins wide enough to hold the kernel, rounded to full blocks
+    pad_width = []
+    for n, f, sigma in zip(image.shape, factors, sigmas):
+        if f > 1:
+            low = int(np.ceil(4 * sigma / f)) * f
+            pad_width.append((low, low + (-(n + 2 * low)) % f))
+        else:
+            pad_width.append((0, 0))
+    data = np.pad(np.asarray(image, dtype=float), pad_width, mode='symmetric')
+
+    # Downsample by block averaging
+    blocks = []
+    for n, f in zip(data.shape, factors):
+        blocks.extend([n // f, f])
+    data = data.reshape(blocks).mean(axis=tuple(range(1, len(blocks), 2)))
+
+    # Residual blur, minus the variance of block averaging and interpolation
+    coarse_sigmas = []
+    for sigma, f in zip(sigmas, factors):
+        if f > 1:
+            var = sigma**2 - (2 * f**2 - 1) / 12
+            coarse_sigmas.append(np.sqrt(max(var, 0)) / f)
+        else:
+            coarse_sigmas.append(sigma)
+    data = gaussian_filter(data, coarse_sigmas, mode="reflect")
+
+    # Upsample with pixel centers aligned to the blocks, then crop margins
+    data = zoom(data, factors, order=1, mode='nearest', grid_mode=True)
+    crop = tuple(slice(p[0], p[0] + n) for p, n in zip(pad_width, image.shape))
+    return data[crop]
@@ -2,86 +2,377 @@
 
 from __future__ import division
 import os
-import cv2
+import sys
+import json
+import time
+import multiprocessing
 import numpy as np
-from iphigen import core, utils
+from iphigen import metrics, output, quantiles, tiled, utils
+from iphigen.prefetch import ReadAhead
+from iphigen.resources import Resources
+from iphigen.pipeline import Pipeline
 from iphigen.ui import user_interface, display_welcome_message
 import iphigen.config as cfg
 
+# Output writer and shared resources of the current (worker) process
+_state = {}
+
 
 def main():
     """Iphigen processes for 2D images."""
     user_interface()
     display_welcome_message()
+    run()
+
+
+def run(resources=None):
+    """Process the images selected in `iphigen.config`.
 
-    # Load data
-    for f in cfg.filename:
-        data = cv2.imread(f)
-        dirname, basename, ext = utils.parse_filepath(f)
-        if cfg.out_dir:
-            dirname = cfg.out_dir
-        print('Selected file:')
-        print('  Name: {}'.format(f))
-        print('  Dimensions: {}'.format(data.shape))
-
-        data = np.asarray(data, dtype=float)
-        # Compute intensity
-        inten = np.sum(data, axis=-1)
-        # Compute barycentic coordinates
-        bary = data / inten[..., None]
-
-        suf = ''  # suffix
-        if cfg.intensity_balance:
-            print('Applying intensity balance (IB)...')
-            print('  Percentiles: {}'.format(cfg.int_bal_perc))
-            suf = suf + '_IB'
-            inten = utils.truncate_range(inten,
-                                         pmin=cfg.int_bal_perc[0],
-                                         pmax=cfg.int_bal_perc[1])
-            inten = utils.set_range(inten, zero_to=255*data.shape[-1])
-
-            data = bary * inten[..., None]
-            # Update barycentic coordinates
-            bary = data / inten[..., None]
-
-        if cfg.retinex:
-            print('Applying multi-scale retinex with barycenter preservation (MSRBP)...')
-            print('  Selected retinex scales: {}'.format(cfg.scales))
-            suf = suf + '_MSRBP' + utils.prepare_scale_suffix(cfg.scales)
-            new_inten = core.multi_scale_retinex(inten, scales=cfg.scales)
-            # Scale back to the approximage original intensity range
-            inten = core.scale_approx(new_inten, inten)
-
-        if cfg.simplex_color_balance:
-            print('Applying simplex color balance (SimplexCB)...')
-            print('  Centering: {}'.format(cfg.simplex_center))
-            print('  Standardize: {}'.format(cfg.simplex_standardize))
-            suf = suf + '_SimplexCB'
-            bary = core.simplex_color_balance(
-                bary, center=cfg.simplex_center,
-                standardize=cfg.simplex_standardize)
-
-        # Insert back the processed intensity image
-        data = bary * inten[..., None]
-
-        if cfg.simplest_color_balance:
-            print('Applying simplest color balance (SimplestCB)...')
-            print('  Percentiles: {}'.format(cfg.int_bal_perc))
-            suf = suf + '_SimplestCB'
-            data = core.simplest_color_balance(
-                data, pmin=cfg.simplest_perc[0], pmax=cfg.simplest_perc[1])
-
-        # Check at least one operation is selected before saving anything
-        if sum([cfg.retinex, cfg.intensity_balance, cfg.simplex_color_balance,
-                cfg.simplest_color_balance]) > 0:
-            print('Saving output...')
-            out_basepath = os.path.join(dirname, '{}{}'.format(basename, suf))
-            out_path = out_basepath + os.extsep + ext
-            cv2.imwrite(out_path, data)
-            print('  {} is saved.\n'.format(out_path))
+    Parameters
+    ----------
+    resources: iphigen.resources.Resources, optional
+        Disk caches, I/O threads and worker processes to reuse, eg. in
+        server mode. By default they are created for this run.
+
+    Returns
+    -------
+    results: list of tuples
+        Input path, output path (None if failed or nothing is saved) and
+        error message (None if successful) for every input.
+
+    """
+    if cfg.mask:
+        raise ValueError('--mask is only available for nifti images.')
+    start = time.time()
+    nr_files = len(cfg.filename)
+    writer = reader = None
+    if cfg.jobs > 1:
+        print('Processing {} files with {} jobs...'.format(
+            nr_files, cfg.jobs))
+        if resources is None:
+            pool = multiprocessing.Pool(cfg.jobs, initializer=_init_worker)
+        else:
+            pool = resources.process_pool(cfg.jobs, _init_worker)
+        settings = _config_snapshot()
+        results = pool.imap(_process_file_task,
+                            [(settings, f) for f in cfg.filename])
+    else:
+        # Reading the next files and saving the previous ones overlap with
+        # processing of the current file
+        pool = read_threads = write_threads = None
+        if resources is not None:
+            read_threads = resources.executor('read')
+            write_threads = resources.executor('write')
+        _state['resources'] = resources
+        writer = _state['writer'] = output.Writer(
+            background=True, max_pending=cfg.write_behind,
+            executor=write_threads)
+        if cfg.stream:
+            results = map(_process_file_safe, cfg.filename)
         else:
-            print('No operation selected, not saving anything.')
+            reader = ReadAhead(_read_image, cfg.filename,
+                               depth=cfg.read_ahead, executor=read_threads)
+            results = (_process_file_safe(f, loaded)
+                       for f, loaded in reader)
+
+    # Results arrive in input order, report progress as they come
+    failed, files = [], []
+    for i, (f, out_path, error, duration, records) in enumerate(results):
+        if error is None:
+            print('[{}/{}] {} ({:.1f} s)'.format(i+1, nr_files, f, duration))
+        else:
+            failed.append(f)
+            print('[{}/{}] {} FAILED: {}'.format(i+1, nr_files, f, error))
+        if cfg.profile:
+            for line in metrics.summary(records):
+                print('    ' + line)
+        files.append({'file': f, 'out_path': out_path, 'error': error,
+                      'wall': duration, 'records': records})
+    if pool is not None and resources is None:
+        pool.close()
+        pool.join()
+    if writer is not None:
+        writer.close()
+        _state.clear()
+        for label, error in writer.errors:
+            for e in files:
+                if e['out_path'] == label:
+                    e['out_path'], e['error'] = None, error
+                    failed.append(e['file'])
+                    print('{} FAILED: {}'.format(e['file'], error))
+        write_summary = writer.summary()
+    else:
+        write_records = [r for e in files for r in e['records']
+                         if 'bytes_written' in r]
+        write_summary = output.summary(
+            sum(r['files_written'] for r in write_records),
+            sum(r['bytes_written'] for r in write_records),
+            sum(r['write_time'] for r in write_records))
+
+    duration = time.time() - start
+    print('Processed {} files ({} failed) in {:.1f} seconds, '
+          '{:.2f} files/s.'.format(nr_files, len(failed), duration,
+                                   nr_files / duration))
+    for f in failed:
+        print('  Failed: {}'.format(f))
+    print(write_summary)
+    total = {'files': nr_files, 'failed': len(failed), 'wall': duration,
+             'jobs': cfg.jobs}
+    if reader is not None:
+        print(reader.stats.summary())
+        total['read_ahead'] = reader.stats.as_dict()
+    if writer is not None:
+        print(writer.stats.summary())
+        total['write_behind'] = writer.stats.as_dict()
+    if cfg.metrics_json:
+        metrics.write_json(cfg.metrics_json, files, total=total)
+        print('Metrics are saved to {}'.format(cfg.metrics_json))
     print('Finished.')
+    return [(e['file'], e['out_path'], e['error']) for e in files]
+
+
+def process_file(f, data=None):
+    """Apply the selected methods to one image and save the result.
+
+    Parameters
+    ----------
+    f: string
+        Path to image.
+    data: np.ndarray, optional
+        Image read from `f` beforehand, eg. by a read-ahead thread.
+
+    Returns
+    -------
+    out_path: string or None
+        Path of the saved image. None if no operation is selected.
+
+    """
+    if cfg.stream:
+        return process_stream(f)
+    if data is None:
+        data = _read_image(f)
+    dirname, basename, ext = utils.parse_filepath(f)
+    if cfg.out_dir:
+        dirname = cfg.out_dir
+    print('Selected file:')
+    print('  Name: {}'.format(f))
+    print('  Dimensions: {}'.format(data.shape))
+    if cfg.tile_size:
+        with metrics.measure('tiled', data, tile_size=cfg.tile_size):
+            return _process_tiled(data, dirname, basename, ext)
+    if cfg.sweep_scales or cfg.sweep_perc:
+        return _process_sweep(data, dirname, basename, ext)
+
+    pipeline = Pipeline.from_config(resources=_state.get('resources'))
+    if not pipeline.stages:
+        print('No operation selected, not saving anything.')
+        return None
+    data = pipeline.run(data)
+
+    print('Saving output...')
+    out_basepath = os.path.join(dirname, '{}{}'.format(basename,
+                                                       pipeline.suffix))
+    out_path = out_basepath + os.extsep + ext
+    _save_image(out_path, data)
+    return out_path
+
+
+def _read_image(f):
+    """Read and decode one image."""
+    import cv2
+    data = cv2.imread(f)
+    if data is None:
+        raise ValueError('{} cannot be read.'.format(f))
+    return data
+
+
+def _save_image(out_path, data):
+    """Save an output, in the background when a writer is running."""
+    writer = _state.get('writer')
+    dtype = cfg.output_dtype or 'uint8'
+    if writer is None:
+        output.save_image(out_path, data, dtype)
+    else:
+        writer.submit(output.save_image, out_path, data, dtype,
+                      label=out_path)
+    if writer is not None and writer.background:
+        print('  {} is being saved.\n'.format(out_path))
+    else:
+        print('  {} is saved.\n'.format(out_path))
+
+
+def process_stream(f):
+    """Apply the selected methods to every frame of a video or sequence.
+
+    Parameters
+    ----------
+    f: string
+        Path to a video, or a numbered image sequence pattern.
+
+    Returns
+    -------
+    out_path: string or None
+        Path (or pattern) of the saved frames. None if no operation is
+        selected.
+
+    """
+    from iphigen import video
+    dirname, basename, ext = utils.parse_filepath(f)
+    if cfg.out_dir:
+        dirname = cfg.out_dir
+    percentile_cache = None
+    if cfg.temporal_smoothing is not None or cfg.stats_interval > 1:
+        percentile_cache = quantiles.TemporalPercentileCache(
+            alpha=cfg.temporal_smoothing or 1., interval=cfg.stats_interval)
+    # Frames are never processed twice, caching them only fills the disk
+    pipeline = Pipeline.from_config(percentile_cache=percentile_cache,
+                                    disk_cache=None, verbose=False)
+    if not pipeline.stages:
+        print('No operation selected, not saving anything.')
+        return None
+    out_basepath = os.path.join(dirname, '{}{}'.format(basename,
+                                                       pipeline.suffix))
+    out_path = out_basepath + os.extsep + ext
+    print('Streaming {}...'.format(f))
+    with metrics.measure('stream') as record:
+        nr_frames = video.process_video(f, out_path, pipeline,
+                                        prefetch=cfg.prefetch)
+    record['frames'] = nr_frames
+    print('  {} frames, {:.1f} frames/s'.format(
+        nr_frames, nr_frames / max(record['wall'], 1e-9)))
+    print('  {} is saved.\n'.format(out_path))
+    return out_path
+
+
+def _process_tiled(data, dirname, basename, ext):
+    """Process an image tile by tile and save the result."""
+    if cfg.simplex_color_balance:
+        raise ValueError('Simplex color balance is not available with '
+                         '--tile_size.')
+    suf = Pipeline.from_config().suffix
+    if not suf:
+        print('No operation selected, not saving anything.')
+        return None
+
+    print('Processing in tiles of {0}x{0} pixels...'.format(cfg.tile_size))
+    out_dir = dirname if dirname else None
+    data = tiled.process_image_tiled(
+        data, tile_size=cfg.tile_size,
+        intensity_balance=cfg.intensity_balance,
+        int_bal_perc=cfg.int_bal_perc, retinex=cfg.retinex,
+        scales=cfg.scales, blur=cfg.blur, cascade=cfg.cascade,
+        workers=cfg.workers,
+        simplest_color_balance=cfg.simplest_color_balance,
+        simplest_perc=cfg.simplest_perc, tmp_dir=out_dir,
+        dtype=np.dtype(cfg.precision))
+    print('Saving output...')
+    out_basepath = os.path.join(dirname, '{}{}'.format(basename, suf))
+    out_path = out_basepath + os.extsep + ext
+    _save_image(out_path, data)
+    return out_path
+
+
+def _process_sweep(data, dirname, basename, ext):
+    """Process an image with every sweep setting and save them as a grid."""
+    import cv2
+    pipeline = Pipeline.from_config()
+    results = pipeline.sweep(data, scale_sets=cfg.sweep_scales,
+                             simplest_percs=cfg.sweep_perc)
+
+    print('Saving {} outputs as a grid...'.format(len(results)))
+    nr_cols = int(np.ceil(np.sqrt(len(results))))
+    nr_rows = int(np.ceil(len(results) / nr_cols))
+    height, width = data.shape[:2]
+    # Floating point, so uint16 and float32 outputs keep their precision
+    grid = np.zeros((nr_rows * height, nr_cols * width, data.shape[2]),
+                    dtype=np.float32)
+    font_scale = max(height, width) / 1000.
+    thickness = max(1, int(round(2 * font_scale)))
+    cells = []
+    for i, (params, out) in enumerate(results):
+        row, col = divmod(i, nr_cols)
+        tile = grid[row*height:(row+1)*height, col*width:(col+1)*width]
+        tile[...] = np.nan_to_num(out)
+        label = 'scales {} perc {}'.format(
+            ','.join(str(s) for s in params['scales']),
+            ','.join('{:g}'.format(p) for p in params['simplest_perc']))
+        origin = (int(10 * font_scale) + 2, int(30 * font_scale) + 2)
+        # cv2 only draws text on 8 bit images, labels are blended from
+        # coverage masks: a black outline, then white text
+        for value, weight in [(0, thickness * 3), (255, thickness)]:
+            coverage = np.zeros((height, width), dtype=np.uint8)
+            cv2.putText(coverage, label, origin, cv2.FONT_HERSHEY_SIMPLEX,
+                        font_scale, 255, weight, cv2.LINE_AA)
+            alpha = coverage[..., None] / 255.
+            tile *= 1 - alpha
+            tile += value * alpha
+        cells.append(dict(params, row=row, col=col))
+
+    out_basepath = os.path.join(dirname, '{}{}'.format(
+        basename, pipeline.sweep_suffix))
+    out_path = out_basepath + os.extsep + ext
+    with open(out_basepath + '.json', 'w') as f:
+        json.dump({'input': basename + os.extsep + ext,
+                   'tile_shape': [height, width], 'outputs': cells}, f,
+                  indent=2)
+    _save_image(out_path, grid)
+    return out_path
+
+
+def _process_file_safe(f, loaded=None):
+    """Process one image, returning errors instead of raising them.
+
+    Measurements of the stages are returned too, so that they reach the
+    parent process when running in a worker. `loaded` is a future of the
+    image read ahead, its reading errors are returned like the others.
+    """
+    start = time.time()
+    recorder = metrics.Recorder(file=f)
+    writer = _state.get('writer')
+    try:
+        with recorder, metrics.measure('file') as record:
+            data = None if loaded is None else loaded.result()
+            if writer is not None and not writer.background:
+                before = writer.files, writer.bytes_written, writer.write_time
+                out_path = process_file(f, data)
+                record['files_written'] = writer.files - before[0]
+                record['bytes_written'] = writer.bytes_written - before[1]
+                record['write_time'] = writer.write_time - before[2]
+            else:
+                out_path = process_file(f, data)
+        error = None
+    except Exception as e:
+        out_path = None
+        error = '{}: {}'.format(type(e).__name__, e)
+    return f, out_path, error, time.time() - start, recorder.records
+
+
+def _config_snapshot():
+    """Collect configuration values to hand over to worker processes."""
+    return {k: getattr(cfg, k) for k in dir(cfg)
+            if not k.startswith('_') and k != 'filename'}
+
+
+def _process_file_task(task):
+    """Process one image in a worker with the configuration of its run.
+
+    Workers can outlive runs (see `iphigen.resources`), so every task
+    carries the configuration.
+    """
+    settings, f = task
+    for k, v in settings.items():
+        setattr(cfg, k, v)
+    return _process_file_safe(f)
+
+
+def _init_worker():
+    """Set up a worker process."""
+    # Outputs are saved by the worker, sizes are reported to the parent
+    _state['writer'] = output.Writer(background=False)
+    # Disk caches are kept as long as the worker
+    _state['resources'] = Resources()
+    # Progress is reported by the parent process
+    sys.stdout = open(os.devnull, 'w')
 
 
 if __name__ == "__main__":
@@ -2,99 +2,294 @@
 
 from __future__ import division
 import os
+import json
 import numpy as np
-import nibabel as nb
-from iphigen import core, utils
+from iphigen import metrics, output, utils
+from iphigen.prefetch import ReadAhead
+from iphigen.pipeline import Pipeline
 from iphigen.ui import user_interface, display_welcome_message
 import iphigen.config as cfg
 
+# Shared resources of the current run
+_state = {}
+
 
 def main():
     """Iphigen processes for nifti images."""
     user_interface()
     display_welcome_message()
+    run()
+
+
+def run(resources=None):
+    """Process the images selected in `iphigen.config`.
+
+    Parameters
+    ----------
+    resources: iphigen.resources.Resources, optional
+        Disk caches and I/O threads to reuse, eg. in server mode. By
+        default they are created for this run. Worker processes of
+        `--series` are always started for the run, as they hold its inputs.
+
+    Returns
+    -------
+    out_paths: list of strings
+        Saved images, empty if no operation is selected.
+
+    """
+    _state['resources'] = resources
+    try:
+        with metrics.Recorder(file=cfg.filename) as recorder:
+            with metrics.measure('file'):
+                out_paths = process_files()
+    finally:
+        _state.clear()
+    if cfg.profile:
+        print('\n'.join(metrics.summary(recorder.records)))
+    if cfg.metrics_json:
+        metrics.write_json(cfg.metrics_json, [{
+            'file': cfg.filename, 'records': recorder.records}])
+        print('Metrics are saved to {}'.format(cfg.metrics_json))
+    print('Finished.')
+    return out_paths
+
+
+def process_files():
+    """Apply the selected methods to the input images and save them.
 
-    # Load data
+    Returns
+    -------
+    out_paths: list of strings
+        Saved images.
+
+    """
+    # Load data, channel files are decompressed in parallel
     data, affine, dirname, basename, ext = [], [], [], [], []
     nr_fileinputs = len(cfg.filename)
+    reader = ReadAhead(_load_input, cfg.filename, depth=cfg.read_ahead,
+                       threads=cfg.read_ahead,
+                       executor=_executor('read'))
     print('Selected file(s):')
-    for i in range(nr_fileinputs):
-        nii = nb.load(cfg.filename[i])
+    for i, (f, loaded) in enumerate(reader):
+        nii, volume = loaded.result()
         affine.append(nii.affine)
-        parses = utils.parse_filepath(cfg.filename[i])
-        data.append(np.squeeze(nii.get_data()))
-        print('  Name: {}'.format(cfg.filename[i]))
-        print('  Dimensions: {}'.format(data[i].shape))
+        parses = utils.parse_filepath(f)
+        print('  Name: {}'.format(f))
+        print('  Dimensions: {}'.format(nii.shape))
         if cfg.out_dir:
             dirname.append(cfg.out_dir)
         else:
             dirname.append(parses[0])
         basename.append(parses[1])
         ext.append(parses[2])
+        if volume is not None:
+            data.append(volume)
+        if i == 0:
+            voxel_size = get_voxel_size(nii)
+    if data:
+        print(reader.stats.summary())
 
-    # Reorganize data
-    data = np.asarray(data)
-    data = data.transpose([1, 2, 3, 0])
-    # Compute intensity
-    inten = np.sum(data, axis=-1)
-    # Compute barycentic coordinates (equivalent to intensity for 0-simplex)
-    bary = data / inten[..., None]
+    if cfg.series:
+        return main_series(dirname, basename, ext, voxel_size)
+    if cfg.chunk_size:
+        if cfg.mask:
+            raise ValueError('Masks are not available with --chunk_size.')
+        with metrics.measure('chunked', chunk_size=cfg.chunk_size):
+            return main_chunked(dirname, basename, ext, voxel_size)
 
-    suf = ''  # suffix
     # TODO: consider zero_to option for MRI data
     if cfg.intensity_balance:
         raise ValueError('Intensity balance not implemented.')
-        # print('Applying intensity balance...')
-        # print('  Percentiles: {}'.format(cfg.int_bal_perc))
-        # suf = suf + '_IB'
-        # inten = utils.truncate_and_scale(
-        #     inten, pmin=cfg.int_bal_perc[0], pmax=cfg.int_bal_perc[1],
-        #     zero_to=255*data.shape[-1])
-        # data = bary * inten[..., None]
-        # # Update barycentic coordinates
-        # bary = data / inten[..., None]
-
-    if cfg.retinex:
-        print('Applying multi-scale retinex with barycenter preservation (MSRBP)...')
-        print('  Selected scales: {}'.format(cfg.scales_nifti))
-        suf = suf + '_MSRBP' + utils.prepare_scale_suffix(cfg.scales_nifti)
-        new_inten = core.multi_scale_retinex(inten, scales=cfg.scales_nifti)
-        # Scale back to the approximage original intensity range
-        inten = core.scale_approx(new_inten, inten)
-
-    if cfg.simplex_color_balance:
-        print('Applying simplex color balance...')
-        print('  Centering: {}'.format(cfg.simplex_center))
-        print('  Standardize: {}'.format(cfg.simplex_standardize))
-        suf = suf + '_SimplexCB'
-        bary = core.simplex_color_balance(bary)
-
-    # Insert back the processed intensity image
-    data = bary * inten[..., None]
-
-    if cfg.simplest_color_balance:
-        print('Applying simplest color balance...')
-        print('  Percentiles: {}'.format(cfg.int_bal_perc))
-        suf = suf + '_SimplestCB'
-        data = core.simplest_color_balance(
-            data, pmin=cfg.simplest_perc[0], pmax=cfg.simplest_perc[1])
-
-    # Check at least one operation is selected before saving anything
-    if sum([cfg.retinex, cfg.intensity_balance, cfg.simplex_color_balance,
-            cfg.simplest_color_balance]) > 0:
-        print('Saving output(s)...')
+    if voxel_size is not None:
+        # Axes of length 1 are squeezed out of the data
+        voxel_size = [v for n, v in zip(nii.shape, voxel_size) if n != 1]
+        if len(voxel_size) != data[0].ndim:
+            raise ValueError('--scales_mm needs 3D images, use --series for '
+                             '4D images.')
+    pipeline = Pipeline.from_config(scales=cfg.scales_nifti,
+                                    mask=load_mask(), voxel_size=voxel_size,
+                                    resources=_state.get('resources'))
+    if not pipeline.stages:
+        print('No operation selected, not saving anything.')
+        return []
+
+    # Reorganize data, files become channels
+    data = np.stack(data, axis=-1)
+    if cfg.sweep_scales or cfg.sweep_perc:
+        return main_sweep(pipeline, data, affine, dirname, basename, ext)
+    data = pipeline.run(data)
+
+    print('Saving output(s)...')
+    out_paths = []
+    with _writer(nr_fileinputs) as writer:
         for i in range(nr_fileinputs):
             # Generate output path
             out_basepath = os.path.join(dirname[i],
-                                        '{}{}'.format(basename[i], suf))
+                                        '{}{}'.format(basename[i],
+                                                      pipeline.suffix))
             out_path = out_basepath + os.extsep + ext[i]
-            # Create nifti image and save
-            img = nb.Nifti1Image(data[..., i], affine=affine[i])
-            nb.save(img, out_path)
-            print('  {} is saved.\n'.format(out_path))
-    else:
+            writer.submit(output.save_nifti, out_path, data[..., i],
+                          affine[i], _output_dtype(), cfg.compress_level,
+                          label=out_path)
+            out_paths.append(out_path)
+    return _report(writer, out_paths)
+
+
+def _load_input(path):
+    """Open a nifti image and read its data unless it is processed lazily."""
+    import nibabel as nb
+    nii = nb.load(path, mmap=True)
+    if cfg.chunk_size or cfg.series:
+        return nii, None
+    return nii, np.squeeze(nii.get_fdata(dtype=cfg.precision))
+
+
+def _writer(nr_outputs):
+    """Background writer compressing outputs in parallel."""
+    return output.Writer(max_pending=nr_outputs,
+                         threads=min(nr_outputs, os.cpu_count() or 1),
+                         executor=_executor('write'))
+
+
+def _executor(name):
+    """Shared I/O thread pool of the run, None to start new threads."""
+    resources = _state.get('resources')
+    return None if resources is None else resources.executor(name)
+
+
+def _output_dtype():
+    """Data type of saved images."""
+    return cfg.output_dtype or cfg.precision
+
+
+def _report(writer, out_paths):
+    """Print saved outputs and write statistics, raise write errors."""
+    if writer.errors:
+        raise IOError('; '.join('{}: {}'.format(*e) for e in writer.errors))
+    for out_path in out_paths:
+        print('  {} is saved.'.format(out_path))
+    print(writer.summary())
+    print(writer.stats.summary())
+    return out_paths
+
+
+def main_sweep(pipeline, data, affine, dirname, basename, ext):
+    """Process with every sweep setting, one output volume per setting.
+
+    Parameters of each volume are stored as JSON in a comment extension of
+    the NIfTI header and in a .json file next to the output.
+    """
+    import nibabel as nb
+    results = pipeline.sweep(data, scale_sets=cfg.sweep_scales,
+                             simplest_percs=cfg.sweep_perc)
+    volumes = [params for params, _ in results]
+    print('Saving {} volumes per output...'.format(len(volumes)))
+    out_paths = []
+    nr_outputs = len(cfg.filename)
+    with _writer(nr_outputs) as writer:
+        for i in range(nr_outputs):
+            out_basepath = os.path.join(dirname[i], '{}{}'.format(
+                basename[i], pipeline.sweep_suffix))
+            out_path = out_basepath + os.extsep + ext[i]
+            sidecar = json.dumps({'input': cfg.filename[i],
+                                  'volumes': volumes})
+            with open(out_basepath + '.json', 'w') as f:
+                f.write(sidecar)
+            writer.submit(
+                output.save_nifti, out_path,
+                np.stack([out[..., i] for _, out in results], axis=-1),
+                affine[i], _output_dtype(), cfg.compress_level,
+                extensions=[nb.nifti1.Nifti1Extension('comment',
+                                                      sidecar.encode())],
+                descrip='iphigen sweep, parameters in extension',
+                label=out_path)
+            out_paths.append(out_path)
+    return _report(writer, out_paths)
+
+
+def get_voxel_size(nii):
+    """Voxel size of the three spatial axes when `scales_mm` is set.
+
+    Returns
+    -------
+    voxel_size: list of floats or None
+
+    """
+    if not cfg.scales_mm:
+        return None
+    voxel_size = [float(z) for z in nii.header.get_zooms()[:3]]
+    print('  Voxel size: {} mm'.format(' x '.join(
+        '{:g}'.format(v) for v in voxel_size)))
+    return voxel_size
+
+
+def load_mask():
+    """Foreground mask selected in `iphigen.config`.
+
+    Returns
+    -------
+    mask: np.ndarray, 'auto' or None
+        Non-zero voxels of the mask image, squeezed like the inputs.
+
+    """
+    if cfg.mask in (None, 'auto'):
+        return cfg.mask
+    import nibabel as nb
+    print('  Mask: {}'.format(cfg.mask))
+    return np.squeeze(np.asanyarray(nb.load(cfg.mask).dataobj)) != 0
+
+
+def main_chunked(dirname, basename, ext, voxel_size=None):
+    """Out-of-core processing, slab by slab along the third axis."""
+    from iphigen import chunked
+    if cfg.intensity_balance or cfg.simplex_color_balance:
+        raise ValueError('Only retinex and simplest color balance are '
+                         'available with --chunk_size.')
+    suf = Pipeline.from_config(scales=cfg.scales_nifti,
+                               voxel_size=voxel_size).suffix
+    if not suf:
         print('No operation selected, not saving anything.')
-    print('Finished.')
+        return []
+
+    print('Processing in slabs of {} slices...'.format(cfg.chunk_size))
+    out_paths = [
+        os.path.join(d, '{}{}'.format(b, suf)) + os.extsep + e
+        for d, b, e in zip(dirname, basename, ext)]
+    chunked.process_nifti_chunked(
+        cfg.filename, out_paths, chunk_size=cfg.chunk_size,
+        retinex=cfg.retinex, scales=cfg.scales_nifti, blur=cfg.blur,
+        cascade=cfg.cascade, workers=cfg.workers,
+        simplest_color_balance=cfg.simplest_color_balance,
+        simplest_perc=cfg.simplest_perc, dtype=np.dtype(cfg.precision),
+        voxel_size=voxel_size, compresslevel=cfg.compress_level)
+    for out_path in out_paths:
+        print('  {} is saved.'.format(out_path))
+    return out_paths
+
+
+def main_series(dirname, basename, ext, voxel_size=None):
+    """Volume by volume processing of 4D images."""
+    from iphigen import timeseries
+    if cfg.intensity_balance:
+        raise ValueError('Intensity balance not implemented.')
+    # Volumes are never processed twice, caching them only fills the disk
+    pipeline = Pipeline.from_config(scales=cfg.scales_nifti, mask=load_mask(),
+                                    voxel_size=voxel_size, disk_cache=None,
+                                    verbose=False)
+    if not pipeline.stages:
+        print('No operation selected, not saving anything.')
+        return []
+
+    print('Processing volumes with {} jobs...'.format(cfg.jobs))
+    out_paths = [
+        os.path.join(d, '{}{}'.format(b, pipeline.suffix)) + os.extsep + e
+        for d, b, e in zip(dirname, basename, ext)]
+    timeseries.process_nifti_series(cfg.filename, out_paths, pipeline,
+                                    jobs=cfg.jobs,
+                                    compresslevel=cfg.compress_level)
+    for out_path in out_paths:
+        print('  {} is saved.'.format(out_path))
+    return out_paths
 
 
 if __name__ == "__main__":
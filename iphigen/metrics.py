@@ -0,0 +1,154 @@
+"""Timing and memory measurements of processing stages.
+
+Stages are wrapped in `measure`, which sends one record (a dictionary) per
+stage to every registered hook. Embedding code collects records with a
+`Recorder`, or registers its own function with `add_hook`.
+"""
+
+from __future__ import division
+import sys
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_hooks = []
+_lock = threading.Lock()
+
+
+def add_hook(hook):
+    """Call `hook(record)` for every measured stage."""
+    with _lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Stop calling a hook added with `add_hook`."""
+    with _lock:
+        _hooks.remove(hook)
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@contextmanager
+def measure(stage, data=None, **info):
+    """Measure a stage and send its record to the hooks.
+
+    Records have the keys 'stage', 'wall' (seconds), 'cpu' (process CPU
+    seconds, includes all threads), 'rss_delta' (growth of the peak resident
+    set size in bytes, 0 if an earlier stage already reached that peak),
+    'shape', 'dtype' and 'nbytes' of the given array, and any extra keyword
+    arguments. Records of stages that raise are not sent.
+
+    Parameters
+    ----------
+    stage: string
+        Stage name.
+    data: np.ndarray, optional
+        Input array of the stage.
+    **info
+        Extra JSON serializable fields, eg. the sigma of a retinex surround.
+
+    Examples
+    --------
+    >>> with measure('retinex', inten, scales=[15, 80, 250]) as record:
+    ...     msr = multi_scale_retinex(inten)
+    >>> record['wall']
+
+    """
+    record = dict(stage=stage, **info)
+    if data is not None:
+        record.update(shape=list(data.shape), dtype=str(data.dtype),
+                      nbytes=int(data.nbytes))
+    rss, cpu, wall = peak_rss(), time.process_time(), time.time()
+    yield record
+    record['wall'] = time.time() - wall
+    record['cpu'] = time.process_time() - cpu
+    if rss is not None:
+        rss = peak_rss() - rss
+    record['rss_delta'] = rss
+    with _lock:
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(record)
+
+
+class Recorder(object):
+    """Collect records of measured stages.
+
+    Parameters
+    ----------
+    **info
+        Fields added to every collected record, eg. the processed file.
+
+    Examples
+    --------
+    >>> with Recorder(file='image.png') as recorder:
+    ...     pipeline.run(data)
+    >>> print('\\n'.join(summary(recorder.records)))
+
+    """
+
+    def __init__(self, **info):
+        self.info = info
+        self.records = []
+
+    def __call__(self, record):
+        record = dict(record, **self.info)
+        self.records.append(record)
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        remove_hook(self)
+        return False
+
+
+def summary(records):
+    """Lines of a human readable table of records."""
+    lines = ['{:<28} {:>9} {:>9} {:>9}  {}'.format(
+        'stage', 'wall (s)', 'cpu (s)', 'rss +MB', 'array')]
+    for r in records:
+        name = r['stage']
+        if 'sigma' in r:
+            name = '{} sigma={}'.format(name, r['sigma'])
+        rss = r.get('rss_delta')
+        rss = '' if rss is None else '{:.1f}'.format(rss / 2**20)
+        array = ''
+        if 'shape' in r:
+            array = '{} {}'.format('x'.join(str(n) for n in r['shape']),
+                                   r['dtype'])
+        lines.append('{:<28} {:>9.3f} {:>9.3f} {:>9}  {}'.format(
+            name, r['wall'], r['cpu'], rss, array))
+    return lines
+
+
+def write_json(path, files, total=None):
+    """Write per-file records and totals as JSON.
+
+    Parameters
+    ----------
+    path: string
+        Output path.
+    files: list of dicts
+        One entry for each processed file, with its 'records'.
+    total: dict, optional
+        Totals of the whole run.
+
+    """
+    with open(path, 'w') as f:
+        json.dump({'files': files, 'total': total}, f, indent=2)
@@ -0,0 +1,249 @@
+"""Output encoding and background writing of processed images."""
+
+from __future__ import division
+import os
+import gzip
+import time
+import queue
+import threading
+import numpy as np
+from iphigen.prefetch import QueueStats
+
+OUTPUT_DTYPES = ('uint8', 'uint16', 'float32', 'float64')
+
+
+def quantize(data, dtype):
+    """Encode an image in a compact data type with a linear scaling.
+
+    Integer types map the finite range of the data linearly onto their
+    full range, so the stored values x are decoded as x * slope + inter, as
+    NIfTI readers do with `scl_slope` and `scl_inter`. NaNs are stored as 0.
+    Floating point types are cast, with slope 1 and intercept 0.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Image.
+    dtype: string
+        One of `OUTPUT_DTYPES`.
+
+    Returns
+    -------
+    data: np.ndarray
+        Encoded image, of `dtype`.
+    slope, inter: float
+        Decoding scaling. The quantization error is at most slope / 2.
+
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return data.astype(dtype, copy=False), 1., 0.
+    if dtype.name not in OUTPUT_DTYPES:
+        raise ValueError('Unknown output dtype "{}", choose one of {}.'.format(
+            dtype, ', '.join(OUTPUT_DTYPES)))
+    finite = np.isfinite(data)
+    if np.any(finite):
+        inter, top = float(np.min(data[finite])), float(np.max(data[finite]))
+    else:
+        inter, top = 0., 0.
+    slope = (top - inter) / np.iinfo(dtype).max
+    if slope == 0:
+        slope = 1.
+    out = np.where(finite, data, inter)
+    out -= inter
+    out /= slope
+    np.rint(out, out=out)
+    np.clip(out, 0, np.iinfo(dtype).max, out=out)
+    return out.astype(dtype), slope, inter
+
+
+def encode_image(data, dtype='uint8'):
+    """Encode a processed 2D image (values 0-255) for `cv2.imwrite`.
+
+    'uint8' rounds and saturates like `cv2.imwrite` does with floating point
+    images, 'uint16' stretches 0-255 to 0-65535 (PNG, TIFF), 'float32' keeps
+    the values (TIFF). NaNs become 0.
+    """
+    data = np.nan_to_num(np.asarray(data, dtype=float))
+    if dtype == 'uint8':
+        return np.clip(np.rint(data), 0, 255).astype(np.uint8)
+    elif dtype == 'uint16':
+        return np.clip(np.rint(data * 257), 0, 65535).astype(np.uint16)
+    elif dtype in ('float32', 'float64'):
+        return data.astype(dtype)
+    raise ValueError('Unknown output dtype "{}", choose one of {}.'.format(
+        dtype, ', '.join(OUTPUT_DTYPES)))
+
+
+def save_image(path, data, dtype='uint8'):
+    """Encode and save a 2D image, returning the number of bytes written."""
+    import cv2
+    if not cv2.imwrite(path, encode_image(data, dtype)):
+        raise ValueError('{} cannot be written.'.format(path))
+    return os.path.getsize(path)
+
+
+def save_nifti(path, data, affine, dtype='float64', compresslevel=6,
+               extensions=(), descrip=None):
+    """Encode and save a NIfTI image, returning the number of bytes written.
+
+    Parameters
+    ----------
+    path: string
+        Output path. '.nii.gz' files are compressed with `compresslevel`.
+    data: np.ndarray
+        Image.
+    affine: np.ndarray
+        Voxel to world transformation.
+    dtype: string
+        Stored data type, see `quantize`. Integer types set `scl_slope` and
+        `scl_inter`.
+    compresslevel: int
+        gzip compression level, 1 (fastest) to 9 (smallest).
+    extensions: list of nibabel.nifti1.Nifti1Extension
+        Header extensions.
+    descrip: string, optional
+        Header description, at most 80 characters.
+
+    """
+    import nibabel as nb
+    data, slope, inter = quantize(data, dtype)
+    img = nb.Nifti1Image(data, affine=affine)
+    if np.dtype(dtype).kind != 'f':
+        img.header.set_slope_inter(slope, inter)
+    for ext in extensions:
+        img.header.extensions.append(ext)
+    if descrip is not None:
+        img.header['descrip'] = descrip.encode()
+    if path.endswith('.gz'):
+        # Streamed into the compressor, without an uncompressed copy
+        from nibabel.fileholders import FileHolder
+        with gzip.open(path, 'wb', compresslevel=compresslevel) as f:
+            img.to_file_map({'image': FileHolder(fileobj=f)})
+    else:
+        nb.save(img, path)
+    return os.path.getsize(path)
+
+
+def summary(files, bytes_written, write_time):
+    """Number, size and throughput of saved outputs as a string."""
+    return 'Wrote {} files, {:.1f} MB in {:.2f} s ({:.1f} MB/s).'.format(
+        files, bytes_written / 2**20, write_time,
+        bytes_written / 2**20 / max(write_time, 1e-9))
+
+
+class Writer(object):
+    """Save outputs in a background thread while the next input is processed.
+
+    Jobs are functions that save one output and return the number of bytes
+    written, eg. `save_image` or `save_nifti`. At most `max_pending` jobs
+    wait in the queue, so memory held by outputs stays bounded; `submit`
+    blocks when the queue is full. Several threads save outputs in parallel,
+    as gzip compression and file writes release the GIL.
+
+    Parameters
+    ----------
+    background: bool
+        Save in background threads. Otherwise `submit` saves immediately.
+    max_pending: int
+        Maximum number of outputs waiting to be saved.
+    threads: int
+        Number of background threads.
+    executor: concurrent.futures.Executor, optional
+        Existing thread pool to run the `threads` saving loops in, instead
+        of new threads.
+
+    Attributes
+    ----------
+    files, bytes_written: int
+        Number and total size of saved outputs.
+    write_time: float
+        Seconds spent saving (encoding, compressing and writing), summed
+        over threads.
+    errors: list of tuples
+        Label and message of failed jobs, when saving in the background.
+    stats: QueueStats
+        Number of outputs waiting and time `submit` blocked, at every submit.
+
+    Examples
+    --------
+    >>> with Writer() as writer:
+    ...     for f in files:
+    ...         writer.submit(save_image, out_path, process(f), label=f)
+    >>> print(writer.summary())
+
+    """
+
+    def __init__(self, background=True, max_pending=2, threads=1,
+                 executor=None):
+        self.background = background
+        self.files, self.bytes_written, self.write_time = 0, 0, 0.
+        self.errors = []
+        self.stats = QueueStats('Write-behind', max_pending)
+        self._lock = threading.Lock()
+        self._jobs, self._threads, self._loops = None, [], []
+        if background:
+            self._jobs = queue.Queue(maxsize=max_pending)
+            for _ in range(threads):
+                if executor is not None:
+                    self._loops.append(executor.submit(self._work))
+                    continue
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """Save an output with `func(*args, **kwargs)`.
+
+        The keyword argument `label` names the job in `errors`. Errors are
+        raised directly when not saving in the background.
+        """
+        label = kwargs.pop('label', None)
+        if self._jobs is None:
+            self._run(func, args, kwargs)
+        else:
+            pending, start = self._jobs.qsize(), time.time()
+            self._jobs.put((label, func, args, kwargs))
+            self.stats.record(pending, time.time() - start)
+
+    def close(self):
+        """Wait until all outputs are saved."""
+        for _ in self._threads + self._loops:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        for loop in self._loops:
+            loop.result()
+        self._threads, self._loops = [], []
+
+    def summary(self):
+        """Number, size and throughput of saved outputs as a string."""
+        return summary(self.files, self.bytes_written, self.write_time)
+
+    def _run(self, func, args, kwargs):
+        start = time.time()
+        nbytes = func(*args, **kwargs)
+        with self._lock:
+            self.files += 1
+            self.bytes_written += nbytes
+            self.write_time += time.time() - start
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            label, func, args, kwargs = job
+            try:
+                self._run(func, args, kwargs)
+            except Exception as e:
+                with self._lock:
+                    self.errors.append((label, '{}: {}'.format(
+                        type(e).__name__, e)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,412 @@
+"""Processing pipeline shared by the command line interfaces."""
+
+from __future__ import division
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from iphigen import core, metrics, quantiles, utils
+from iphigen.diskcache import DiskCache
+import iphigen.config as cfg
+
+STAGES = ('intensity_balance', 'retinex', 'simplex_color_balance',
+          'simplest_color_balance')
+STAGE_SUFFIXES = {'intensity_balance': '_IB', 'retinex': '_MSRBP',
+                  'simplex_color_balance': '_SimplexCB',
+                  'simplest_color_balance': '_SimplestCB'}
+
+
+class Pipeline(object):
+    """Retinex and color balance stages applied in a fixed order.
+
+    Stages run in the order of `STAGES`: intensity balance, multi-scale
+    retinex with barycenter preservation (MSRBP), simplex color balance and
+    simplest color balance. The image is kept as intensity (sum of channels)
+    and barycentric coordinates (channels divided by intensity) between the
+    stages. Barycentric coordinates are computed in place of the input copy
+    and the processed intensity is multiplied back in place, so a run needs
+    one channels-sized buffer plus intensity-sized buffers.
+
+    Parameters
+    ----------
+    intensity_balance: bool
+        Truncate and rescale intensity with `int_bal_perc` percentiles.
+    int_bal_perc: list
+        Intensity balance percentiles.
+    retinex: bool
+        Apply multi-scale retinex on the intensity.
+    scales: list
+        Retinex scales, see `core.multi_scale_retinex`.
+    blur: string
+        Gaussian blur engine, see `core.multi_scale_retinex`.
+    cascade: bool
+        Cascaded surrounds, see `core.multi_scale_retinex`.
+    workers: int
+        Number of threads, see `core.multi_scale_retinex`.
+    simplex_color_balance: bool
+        Apply simplex color balance on the barycentric coordinates.
+    simplex_center: bool
+        See `core.simplex_color_balance`.
+    simplex_standardize: bool
+        See `core.simplex_color_balance`.
+    simplest_color_balance: bool
+        Apply simplest color balance on the channels.
+    simplest_perc: list
+        Simplest color balance percentiles.
+    percentile_method: string
+        See `quantiles.percentile`.
+    percentile_cache: quantiles.PercentileCache, optional
+        Percentile cache kept across runs, eg. a
+        `quantiles.TemporalPercentileCache` for video frames. It is cleared
+        after every run. By default each run uses a new cache.
+    dtype: numpy dtype
+        Floating point type of all working arrays and of the output. With
+        `np.float32` memory use and bandwidth are halved; see
+        `iphigen.accuracy` for the deviation from `np.float64`.
+    disk_cache: iphigen.diskcache.DiskCache, optional
+        Reuse retinex surrounds and outputs of earlier runs, see
+        `core.multi_scale_retinex`. Not used with a mask.
+    mask: np.ndarray or 'auto', optional
+        Boolean foreground mask of the image shape without channels, or
+        'auto' to compute one from the intensity with
+        `utils.foreground_mask`. Retinex is restricted to the mask (see
+        `core.multi_scale_retinex`), all percentiles and balance statistics
+        are computed inside it, and the output is 0 outside it.
+    batch: bool
+        Inputs are stacks of same-shaped images, (N, H, W, C). Retinex
+        filters the spatial axes only and percentiles are computed per
+        image (and channel), so a stack gives the same result as running
+        each image, with far less overhead for many small images. Intensity
+        balance and simplex color balance are not available.
+    voxel_size: list, optional
+        Voxel size of the spatial axes, eg. NIfTI header zooms. Scales are
+        then in the same unit (eg. mm), see `core.multi_scale_retinex`.
+    verbose: bool
+        Print stage information.
+    track_memory: bool
+        Record peak memory of `run` with tracemalloc. Slightly slower.
+
+    Attributes
+    ----------
+    timings: OrderedDict
+        Wall time in seconds of each step of the last run. Full records of
+        the steps are sent to the `iphigen.metrics` hooks.
+    peak_memory: int or None
+        Peak memory in bytes allocated during the last run, when
+        `track_memory` is set.
+
+    Examples
+    --------
+    >>> pipeline = Pipeline(retinex=True, scales=[15, 80, 250],
+    ...                     simplest_color_balance=True)
+    >>> out = pipeline.run(image)
+    >>> out_name = 'image' + pipeline.suffix + '.png'
+
+    """
+
+    def __init__(self, intensity_balance=False, int_bal_perc=(1., 99.),
+                 retinex=False, scales=None, blur='exact', cascade=False,
+                 workers=1, simplex_color_balance=False, simplex_center=True,
+                 simplex_standardize=False, simplest_color_balance=False,
+                 simplest_perc=(1., 99.), percentile_method='exact',
+                 percentile_cache=None, dtype=np.float64, disk_cache=None,
+                 mask=None, batch=False, voxel_size=None, verbose=True,
+                 track_memory=False):
+        if scales is None:
+            scales = [15, 80, 250]
+        self.intensity_balance = intensity_balance
+        self.int_bal_perc = int_bal_perc
+        self.retinex = retinex
+        self.scales = scales
+        self.blur = blur
+        self.cascade = cascade
+        self.workers = workers
+        self.simplex_color_balance = simplex_color_balance
+        self.simplex_center = simplex_center
+        self.simplex_standardize = simplex_standardize
+        self.simplest_color_balance = simplest_color_balance
+        self.simplest_perc = simplest_perc
+        self.percentile_method = percentile_method
+        self.percentile_cache = percentile_cache
+        self.dtype = dtype
+        self.disk_cache = disk_cache
+        self.mask = mask
+        self.batch = batch
+        self.voxel_size = voxel_size
+        self.verbose = verbose
+        self.track_memory = track_memory
+        self.timings = OrderedDict()
+        self.peak_memory = None
+
+    @classmethod
+    def from_config(cls, **kwargs):
+        """Pipeline with settings from `iphigen.config`.
+
+        Keyword arguments override configuration values. A disk cache is
+        used when `cache_dir` is set, unless `disk_cache` is given. It is
+        taken from `resources` (an `iphigen.resources.Resources`) if given.
+        """
+        resources = kwargs.pop('resources', None)
+        settings = dict(
+            intensity_balance=cfg.intensity_balance,
+            int_bal_perc=cfg.int_bal_perc, retinex=cfg.retinex,
+            scales=cfg.scales, blur=cfg.blur, cascade=cfg.cascade,
+            workers=cfg.workers,
+            simplex_color_balance=cfg.simplex_color_balance,
+            simplex_center=cfg.simplex_center,
+            simplex_standardize=cfg.simplex_standardize,
+            simplest_color_balance=cfg.simplest_color_balance,
+            simplest_perc=cfg.simplest_perc,
+            percentile_method=cfg.percentile_method,
+            dtype=np.dtype(cfg.precision), disk_cache=None)
+        if cfg.cache_dir and 'disk_cache' not in kwargs:
+            if resources is not None:
+                settings['disk_cache'] = resources.disk_cache(
+                    cfg.cache_dir, cfg.cache_size * 2**20)
+            else:
+                settings['disk_cache'] = DiskCache(
+                    cfg.cache_dir, max_bytes=cfg.cache_size * 2**20)
+        settings.update(kwargs)
+        return cls(**settings)
+
+    @property
+    def stages(self):
+        """Names of the selected stages, in processing order."""
+        return [s for s in STAGES if getattr(self, s)]
+
+    @property
+    def suffix(self):
+        """Output file name suffix describing the selected stages."""
+        suf = ''
+        for stage in self.stages:
+            suf = suf + STAGE_SUFFIXES[stage]
+            if stage == 'retinex':
+                suf = suf + utils.prepare_scale_suffix(self.scales)
+                if self.voxel_size is not None:
+                    suf = suf + 'mm'
+        if suf and self.mask is not None:
+            suf = suf + '_mask'
+        return suf
+
+    @property
+    def sweep_suffix(self):
+        """Output file name suffix of `sweep` results."""
+        return ''.join(STAGE_SUFFIXES[s] for s in self.stages) + '_sweep'
+
+    def run(self, data):
+        """Apply the selected stages.
+
+        Parameters
+        ----------
+        data: np.ndarray
+            Image with channels in the last dimension. Not modified.
+
+        Returns
+        -------
+        data: np.ndarray
+            Processed image, of `dtype`.
+
+        """
+        self.timings = OrderedDict()
+        self.peak_memory = None
+        if self.track_memory:
+            tracemalloc.start()
+        try:
+            data = self._run(data)
+            if self.track_memory:
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            if self.track_memory:
+                tracemalloc.stop()
+            if self.percentile_cache is not None:
+                self.percentile_cache.clear()
+        return data
+
+    def sweep(self, data, scale_sets=None, simplest_percs=None):
+        """Apply the selected stages with several parameter settings.
+
+        Decomposition, intensity balance and simplex color balance are done
+        once. Retinex surrounds are shared between all sets of scales, see
+        `core.multi_scale_retinex_sweep`. Disk cache is not used.
+
+        Parameters
+        ----------
+        data: np.ndarray
+            Image with channels in the last dimension. Not modified.
+        scale_sets: list of lists, optional
+            Retinex scales to compare. Defaults to `[scales]`.
+        simplest_percs: list of pairs, optional
+            Simplest color balance percentiles to compare, for each set of
+            scales. Defaults to `[simplest_perc]`.
+
+        Returns
+        -------
+        results: list of tuples
+            Parameters (dict with 'scales' and 'simplest_perc') and
+            processed image of every combination, scales varying slowest.
+
+        """
+        if scale_sets is None:
+            scale_sets = [self.scales]
+        if simplest_percs is None:
+            simplest_percs = [self.simplest_perc]
+        if self.mask is not None or self.batch:
+            raise ValueError('Masks and batches are not available in '
+                             'sweeps.')
+        cache = self.percentile_cache
+        if cache is None:
+            cache = quantiles.PercentileCache()
+        self.timings = OrderedDict()
+        try:
+            inten, bary, mask = self._decompose(data, cache)
+            if self.retinex:
+                self._print('Applying multi-scale retinex with barycenter '
+                            'preservation (MSRBP)...')
+                with self._measure('retinex', inten):
+                    new_intens = core.multi_scale_retinex_sweep(
+                        inten, scale_sets, verbose=self.verbose,
+                        dtype=self.dtype, blur=self.blur,
+                        workers=self.workers, voxel_size=self.voxel_size)
+            else:
+                new_intens = [inten for _ in scale_sets]
+            bary = self._simplex(bary)
+
+            results = []
+            for scales, new_inten in zip(scale_sets, new_intens):
+                if self.retinex:
+                    new_inten = core.scale_approx(
+                        new_inten, inten, method=self.percentile_method,
+                        cache=cache)
+                composed = self._compose(new_inten, bary.copy(), mask)
+                for k, perc in enumerate(simplest_percs):
+                    params = {'scales': list(scales),
+                              'simplest_perc': list(perc)}
+                    if k < len(simplest_percs) - 1:
+                        out = composed.copy()
+                    else:
+                        out, composed = composed, None
+                    results.append((params, self._simplest(out, perc, mask,
+                                                           cache)))
+            return results
+        finally:
+            if self.percentile_cache is not None:
+                self.percentile_cache.clear()
+
+    def _run(self, data):
+        if self.batch and (self.intensity_balance
+                           or self.simplex_color_balance):
+            raise ValueError('Intensity balance and simplex color balance '
+                             'are not available in batches.')
+        cache = self.percentile_cache
+        if cache is None:
+            cache = quantiles.PercentileCache()
+        inten, bary, mask = self._decompose(data, cache)
+
+        if self.retinex:
+            self._print('Applying multi-scale retinex with barycenter '
+                        'preservation (MSRBP)...')
+            self._print('  Selected retinex scales: {}'.format(self.scales))
+            with self._measure('retinex', inten):
+                new_inten = core.multi_scale_retinex(
+                    inten, scales=self.scales, verbose=self.verbose,
+                    dtype=self.dtype, blur=self.blur, cascade=self.cascade,
+                    workers=self.workers, disk_cache=self.disk_cache,
+                    mask=mask, batch=self.batch, voxel_size=self.voxel_size)
+                # Scale back to the approximage original intensity range
+                inten = core.scale_approx(new_inten, inten,
+                                          method=self.percentile_method,
+                                          cache=cache, mask=mask,
+                                          batch=self.batch)
+                new_inten = None
+            if self.disk_cache is not None:
+                self._print('  Cache: {}'.format(self.disk_cache.stats()))
+
+        bary = self._simplex(bary)
+        data = self._compose(inten, bary, mask)
+        bary, inten = None, None
+        return self._simplest(data, self.simplest_perc, mask, cache)
+
+    def _decompose(self, data, cache):
+        """Intensity, barycentric coordinates and mask, after IB."""
+        with self._measure('decompose', data):
+            bary = np.array(data, dtype=self.dtype)
+            # Compute intensity
+            inten = np.sum(bary, axis=-1)
+            # Compute barycentic coordinates, in place of the channels
+            bary /= inten[..., None]
+
+        mask = self.mask
+        if mask is not None:
+            with self._measure('mask', inten):
+                if isinstance(mask, str):
+                    if mask != 'auto':
+                        raise ValueError('Unknown mask "{}".'.format(mask))
+                    mask = utils.foreground_mask(inten)
+                elif mask.shape != inten.shape:
+                    raise ValueError('Mask shape {} does not match image '
+                                     'shape {}.'.format(mask.shape,
+                                                        inten.shape))
+                mask = np.asarray(mask, dtype=bool)
+                self._print('  Foreground mask: {:.1%} of voxels'.format(
+                    np.mean(mask)))
+                # Background is excluded from all statistics
+                inten[~mask] = 0
+                bary[~mask] = np.nan
+
+        if self.intensity_balance:
+            self._print('Applying intensity balance (IB)...')
+            self._print('  Percentiles: {}'.format(self.int_bal_perc))
+            with self._measure('intensity_balance', inten):
+                inten = utils.truncate_range(
+                    inten, pmin=self.int_bal_perc[0],
+                    pmax=self.int_bal_perc[1], method=self.percentile_method,
+                    cache=cache, mask=mask)
+                inten = utils.set_range(inten, zero_to=255*bary.shape[-1],
+                                        mask=mask)
+                # Barycentric coordinates are undefined where intensity is 0
+                bary[inten == 0] = np.nan
+        return inten, bary, mask
+
+    def _simplex(self, bary):
+        """Simplex color balance, if selected."""
+        if self.simplex_color_balance:
+            self._print('Applying simplex color balance (SimplexCB)...')
+            self._print('  Centering: {}'.format(self.simplex_center))
+            self._print('  Standardize: {}'.format(self.simplex_standardize))
+            with self._measure('simplex_color_balance', bary):
+                bary = core.simplex_color_balance(
+                    bary, center=self.simplex_center,
+                    standardize=self.simplex_standardize)
+        return bary
+
+    def _compose(self, inten, bary, mask):
+        """Insert back the processed intensity image, in place of bary."""
+        with self._measure('compose', bary):
+            data = bary
+            data *= inten[..., None]
+            if mask is not None:
+                data[~mask] = 0
+        return data
+
+    def _simplest(self, data, perc, mask, cache):
+        """Simplest color balance, if selected."""
+        if self.simplest_color_balance:
+            self._print('Applying simplest color balance (SimplestCB)...')
+            self._print('  Percentiles: {}'.format(perc))
+            with self._measure('simplest_color_balance', data):
+                data = core.simplest_color_balance(
+                    data, pmin=perc[0], pmax=perc[1],
+                    method=self.percentile_method, cache=cache, mask=mask,
+                    batch=self.batch)
+        return data
+
+    @contextmanager
+    def _measure(self, step, data):
+        """Measure a step, keeping its wall time in `timings`."""
+        with metrics.measure(step, data) as record:
+            yield record
+        self.timings[step] = record['wall']
+
+    def _print(self, message):
+        if self.verbose:
+            print(message)
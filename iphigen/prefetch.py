@@ -0,0 +1,122 @@
+"""Read-ahead of inputs on threads, overlapping I/O with processing."""
+
+from __future__ import division
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueStats(object):
+    """Occupancy and stall time of a bounded queue.
+
+    Occupancy is the number of items ready in the queue when the consumer
+    (read-ahead) or the producer (write-behind) comes to it. A mean close to
+    0 with long stalls means the queue is too shallow, or that I/O is slower
+    than processing; a mean close to the depth means I/O keeps up.
+
+    Parameters
+    ----------
+    name: string
+        Name used in the summary, eg. 'Read-ahead'.
+    depth: int
+        Queue size bound.
+
+    """
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.waits, self.occupancy_sum, self.stall_time = 0, 0, 0.
+
+    def record(self, occupancy, stall):
+        """Add one queue access."""
+        self.waits += 1
+        self.occupancy_sum += occupancy
+        self.stall_time += stall
+
+    def as_dict(self):
+        """Statistics as a JSON serializable dict."""
+        return {'depth': self.depth, 'waits': self.waits,
+                'mean_occupancy': self.occupancy_sum / max(self.waits, 1),
+                'stall_time': self.stall_time}
+
+    def summary(self):
+        """Statistics as a string."""
+        return '{}: depth {}, mean occupancy {:.1f}, stalled {:.2f} s.'.format(
+            self.name, self.depth, self.occupancy_sum / max(self.waits, 1),
+            self.stall_time)
+
+
+class ReadAhead(object):
+    """Load inputs on threads ahead of their processing.
+
+    Iterating yields the items in order, each with a future of its loaded
+    value. Up to `depth` items are loaded ahead, by `threads` threads, so
+    reading and decoding (which release the GIL, eg. `cv2.imread` and gzip)
+    overlap with the processing of earlier items while memory stays
+    bounded. Loading errors are raised by `future.result()`, so they can be
+    handled per item.
+
+    Parameters
+    ----------
+    load: callable
+        Function loading one item.
+    items: iterable
+        Items to load, eg. file paths.
+    depth: int
+        Maximum number of items loaded ahead.
+    threads: int
+        Number of loading threads.
+    executor: concurrent.futures.Executor, optional
+        Existing thread pool to load with, instead of `threads` new
+        threads.
+
+    Attributes
+    ----------
+    stats: QueueStats
+        Number of ready items and waiting time at every step.
+
+    Examples
+    --------
+    >>> for f, future in ReadAhead(cv2.imread, files, depth=4):
+    ...     data = future.result()
+
+    """
+
+    def __init__(self, load, items, depth=2, threads=1, executor=None):
+        self.load = load
+        self.items = items
+        self.depth = depth
+        self.threads = threads
+        self.executor = executor
+        self.stats = QueueStats('Read-ahead', depth)
+
+    def __iter__(self):
+        if self.executor is not None:
+            yield from self._iterate(self.executor)
+        else:
+            with ThreadPoolExecutor(self.threads) as pool:
+                yield from self._iterate(pool)
+
+    def _iterate(self, pool):
+        items = iter(self.items)
+        pending = collections.deque()
+
+        def refill():
+            while len(pending) < self.depth:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                pending.append((item, pool.submit(self.load, item)))
+
+        refill()
+        while pending:
+            item, future = pending.popleft()
+            ready = int(future.done()) + sum(f.done() for _, f in pending)
+            start = time.time()
+            # Wait here so that the stall is measured, errors are kept
+            future.exception()
+            self.stats.record(ready, time.time() - start)
+            refill()
+            yield item, future
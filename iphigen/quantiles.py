@@ -0,0 +1,424 @@
+"""Percentile computations shared by balance and scaling functions."""
+
+from __future__ import division
+import numpy as np
+
+PERCENTILE_METHODS = ('exact', 'histogram')
+
+
+def nonzero_mask(data):
+    """Mask of elements that are not (close to) zero."""
+    return ~np.isclose(data, 0)
+
+
+def percentile(data, q, mask=None, method='exact', bins=2**16, cache=None):
+    """Percentiles of the valid (not NaN, optionally masked) elements.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image.
+    q : float or list of floats
+        Percentiles, between 0 and 100.
+    mask : np.ndarray, optional
+        Boolean mask of elements to consider. NaNs are always discarded.
+    method : string
+        One of `PERCENTILE_METHODS`:
+            'exact': Selection on the valid elements, same result as
+                `np.nanpercentile`. NaN and mask are combined once.
+            'histogram': Linear histogram of `bins` bins between the minimum
+                and maximum, counted block by block without copying the
+                valid elements. The error is at most one bin width, i.e.
+                (max - min) / bins.
+    bins : int
+        Number of bins for the 'histogram' method.
+    cache : PercentileCache, optional
+        Reuse results computed before for the same array.
+
+    Returns
+    -------
+    p : float or np.ndarray
+        Percentile values.
+
+    """
+    if cache is not None:
+        key = (tuple(np.atleast_1d(q)), method, bins)
+        result = cache.get(data, key, mask)
+        if result is None:
+            result = percentile(data, q, mask=mask, method=method, bins=bins)
+            result = cache.put(data, key, result, mask)
+        return result
+
+    if method == 'exact':
+        valid = ~np.isnan(data)
+        if mask is not None:
+            valid &= mask
+        return np.percentile(data[valid], q)
+    elif method == 'histogram':
+        return QuantileSketch.from_array(data, mask=mask,
+                                         bins=bins).percentile(q)
+    else:
+        raise ValueError('Unknown percentile method "{}", choose one of '
+                         '{}.'.format(method, ', '.join(PERCENTILE_METHODS)))
+
+
+def channel_percentiles(data, q, mask=None, method='exact', bins=2**16,
+                        cache=None, axis=-1):
+    """Percentiles of every channel (last dimension) at once.
+
+    Same results as `percentile` on each channel. With the 'exact' method
+    all channels are selected in a single `np.partition` call over a
+    channels-first copy, in which invalid elements are set to +inf so they
+    sort after the valid ones of their channel.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image with channels in the last dimension, or along `axis`.
+    q : float or list of floats
+        Percentiles, between 0 and 100.
+    mask : np.ndarray, optional
+        Boolean mask of elements to consider, of the shape of `data`. NaNs
+        are always discarded.
+    method : string
+        See `percentile`.
+    bins : int
+        Number of histogram bins for the 'histogram' method.
+    cache : PercentileCache, optional
+        Reuse results computed before for the same array.
+    axis : int or tuple of ints
+        Axes indexing the channels, eg. (0, -1) for every channel of every
+        image of a stack.
+
+    Returns
+    -------
+    p : np.ndarray
+        Percentile values, of shape (channels, len(q)), or the shape of the
+        `axis` dimensions followed by len(q). NaN for channels without valid
+        elements.
+
+    """
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    axes = [ax % data.ndim for ax in np.atleast_1d(axis)]
+    if cache is not None:
+        key = ('channels', tuple(q), method, bins, tuple(axes))
+        result = cache.get(data, key, mask)
+        if result is None:
+            result = channel_percentiles(data, q, mask=mask, method=method,
+                                         bins=bins, axis=axis)
+            result = cache.put(data, key, result, mask)
+        return result
+
+    # Channels first, flattened into rows
+    channel_shape = tuple(data.shape[ax] for ax in axes)
+    nr_channels = int(np.prod(channel_shape))
+    work = np.moveaxis(data, axes, range(len(axes))).reshape(nr_channels, -1)
+    if mask is not None:
+        mask = np.moveaxis(np.broadcast_to(mask, data.shape), axes,
+                           range(len(axes))).reshape(nr_channels, -1)
+    if method == 'histogram':
+        result = np.full((nr_channels, q.size), np.nan)
+        for d in range(nr_channels):
+            sub_mask = None if mask is None else mask[d]
+            if mask is None or np.any(sub_mask):
+                result[d] = percentile(work[d], q, mask=sub_mask,
+                                       method=method, bins=bins)
+        return result.reshape(channel_shape + (q.size,))
+    elif method != 'exact':
+        raise ValueError('Unknown percentile method "{}", choose one of '
+                         '{}.'.format(method, ', '.join(PERCENTILE_METHODS)))
+
+    if np.may_share_memory(work, data):
+        work = work.copy()
+    invalid = np.isnan(work)
+    if mask is not None:
+        invalid |= ~mask
+    work[invalid] = np.inf
+    count = work.shape[1] - np.count_nonzero(invalid, axis=1)
+    invalid = None
+
+    # Linear interpolation between ranks, as np.percentile does
+    rank = q[None, :] / 100 * (np.maximum(count, 1)[:, None] - 1)
+    lower = np.floor(rank).astype(np.intp)
+    upper = np.minimum(lower + 1, np.maximum(count, 1)[:, None] - 1)
+    work.partition(np.unique(np.concatenate([lower.ravel(),
+                                             upper.ravel()])), axis=1)
+    rows = np.arange(nr_channels)[:, None]
+    a, b = work[rows, lower], work[rows, upper]
+    t = rank - lower
+    result = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+    result[count == 0] = np.nan
+    return result.reshape(channel_shape + (q.size,))
+
+
+class QuantileSketch(object):
+    """Mergeable percentile estimator for data seen in pieces.
+
+    Values are kept as they are until more than `exact_size` of them are
+    seen, so percentiles of small data are exact. Beyond that, values are
+    counted in a linear histogram of `bins` bins. The histogram range doubles
+    whenever new values fall outside of it, so the percentile error is at
+    most one bin width, about (max - min) / (bins / 2). Merging two sketches
+    adds at most the bin width of the merged sketch.
+
+    Parameters
+    ----------
+    bins : int
+        Number of histogram bins, should be even.
+    exact_size : int
+        Number of values kept before switching to the histogram.
+
+    Examples
+    --------
+    >>> sketch = QuantileSketch()
+    >>> for chunk in chunks:
+    ...     sketch.update(chunk)
+    >>> pmin, pmax = sketch.percentile([1., 99.])
+
+    """
+
+    def __init__(self, bins=2**16, exact_size=10**7):
+        self.bins = bins
+        self.exact_size = exact_size
+        self.count = 0
+        self.min, self.max = np.inf, -np.inf
+        self._values = []
+        self._counts = None
+        self._origin, self._width = None, None
+
+    @classmethod
+    def from_array(cls, data, mask=None, bins=2**16, block=2**18):
+        """Histogram sketch of the valid (not NaN, masked) elements.
+
+        The array is read in blocks of `block` elements, once for the range
+        and once for the counts, so temporaries stay small and the valid
+        elements are never copied as a whole.
+        """
+        data = np.ravel(data)
+        if mask is not None:
+            mask = np.ravel(mask)
+
+        def blocks():
+            for i in range(0, data.size, block):
+                values = data[i:i + block]
+                valid = ~np.isnan(values)
+                if mask is not None:
+                    valid &= mask[i:i + block]
+                values = values[valid]
+                if values.size:
+                    yield values
+
+        sketch = cls(bins=bins, exact_size=0)
+        for values in blocks():
+            sketch.count += values.size
+            sketch.min = min(sketch.min, values.min())
+            sketch.max = max(sketch.max, values.max())
+        if sketch.count:
+            sketch._to_histogram()
+            for values in blocks():
+                sketch._add(values)
+        return sketch
+
+    def update(self, values):
+        """Add values. NaNs are ignored."""
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+        self.count += values.size
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        if self._counts is None:
+            self._values.append(values)
+            if self.count > self.exact_size:
+                self._to_histogram()
+        else:
+            self._add(values)
+
+    def merge(self, other):
+        """Add all values seen by another sketch."""
+        if other._counts is None:
+            for values in other._values:
+                self.update(values)
+            return
+        if self.count == 0 and self.bins == other.bins:
+            # Nothing to combine, take over the histogram as it is
+            self.count, self.min, self.max = other.count, other.min, other.max
+            self._counts = other._counts.copy()
+            self._origin, self._width = other._origin, other._width
+            return
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if self._counts is None:
+            self._to_histogram()
+        self.count += other.count
+        centers = other._origin + other._width * (np.arange(other.bins) + .5)
+        self._add(centers, weights=other._counts)
+
+    def percentile(self, q):
+        """Percentiles of all values seen, same definition as np.percentile.
+
+        Parameters
+        ----------
+        q : float or list of floats
+            Percentiles, between 0 and 100.
+
+        Returns
+        -------
+        p : float or np.ndarray
+
+        """
+        if self.count == 0:
+            raise ValueError('No values to compute percentiles from.')
+        if self._counts is None:
+            return np.percentile(np.concatenate(self._values), q)
+        # Rank of each percentile, linearly interpolated within its bin
+        rank = np.asarray(q, dtype=float) / 100. * (self.count - 1)
+        cumsum = np.cumsum(self._counts)
+        idx = np.searchsorted(cumsum, rank, side='right')
+        idx = np.minimum(idx, self.bins - 1)
+        before = cumsum[idx] - self._counts[idx]
+        frac = (rank - before + .5) / np.maximum(self._counts[idx], 1)
+        result = self._origin + self._width * (idx + np.clip(frac, 0, 1))
+        return np.clip(result, self.min, self.max)
+
+    def _to_histogram(self):
+        """Switch from kept values to histogram counts."""
+        values = np.concatenate(self._values) if self._values else []
+        self._values = []
+        self._origin = self.min
+        self._width = (self.max - self.min) / self.bins
+        if self._width <= 0:
+            self._width = max(abs(self.min), 1.) * 1e-6
+        self._counts = np.zeros(self.bins, dtype=np.int64)
+        self._add(values)
+
+    def _add(self, values, weights=None):
+        """Count values into the histogram, growing its range if needed."""
+        values = np.asarray(values, dtype=float)
+        if values.size == 0:
+            return
+        self._expand(values.min(), values.max())
+        idx = np.floor((values - self._origin) / self._width).astype(np.int64)
+        idx = np.clip(idx, 0, self.bins - 1)
+        if weights is None:
+            self._counts += np.bincount(idx, minlength=self.bins)
+        else:
+            self._counts += np.bincount(
+                idx, weights=weights, minlength=self.bins).astype(np.int64)
+
+    def _expand(self, low, high):
+        """Double the bin width until [low, high] is covered."""
+        half = self.bins // 2
+        while (low < self._origin
+               or high > self._origin + self._width * self.bins):
+            merged = self._counts.reshape(half, 2).sum(axis=1)
+            self._counts = np.zeros(self.bins, dtype=np.int64)
+            self._width *= 2
+            if low < self._origin:
+                # Old range goes to the upper half
+                self._counts[half:] = merged
+                self._origin -= self._width * half
+            else:
+                self._counts[:half] = merged
+
+
+class PercentileCache(object):
+    """Percentile results of arrays within one processing run.
+
+    Results are keyed by array (and mask) identity. Functions that modify an
+    array in place call `invalidate` on it, so later calls recompute.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.hits, self.misses = 0, 0
+
+    def get(self, data, key, mask=None):
+        """Cached result, or None."""
+        entry = self._entries.get(id(data))
+        full_key = (key, None if mask is None else id(mask))
+        if entry is not None and full_key in entry[1]:
+            self.hits += 1
+            return entry[1][full_key]
+        self.misses += 1
+        return None
+
+    def put(self, data, key, result, mask=None):
+        """Store a result and return it.
+
+        References are kept so ids are not reused.
+        """
+        entry = self._entries.setdefault(id(data), ([data], {}))
+        if mask is not None:
+            entry[0].append(mask)
+        entry[1][(key, None if mask is None else id(mask))] = result
+        return result
+
+    def invalidate(self, data):
+        """Forget results of an array, after it is modified in place."""
+        self._entries.pop(id(data), None)
+
+    def clear(self):
+        """Forget everything."""
+        self._entries = {}
+
+
+class TemporalPercentileCache(PercentileCache):
+    """Percentiles smoothed over consecutive frames of a sequence.
+
+    Within a frame this behaves like `PercentileCache`. Across frames, the
+    n-th distinct percentile request of a frame is matched to the n-th
+    request of the previous frames, which holds when every frame goes
+    through the same processing steps, so masks recreated every frame still
+    match. Results are exponential moving
+    averages, which removes flicker caused by percentiles jumping between
+    frames, and percentiles are only computed every `interval` frames;
+    in-between frames reuse the smoothed values.
+
+    Call `clear` after each frame.
+
+    Parameters
+    ----------
+    alpha : float
+        Weight of the current frame, between 0 and 1. 1 disables smoothing.
+    interval : int
+        Compute percentiles every `interval` frames.
+
+    """
+
+    def __init__(self, alpha=0.2, interval=1):
+        super(TemporalPercentileCache, self).__init__()
+        self.alpha = alpha
+        self.interval = interval
+        self.frame = 0
+        self._smoothed = {}
+        self._request = 0
+
+    def get(self, data, key, mask=None):
+        """Cached or smoothed result, or None if it should be computed."""
+        result = super(TemporalPercentileCache, self).get(data, key, mask)
+        if result is not None:
+            return result
+        slot = (self._request, key)
+        self._request += 1
+        if self.frame % self.interval != 0 and slot in self._smoothed:
+            return super(TemporalPercentileCache, self).put(
+                data, key, self._smoothed[slot], mask)
+        return None
+
+    def put(self, data, key, result, mask=None):
+        """Blend a computed result into the moving average and return it."""
+        slot = (self._request - 1, key)
+        if slot in self._smoothed:
+            result = (self.alpha * np.asarray(result)
+                      + (1 - self.alpha) * self._smoothed[slot])
+        self._smoothed[slot] = result
+        return super(TemporalPercentileCache, self).put(data, key, result,
+                                                        mask)
+
+    def clear(self):
+        """Forget arrays of the current frame and move to the next frame."""
+        super(TemporalPercentileCache, self).clear()
+        self.frame += 1
+        self._request = 0
@@ -0,0 +1,81 @@
+"""Caches, threads and worker processes kept between runs."""
+
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Resources(object):
+    """Disk caches, I/O threads and worker processes reused by many runs.
+
+    Runs of `iphigen_2d.run` and `iphigen_nifti.run` create what they need
+    and release it at the end. Given a `Resources`, as in server mode, they
+    use it instead, so consecutive jobs share disk cache statistics and do
+    not pay for starting threads and processes every time. Everything is
+    created on first use.
+
+    Worker processes are started with the 'forkserver' method, so they do
+    not inherit the threads (and locks) of a threaded server. As with any
+    start method other than 'fork', the main module must be importable,
+    eg. an entry point script rather than `python -c`.
+
+    Examples
+    --------
+    >>> resources = Resources()
+    >>> for job in jobs:
+    ...     user_interface(job)
+    ...     iphigen_2d.run(resources)
+    >>> resources.close()
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._disk_caches = {}
+        self._executors = {}
+        self._pools = {}
+
+    def disk_cache(self, directory, max_bytes):
+        """Disk cache of a directory, opened once."""
+        from iphigen.diskcache import DiskCache
+        key = (os.path.abspath(directory), max_bytes)
+        with self._lock:
+            if key not in self._disk_caches:
+                self._disk_caches[key] = DiskCache(directory, max_bytes)
+            return self._disk_caches[key]
+
+    def executor(self, name):
+        """Thread pool for one kind of I/O, eg. 'read' or 'write'.
+
+        Kinds get separate pools, so long-running write loops never take
+        the threads that loads wait for.
+        """
+        with self._lock:
+            if name not in self._executors:
+                self._executors[name] = ThreadPoolExecutor(
+                    max(os.cpu_count() or 1, 2))
+            return self._executors[name]
+
+    def process_pool(self, processes, initializer=None):
+        """Pool of `processes` worker processes, started once.
+
+        Tasks must carry their configuration, as workers outlive runs.
+        """
+        key = (processes, initializer)
+        with self._lock:
+            if key not in self._pools:
+                context = multiprocessing.get_context('forkserver')
+                self._pools[key] = context.Pool(processes,
+                                                initializer=initializer)
+            return self._pools[key]
+
+    def close(self):
+        """Stop worker processes and threads."""
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+                pool.join()
+            for executor in self._executors.values():
+                executor.shutdown()
+            self._pools, self._executors = {}, {}
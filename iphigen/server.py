@@ -0,0 +1,194 @@
+"""Long-running server that processes jobs with warm imports and caches.
+
+Jobs are JSON objects, one per line, read from a Unix socket (default) or
+from standard input. Responses are written back as one JSON line each.
+Heavy modules are imported once, and disk caches (with --cache_dir), I/O
+threads and --jobs worker processes are kept for the lifetime of the
+server, see `iphigen.resources`.
+
+Usage:
+    iphigen_server                      # Unix socket, see iphigen_client
+    iphigen_server --stdio < jobs.jsonl
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+import socketserver
+from iphigen.client import default_socket_path
+from iphigen.resources import Resources
+
+# Jobs change the global configuration, so they run one at a time
+_lock = threading.Lock()
+
+
+def warm_up():
+    """Import heavy modules and run a tiny job once."""
+    import numpy as np
+    import cv2  # noqa: F401
+    import nibabel  # noqa: F401
+    from iphigen.core import multi_scale_retinex
+    from iphigen import filters
+    image = np.random.random((32, 32)) * 255
+    for blur in filters.BLUR_METHODS:
+        multi_scale_retinex(image, scales=[1, 8], verbose=False, blur=blur)
+
+
+def handle_request(request, resources=None):
+    """Process one request.
+
+    Parameters
+    ----------
+    request: dict
+        'command': 'iphigen' or 'iphigen_nifti' to run a job, 'ping' to
+            check the server, 'shutdown' to stop it.
+        'args': list of command line arguments of the job.
+        'cwd': directory relative paths of the job refer to.
+        'id': optional, returned in the response.
+    resources: iphigen.resources.Resources, optional
+        Caches, threads and worker processes shared by the jobs.
+
+    Returns
+    -------
+    response: dict
+        'id', 'ok' (bool), 'outputs' (saved files), 'errors' (messages),
+        'log' (printed output of the job) and 'wall' (seconds).
+
+    """
+    import iphigen.config as cfg
+    from iphigen import iphigen_2d, iphigen_nifti
+    from iphigen.ui import user_interface
+
+    start = time.time()
+    command = request.get('command')
+    response = {'id': request.get('id'), 'ok': True, 'outputs': [],
+                'errors': [], 'log': ''}
+    if command in ('ping', 'shutdown'):
+        response['wall'] = time.time() - start
+        return response
+
+    log = io.StringIO()
+    with _lock:
+        settings = {k: getattr(cfg, k) for k in dir(cfg)
+                    if not k.startswith('_')}
+        cwd = os.getcwd()
+        try:
+            with contextlib.redirect_stdout(log), \
+                    contextlib.redirect_stderr(log):
+                os.chdir(request.get('cwd', cwd))
+                user_interface(list(request.get('args', [])))
+                if command == 'iphigen':
+                    for f, out_path, error in iphigen_2d.run(resources):
+                        if out_path is not None:
+                            response['outputs'].append(out_path)
+                        if error is not None:
+                            response['errors'].append(
+                                '{}: {}'.format(f, error))
+                elif command == 'iphigen_nifti':
+                    response['outputs'] = iphigen_nifti.run(resources)
+                else:
+                    raise ValueError('Unknown command "{}".'.format(command))
+        except SystemExit as e:
+            # Argument errors and --help
+            if e.code not in (None, 0):
+                response['errors'].append('Invalid arguments.')
+        except Exception as e:
+            response['errors'].append('{}: {}'.format(type(e).__name__, e))
+        finally:
+            os.chdir(cwd)
+            for k, v in settings.items():
+                setattr(cfg, k, v)
+    response['ok'] = not response['errors']
+    response['log'] = log.getvalue()
+    response['wall'] = time.time() - start
+    return response
+
+
+def _respond(line, resources=None):
+    """Response line of a request line."""
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        return {'ok': False, 'errors': ['Invalid JSON: {}'.format(e)],
+                'outputs': [], 'log': ''}, False
+    return (handle_request(request, resources),
+            request.get('command') == 'shutdown')
+
+
+def serve_stdio(stdin=None, stdout=None):
+    """Answer requests from standard input until it is closed."""
+    stdin = sys.stdin if stdin is None else stdin
+    stdout = sys.stdout if stdout is None else stdout
+    resources = Resources()
+    try:
+        for line in stdin:
+            if not line.strip():
+                continue
+            response, shutdown = _respond(line, resources)
+            stdout.write(json.dumps(response) + '\n')
+            stdout.flush()
+            if shutdown:
+                break
+    finally:
+        resources.close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Answer requests of one connection."""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response, shutdown = _respond(line.decode(),
+                                          self.server.resources)
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+            if shutdown:
+                # shutdown() waits for serve_forever, call it from elsewhere
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+def serve_socket(socket_path=None):
+    """Answer requests on a Unix socket until a shutdown request."""
+    if socket_path is None:
+        socket_path = default_socket_path()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # left over from a stopped server
+    server = socketserver.ThreadingUnixStreamServer(socket_path, _Handler)
+    server.daemon_threads = True
+    server.resources = Resources()
+    try:
+        print('Listening on {}'.format(socket_path))
+        sys.stdout.flush()
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.resources.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def main():
+    """Start the server."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, metavar='path',
+                        default=default_socket_path())
+    parser.add_argument('--stdio', action='store_true',
+                        help="Read requests from standard input instead.")
+    args = parser.parse_args()
+    warm_up()
+    if args.stdio:
+        serve_stdio()
+    else:
+        serve_socket(args.socket)
+
+
+if __name__ == "__main__":
+    main()
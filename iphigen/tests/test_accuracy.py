@@ -0,0 +1,35 @@
+"""Test reduced precision processing."""
+
+import numpy as np
+from iphigen.accuracy import precision_report
+from iphigen.pipeline import Pipeline
+
+
+def test_pipeline_float32():
+    """Test float32 pipeline stays within a small fraction of a gray level."""
+    # Given
+    data = (np.random.random((60, 50, 3)) * 255).astype('uint8')
+    settings = dict(intensity_balance=True, retinex=True, scales=[2, 8],
+                    simplex_color_balance=True, simplest_color_balance=True)
+    # When
+    output = Pipeline(dtype=np.float32, verbose=False, **settings).run(data)
+    report = precision_report(data, **settings)
+    # Then
+    assert output.dtype == np.float32
+    assert [r['stage'] for r in report] == [
+        'intensity_balance', 'retinex', 'simplex_color_balance',
+        'simplest_color_balance']
+    for r in report:
+        assert r['max'] < 1e-2
+        assert r['nan_mismatch'] == 0
+
+
+def test_precision_report_no_valid():
+    """Test deviations are NaN when no output element is finite."""
+    # When
+    report = precision_report(np.zeros((20, 20, 3)), retinex=True,
+                              scales=[2])
+    # Then
+    assert np.isnan(report[0]['max'])
+    assert all(np.isnan(v) for v in report[0]['percentiles'].values())
+    assert report[0]['nan_mismatch'] == 0
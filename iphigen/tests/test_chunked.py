@@ -0,0 +1,43 @@
+"""Test out-of-core nifti processing."""
+
+import numpy as np
+import nibabel as nb
+from iphigen import core
+from iphigen.chunked import process_nifti_chunked
+
+
+def test_process_nifti_chunked(tmpdir):
+    """Test slab-wise retinex against whole volume retinex."""
+    # Given
+    data = np.random.random((20, 16, 30)) * 100
+    in_path = str(tmpdir.join('in.nii'))
+    out_path = str(tmpdir.join('out.nii.gz'))
+    nb.save(nb.Nifti1Image(data, np.eye(4)), in_path)
+    scales = [1, 2]
+    expected = core.multi_scale_retinex(data, scales=scales, verbose=False)
+    expected = core.scale_approx(expected, data)
+    # When
+    process_nifti_chunked([in_path], [out_path], chunk_size=7, retinex=True,
+                          scales=scales)
+    output = nb.load(out_path).get_fdata()
+    # Then
+    assert np.allclose(output, expected)
+
+
+def test_process_nifti_chunked_voxel_size(tmpdir):
+    """Test slab-wise retinex in mm against whole volume retinex."""
+    # Given
+    data = np.random.random((20, 16, 30)) * 100
+    in_path = str(tmpdir.join('in.nii'))
+    out_path = str(tmpdir.join('out.nii'))
+    nb.save(nb.Nifti1Image(data, np.eye(4)), in_path)
+    scales, voxel_size = [1, 4], [0.5, 0.5, 2.]
+    expected = core.multi_scale_retinex(data, scales=scales, verbose=False,
+                                        voxel_size=voxel_size)
+    expected = core.scale_approx(expected, data)
+    # When
+    process_nifti_chunked([in_path], [out_path], chunk_size=7, retinex=True,
+                          scales=scales, voxel_size=voxel_size)
+    output = nb.load(out_path).get_fdata()
+    # Then
+    assert np.allclose(output, expected)
@@ -1 +1,233 @@
 """Test core functions."""
+
+import pytest
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from iphigen.core import (multi_scale_retinex, multi_scale_retinex_sweep,
+                          simplex_color_balance, simplest_color_balance)
+from iphigen.utils import truncate_range, set_range
+
+
+def _stacked_msr(image, scales):
+    """Reference retinex that keeps every scale in memory."""
+    msr = np.zeros(image.shape + (len(scales),))
+    for i, sigma in enumerate(scales):
+        temp = gaussian_filter(image, sigma, mode="reflect")
+        msr[..., i] = np.log(image + 1) - np.log(temp + 1)
+    msr = np.nan_to_num(msr)
+    msr = np.mean(msr, axis=-1)
+    return np.exp(msr - 1)
+
+
+def test_multi_scale_retinex():
+    """Test accumulated retinex against the stacked formulation."""
+    # Given
+    data = np.random.random((32, 32, 8)) * 100
+    scales = [1, 3, 5]
+    expected = _stacked_msr(data, scales)
+    # When
+    output = multi_scale_retinex(data, scales=scales, verbose=False)
+    # Then
+    assert np.allclose(output, expected)
+
+
+def test_multi_scale_retinex_float32():
+    """Test reduced precision retinex."""
+    # Given
+    data = np.random.random((64, 64)) * 255
+    scales = [2, 8]
+    expected = _stacked_msr(data, scales)
+    # When
+    output = multi_scale_retinex(data, scales=scales, verbose=False,
+                                 dtype=np.float32)
+    # Then
+    assert output.dtype == np.float32
+    assert output == pytest.approx(expected, rel=1e-5)
+
+
+def test_multi_scale_retinex_pyramid():
+    """Test pyramid surrounds against the exact path."""
+    # Given
+    data = np.random.random((128, 96)) * 255
+    scales = [3, 15, 40]
+    expected = multi_scale_retinex(data, scales=scales, verbose=False)
+    # When
+    output = multi_scale_retinex(data, scales=scales, verbose=False,
+                                 blur='pyramid')
+    # Then
+    assert output == pytest.approx(expected, rel=1e-2)
+
+
+@pytest.mark.parametrize("scales", [[15, 80, 250], [10, 3, 1]])
+def test_multi_scale_retinex_cascade(scales):
+    """Test cascaded surrounds against independent surrounds."""
+    # Given
+    data = np.random.random((300, 200)) * 255
+    expected = multi_scale_retinex(data, scales=scales, verbose=False)
+    # When
+    output = multi_scale_retinex(data, scales=scales, verbose=False,
+                                 cascade=True)
+    # Then
+    assert output == pytest.approx(expected, rel=1e-3)
+
+
+def test_multi_scale_retinex_workers():
+    """Test threaded retinex is bit-identical to serial retinex."""
+    # Given
+    data = np.random.random((100, 80)) * 255
+    scales = [1, 3, 5, 10, 15]
+    expected = multi_scale_retinex(data, scales=scales, verbose=False)
+    # When
+    output = multi_scale_retinex(data, scales=scales, verbose=False,
+                                 workers=4)
+    # Then
+    assert np.array_equal(output, expected)
+
+
+def test_multi_scale_retinex_sweep():
+    """Test shared surrounds against separate cascaded runs."""
+    # Given
+    data = np.random.random((48, 40)) * 255
+    scale_sets = [[1, 3, 8], [3, 5], [8, 1, 8]]
+    expected = [multi_scale_retinex(data, scales=s, verbose=False,
+                                    cascade=True) for s in scale_sets]
+    # When
+    output = multi_scale_retinex_sweep(data, scale_sets, verbose=False)
+    # Then
+    # Surrounds are cascaded over the sigmas of all sets
+    for out, exp in zip(output, expected):
+        assert np.allclose(out, exp, rtol=1e-4)
+
+
+@pytest.mark.parametrize('blur', ['exact', 'iir'])
+def test_multi_scale_retinex_batch(blur):
+    """Test a stack of images against one call per image."""
+    # Given
+    data = np.random.random((5, 24, 20)) * 255
+    scales = [1, 4]
+    expected = [multi_scale_retinex(image, scales=scales, verbose=False,
+                                    blur=blur) for image in data]
+    # When
+    output = multi_scale_retinex(data, scales=scales, verbose=False,
+                                 blur=blur, batch=True)
+    # Then
+    assert np.allclose(output, expected)
+
+
+def test_multi_scale_retinex_voxel_size():
+    """Test scales in mm against per-axis voxel sigmas."""
+    # Given
+    data = np.random.random((24, 24, 8)) * 255
+    voxel_size = [0.5, 0.5, 3.]
+    scales = [0.5, 2.]
+    # Thin slice axis is not filtered at the smallest scale
+    sigmas = [(1, 1, 0), (4, 4, 2 / 3.)]
+    expected = _stacked_msr(data, sigmas)
+    # When
+    output = multi_scale_retinex(data, scales=scales, verbose=False,
+                                 voxel_size=voxel_size)
+    # Then
+    assert np.allclose(output, expected)
+
+
+def test_multi_scale_retinex_mask():
+    """Test masked retinex against normalized convolution on the full image."""
+    # Given
+    data = np.random.random((80, 64)) * 255
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[20:50, 30:45] = True
+    data[~mask] = 1000  # bright background should not leak into surrounds
+    scales = [1, 3]
+    weights = mask.astype(float)
+    msr = np.zeros(data.shape)
+    for sigma in scales:
+        surround = (gaussian_filter(data * weights, sigma)
+                    / gaussian_filter(weights, sigma))
+        msr += np.log1p(data * weights) - np.log1p(surround)
+    expected = np.exp(msr / len(scales) - 1)
+    # When
+    output = multi_scale_retinex(data, scales=scales, verbose=False,
+                                 mask=mask)
+    # Then
+    assert np.allclose(output[mask], expected[mask])
+    assert np.all(output[~mask] == 0)
+
+
+@pytest.mark.parametrize('use_mask', [False, True])
+def test_simplest_color_balance(use_mask):
+    """Test batched balance against truncation and scaling per channel."""
+    # Given
+    data = np.random.random((40, 30, 4)) * 255
+    data.ravel()[np.random.choice(data.size, 200, replace=False)] = 0
+    data.ravel()[np.random.choice(data.size, 20, replace=False)] = np.nan
+    mask = np.random.random(data.shape[:-1]) > 0.3 if use_mask else None
+    expected = data.copy()
+    for d in range(data.shape[-1]):
+        expected[..., d] = truncate_range(expected[..., d], pmin=1, pmax=99,
+                                          mask=mask)
+        expected[..., d] = set_range(expected[..., d], mask=mask)
+    # When
+    output = simplest_color_balance(data.copy(), pmin=1, pmax=99, mask=mask)
+    # Then
+    assert np.allclose(output, expected, equal_nan=True)
+
+
+def test_simplest_color_balance_batch():
+    """Test a stack of images against one call per image."""
+    # Given
+    data = np.random.random((4, 16, 12, 3)) * 255
+    data[0] *= 0.1
+    expected = [simplest_color_balance(image.copy()) for image in data]
+    # When
+    output = simplest_color_balance(data.copy(), batch=True)
+    # Then
+    assert np.allclose(output, expected)
+
+
+def _compoda_simplex_color_balance(bary, center, standardize, trunc_max):
+    """Reference simplex color balance with compoda operations."""
+    coda = pytest.importorskip('compoda.core')
+    dims = bary.shape
+    bary = np.nan_to_num(bary.reshape([np.prod(dims[:-1]), dims[-1]]))
+    mask = np.prod(bary, axis=-1) > 0
+    temp = bary[mask]
+    sample_center = coda.sample_center(temp)
+    if center:
+        temp = coda.perturb(temp, np.full(temp.shape, sample_center)**-1.)
+    if standardize:
+        totvar = coda.sample_total_variance(temp, sample_center)
+        temp = coda.power(temp, np.power(totvar, -1./2.))
+    if trunc_max:
+        anorm = coda.aitchison_norm(temp)
+        thr_min, thr_max = np.percentile(anorm, [1., 99.])
+        correction = np.ones(anorm.shape)
+        idx = anorm > thr_max
+        correction[idx] = anorm[idx] / thr_max
+        temp = coda.power(temp, correction[:, None])
+        correction = np.ones(anorm.shape)
+        idx = anorm < thr_min
+        correction[idx] = anorm[idx] / thr_min
+        temp = coda.power(temp, correction[:, None])
+    bary[mask] = temp
+    return bary.reshape(dims)
+
+
+@pytest.mark.parametrize("center,standardize,trunc_max", [
+    (True, False, False), (True, True, False), (False, True, False),
+    (True, True, True), (False, False, True)])
+def test_simplex_color_balance(center, standardize, trunc_max):
+    """Test clr based simplex color balance against compoda operations."""
+    # Given
+    data = np.random.random((20, 16, 6, 3)) + 0.05
+    data[:2] = 0
+    data[5, 5, 0] = np.nan
+    bary = data / np.sum(data, axis=-1)[..., None]
+    expected = _compoda_simplex_color_balance(bary.copy(), center,
+                                              standardize, trunc_max)
+    # When
+    output = simplex_color_balance(bary, center=center,
+                                   standardize=standardize,
+                                   trunc_max=trunc_max)
+    # Then
+    assert np.allclose(output, expected)
+    assert not np.array_equal(output, bary)
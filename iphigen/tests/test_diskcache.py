@@ -0,0 +1,62 @@
+"""Test on-disk cache."""
+
+import os
+import numpy as np
+from iphigen.core import multi_scale_retinex
+from iphigen.diskcache import DiskCache
+
+
+def test_multi_scale_retinex_disk_cache(tmpdir):
+    """Test cached retinex and surrounds give the uncached result."""
+    # Given
+    data = np.random.random((40, 30)) * 255
+    cache = DiskCache(str(tmpdir))
+    expected = multi_scale_retinex(data, scales=[1, 3], verbose=False)
+    # When
+    first = multi_scale_retinex(data, scales=[1, 3], verbose=False,
+                                disk_cache=cache)
+    second = multi_scale_retinex(data, scales=[1, 3], verbose=False,
+                                 disk_cache=cache)
+    # Surrounds are shared with other scale sets
+    third = multi_scale_retinex(data, scales=[1, 3, 5], verbose=False,
+                                disk_cache=cache)
+    # Then
+    assert np.array_equal(first, expected)
+    assert np.array_equal(second, expected)
+    assert np.array_equal(
+        third, multi_scale_retinex(data, scales=[1, 3, 5], verbose=False))
+    # msr + 2 surrounds missed, msr hit, msr + sigma 5 missed, 2 hits
+    assert (cache.hits, cache.misses) == (3, 5)
+
+
+def test_disk_cache_eviction(tmpdir):
+    """Test least recently used entries are evicted beyond the bound."""
+    # Given
+    cache = DiskCache(str(tmpdir), max_bytes=2000)
+    arrays = [np.full(100, i, dtype=float) for i in range(3)]
+    keys = [cache.key(cache.digest(a), kind='test') for a in arrays]
+    # When
+    cache.put(keys[0], arrays[0])
+    cache.put(keys[1], arrays[1])
+    os.utime(os.path.join(str(tmpdir), keys[0] + '.npy'), (0, 0))
+    os.utime(os.path.join(str(tmpdir), keys[1] + '.npy'), (1, 1))
+    cache.get(keys[0])  # now the most recently used
+    cache.put(keys[2], arrays[2])
+    # Then
+    assert cache.get(keys[1]) is None
+    assert np.array_equal(cache.get(keys[0]), arrays[0])
+    assert np.array_equal(cache.get(keys[2]), arrays[2])
+
+
+def test_disk_cache_write_error(tmpdir):
+    """Test failed writes are counted instead of raised."""
+    # Given
+    directory = str(tmpdir.join('cache'))
+    cache = DiskCache(directory)
+    os.rmdir(directory)
+    # When
+    key = cache.key('0', kind='test')
+    cache.get(key)
+    cache.put(key, np.zeros(10))
+    # Then
+    assert (cache.hits, cache.misses, cache.write_errors) == (0, 1, 1)
@@ -0,0 +1,65 @@
+"""Test gaussian blur engines."""
+
+import pytest
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from iphigen.filters import gaussian_blur, approximation_error
+
+
+@pytest.mark.parametrize("method, sigma, max_error", [
+    ('iir', 2, 0.04), ('iir', 15, 0.04),
+    ('box', 2, 0.04), ('box', 15, 0.04),
+    ('fft', 1, 0.002), ('fft', 15, 0.002),
+    ('pyramid', 8, 0.002), ('pyramid', 40, 0.002)])
+def test_approximation_error(method, sigma, max_error):
+    """Test approximate blurs stay within documented error bounds."""
+    # Given
+    data = np.zeros((120, 90))
+    data[30:80, 20:60] = 100
+    data += np.random.random(data.shape) * 50
+    # When
+    output = approximation_error(data, sigma, method)
+    # Then
+    assert output[0] < max_error
+
+
+def test_gaussian_blur_per_axis():
+    """Test per axis sigma with a skipped axis."""
+    # Given
+    data = np.random.random((4, 40, 40))
+    expected = gaussian_filter(data, [0, 3, 3], mode="reflect")
+    # When
+    output = gaussian_blur(data, [0, 3, 3], method='fft')
+    # Then
+    assert np.allclose(output, expected, atol=1e-3)
+
+
+@pytest.mark.parametrize("method", ['exact', 'iir', 'box', 'fft', 'pyramid'])
+@pytest.mark.parametrize("dtype, expected", [
+    ('float32', 'float32'), ('float64', 'float64'), ('uint8', 'float32')])
+def test_gaussian_blur_dtype(method, dtype, expected):
+    """Test all engines return the same floating point type."""
+    # Given
+    data = (np.random.random((40, 30)) * 255).astype(dtype)
+    # When
+    output = gaussian_blur(data, 8, method=method)
+    # Then
+    assert output.dtype == expected
+
+
+def test_gaussian_blur_unknown_method():
+    """Test unknown blur method is rejected."""
+    with pytest.raises(ValueError):
+        gaussian_blur(np.zeros((8, 8)), 1, method='median')
+
+
+@pytest.mark.parametrize("method", ['exact', 'iir', 'box'])
+def test_gaussian_blur_workers(method):
+    """Test threaded slabs give bit-identical results."""
+    # Given
+    data = np.random.random((40, 30, 20))
+    expected = gaussian_blur(data, [3, 2, 4], method=method)
+    # When
+    output = gaussian_blur(data, [3, 2, 4], method=method, workers=4)
+    # Then
+    assert np.array_equal(output, expected)
@@ -0,0 +1,58 @@
+"""Test 2D image processing script."""
+
+import json
+import pytest
+import numpy as np
+import cv2
+import iphigen.config as cfg
+from iphigen.iphigen_2d import run, _process_file_safe
+
+
+def test_process_file_safe(tmpdir, monkeypatch):
+    """Test one unreadable image does not stop a batch."""
+    # Given
+    good, bad = str(tmpdir.join('good.png')), str(tmpdir.join('bad.png'))
+    cv2.imwrite(good, (np.random.random((16, 16, 3)) * 255).astype('uint8'))
+    tmpdir.join('bad.png').write('not an image')
+    monkeypatch.setattr(cfg, 'simplest_color_balance', True)
+    # When
+    output = [_process_file_safe(f) for f in [bad, good]]
+    # Then
+    assert output[0][2].startswith('ValueError')
+    assert output[1][1] == str(tmpdir.join('good_SimplestCB.png'))
+    assert output[1][2] is None
+    stages = [r['stage'] for r in output[1][4]]
+    assert stages[-2:] == ['simplest_color_balance', 'file']
+    assert output[0][4] == []
+
+
+@pytest.mark.parametrize('output_dtype', [None, 'uint16'])
+def test_process_file_sweep(tmpdir, monkeypatch, output_dtype):
+    """Test sweep outputs are saved as one grid with parameters."""
+    # Given
+    path = str(tmpdir.join('image.png'))
+    cv2.imwrite(path, (np.random.random((20, 30, 3)) * 255).astype('uint8'))
+    for k, v in [('retinex', True), ('simplest_color_balance', True),
+                 ('sweep_scales', [[2, 5], [5]]), ('sweep_perc', None),
+                 ('cache_dir', None), ('output_dtype', output_dtype)]:
+        monkeypatch.setattr(cfg, k, v)
+    # When
+    _, out_path, error, _, _ = _process_file_safe(path)
+    # Then
+    assert error is None
+    assert out_path == str(tmpdir.join('image_MSRBP_SimplestCB_sweep.png'))
+    grid = cv2.imread(out_path, cv2.IMREAD_UNCHANGED)
+    assert grid.shape == (20, 60, 3)
+    assert grid.dtype == (output_dtype or 'uint8')
+    with open(str(tmpdir.join('image_MSRBP_SimplestCB_sweep.json'))) as f:
+        cells = json.load(f)['outputs']
+    assert [(c['scales'], c['col']) for c in cells] == [([2, 5], 0), ([5], 1)]
+
+
+def test_run_mask(monkeypatch):
+    """Test masks, which only nifti processing supports, are rejected."""
+    # Given
+    monkeypatch.setattr(cfg, 'mask', 'auto')
+    # Then
+    with pytest.raises(ValueError):
+        run()
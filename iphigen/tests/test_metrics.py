@@ -0,0 +1,51 @@
+"""Test stage measurements."""
+
+import json
+import numpy as np
+from iphigen import metrics
+from iphigen.core import multi_scale_retinex
+
+
+def test_recorder_retinex(capsys):
+    """Test retinex scales are recorded and nothing is printed."""
+    # Given
+    data = np.random.random((32, 24)) * 255
+    # When
+    with metrics.Recorder(file='a.png') as recorder:
+        multi_scale_retinex(data, scales=[1, 3], verbose=False, workers=2)
+    multi_scale_retinex(data, scales=[1, 3], verbose=False)
+    # Then
+    assert capsys.readouterr().out == ''
+    stages = [r['stage'] for r in recorder.records]
+    assert sorted(stages) == ['multi_scale_retinex', 'retinex_scale',
+                              'retinex_scale']
+    assert sorted(r['sigma'] for r in recorder.records
+                  if 'sigma' in r) == [1., 3.]
+    record = recorder.records[-1]
+    assert record['file'] == 'a.png'
+    assert record['shape'] == [32, 24] and record['dtype'] == 'float64'
+    assert record['wall'] >= 0 and record['cpu'] >= 0
+
+
+def test_add_hook_write_json(tmpdir):
+    """Test custom hooks and JSON output."""
+    # Given
+    records = []
+    path = str(tmpdir.join('metrics.json'))
+    # When
+    metrics.add_hook(records.append)
+    try:
+        with metrics.measure('step', np.zeros(4, dtype='uint8'), extra=1):
+            pass
+    finally:
+        metrics.remove_hook(records.append)
+    with metrics.measure('ignored'):
+        pass
+    metrics.write_json(path, [{'file': 'a', 'records': records}])
+    # Then
+    with open(path) as f:
+        output = json.load(f)
+    assert len(records) == 1
+    assert output['files'][0]['records'][0]['stage'] == 'step'
+    assert output['files'][0]['records'][0]['extra'] == 1
+    assert output['files'][0]['records'][0]['nbytes'] == 4
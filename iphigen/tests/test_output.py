@@ -0,0 +1,70 @@
+"""Test output encoding and writing."""
+
+import os
+import pytest
+import numpy as np
+import nibabel as nb
+from iphigen.output import quantize, encode_image, save_nifti, Writer
+
+
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16'])
+def test_quantize(dtype):
+    """Test integer encoding error stays within half a step."""
+    # Given
+    data = np.random.random((20, 20)) * 1000 - 100
+    data[0, 0] = np.nan
+    # When
+    output, slope, inter = quantize(data, dtype)
+    # Then
+    assert output.dtype == dtype
+    assert output[0, 0] == 0
+    decoded = output * slope + inter
+    assert np.nanmax(np.abs(decoded - data)) <= slope / 2 + 1e-9
+
+
+def test_encode_image_uint8_input():
+    """Test 8 bit inputs are stretched to 16 bit without overflow."""
+    # Given
+    data = np.array([[0, 1, 128, 255]], dtype=np.uint8)
+    # When
+    output = encode_image(data, 'uint16')
+    # Then
+    assert output.dtype == np.uint16
+    assert np.array_equal(output, data.astype(int) * 257)
+
+
+def test_save_nifti(tmpdir):
+    """Test scaled uint16 NIfTI outputs decode to the data."""
+    # Given
+    data = np.random.random((8, 9, 10)) * 500 + 20
+    path = str(tmpdir.join('out.nii.gz'))
+    # When
+    nbytes = save_nifti(path, data, np.eye(4), dtype='uint16',
+                        compresslevel=1)
+    img = nb.load(path)
+    # Then
+    assert nbytes == os.path.getsize(path)
+    assert img.get_data_dtype() == np.uint16
+    assert np.allclose(img.get_fdata(), data, atol=500 / 65535)
+
+
+def test_writer(tmpdir):
+    """Test background saving counts bytes and collects errors."""
+    # Given
+    def save(path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+        return len(content)
+    paths = [str(tmpdir.join('{}.txt'.format(i))) for i in range(5)]
+    bad_path = str(tmpdir.join('missing', 'bad.txt'))
+    # When
+    with Writer(max_pending=1, threads=2) as writer:
+        for path in paths:
+            writer.submit(save, path, 'abc', label=path)
+        writer.submit(save, bad_path, 'abc', label=bad_path)
+    # Then
+    assert all(os.path.isfile(path) for path in paths)
+    assert (writer.files, writer.bytes_written) == (5, 15)
+    assert [label for label, _ in writer.errors] == [bad_path]
+    assert writer.stats.waits == 6
+    assert writer.stats.as_dict()['mean_occupancy'] <= 1
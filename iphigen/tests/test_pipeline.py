@@ -0,0 +1,111 @@
+"""Test processing pipeline."""
+
+import numpy as np
+from iphigen import core, utils
+from iphigen.pipeline import Pipeline
+
+
+def _stepwise(data, scales):
+    """Reference that recomputes intensity and coordinates per stage."""
+    data = np.asarray(data, dtype=float)
+    inten = np.sum(data, axis=-1)
+    bary = data / inten[..., None]
+    inten = utils.truncate_range(inten, pmin=1., pmax=99.)
+    inten = utils.set_range(inten, zero_to=255*data.shape[-1])
+    data = bary * inten[..., None]
+    bary = data / inten[..., None]
+    new_inten = core.multi_scale_retinex(inten, scales=scales, verbose=False)
+    inten = core.scale_approx(new_inten, inten)
+    bary = core.simplex_color_balance(bary)
+    data = bary * inten[..., None]
+    return core.simplest_color_balance(data, pmin=1., pmax=99.)
+
+
+def test_pipeline_run():
+    """Test fused pipeline against the stage by stage computation."""
+    # Given
+    data = (np.random.random((40, 30, 3)) * 255).astype('uint8')
+    scales = [1, 3, 5]
+    expected = _stepwise(data, scales)
+    pipeline = Pipeline(intensity_balance=True, retinex=True, scales=scales,
+                        simplex_color_balance=True,
+                        simplest_color_balance=True, verbose=False,
+                        track_memory=True)
+    # When
+    output = pipeline.run(data)
+    # Then
+    assert np.allclose(output, expected, equal_nan=True)
+    assert pipeline.suffix == '_IB_MSRBP_1_3_5_SimplexCB_SimplestCB'
+    assert list(pipeline.timings) == [
+        'decompose', 'intensity_balance', 'retinex',
+        'simplex_color_balance', 'compose', 'simplest_color_balance']
+    assert pipeline.peak_memory > data.size * 8
+
+
+def test_pipeline_no_stage():
+    """Test input is left untouched when nothing is selected."""
+    # Given
+    data = np.random.random((8, 8, 3))
+    pipeline = Pipeline(verbose=False)
+    # When
+    output = pipeline.run(data)
+    # Then
+    assert pipeline.stages == []
+    assert pipeline.suffix == ''
+    assert np.allclose(output, data)
+
+
+def test_pipeline_mask():
+    """Test that background does not change the masked output."""
+    # Given
+    data = np.random.random((60, 60, 3)) * 100 + 1
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[10:40, 15:50] = True
+    other = data.copy()
+    other[~mask] = 255
+    pipeline = Pipeline(retinex=True, scales=[2, 5],
+                        simplest_color_balance=True, mask=mask,
+                        verbose=False)
+    # When
+    output = pipeline.run(data)
+    other_output = pipeline.run(other)
+    # Then
+    assert np.allclose(output, other_output)
+    assert np.all(output[~mask] == 0)
+    assert pipeline.suffix == '_MSRBP_2_5_SimplestCB_mask'
+
+
+def test_pipeline_sweep():
+    """Test sweep results against separate runs."""
+    # Given
+    data = np.random.random((40, 30, 3)) * 255
+    scale_sets = [[2, 5], [5, 10]]
+    percs = [[1., 99.], [5., 95.]]
+    expected = [Pipeline(retinex=True, scales=s, cascade=True,
+                         simplest_color_balance=True, simplest_perc=p,
+                         verbose=False).run(data)
+                for s in scale_sets for p in percs]
+    pipeline = Pipeline(retinex=True, simplest_color_balance=True,
+                        verbose=False)
+    # When
+    output = pipeline.sweep(data, scale_sets=scale_sets, simplest_percs=percs)
+    # Then
+    assert [params for params, _ in output] == [
+        {'scales': s, 'simplest_perc': p} for s in scale_sets for p in percs]
+    # Surrounds are cascaded over the sigmas of all sets
+    for (_, out), exp in zip(output, expected):
+        assert np.allclose(out, exp, atol=0.01)
+
+
+def test_pipeline_batch():
+    """Test a stack of images against one run per image."""
+    # Given
+    data = np.random.random((6, 20, 16, 3)) * 255
+    data[1] *= 0.2
+    settings = dict(retinex=True, scales=[2, 5], simplest_color_balance=True,
+                    verbose=False)
+    expected = [Pipeline(**settings).run(image) for image in data]
+    # When
+    output = Pipeline(batch=True, **settings).run(data)
+    # Then
+    assert np.allclose(output, expected)
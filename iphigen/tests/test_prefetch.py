@@ -0,0 +1,42 @@
+"""Test read-ahead of inputs."""
+
+import time
+import threading
+import pytest
+from iphigen.prefetch import ReadAhead
+
+
+def test_read_ahead():
+    """Test items keep their order and at most depth are loaded ahead."""
+    # Given
+    loading, most = [0], [0]
+    lock = threading.Lock()
+
+    def load(i):
+        with lock:
+            loading[0] += 1
+            most[0] = max(most[0], loading[0])
+        time.sleep(0.01)
+        if i == 3:
+            raise ValueError('bad item')
+        return i * 10
+
+    reader = ReadAhead(load, range(8), depth=3, threads=3)
+    # When
+    results = []
+    for i, loaded in reader:
+        if i == 3:
+            with pytest.raises(ValueError):
+                loaded.result()
+        else:
+            results.append(loaded.result())
+        time.sleep(0.02)
+        with lock:
+            loading[0] -= 1
+    # Then
+    assert results == [i * 10 for i in range(8) if i != 3]
+    # Up to depth items are loaded ahead of the processed one
+    assert most[0] <= 4
+    assert reader.stats.waits == 8
+    # Loading is faster than processing, the queue stays filled
+    assert reader.stats.as_dict()['mean_occupancy'] > 1
@@ -0,0 +1,147 @@
+"""Test percentile computations."""
+
+import pytest
+import numpy as np
+from iphigen.quantiles import (percentile, channel_percentiles,
+                               QuantileSketch, PercentileCache,
+                               TemporalPercentileCache)
+
+
+def test_percentile_exact():
+    """Test exact percentiles against nanpercentile."""
+    # Given
+    data = np.random.random(1000)
+    data[np.random.choice(data.size, 50, replace=False)] = np.nan
+    q = [1., 50., 99.]
+    expected = np.nanpercentile(data, q)
+    # When
+    output = percentile(data, q)
+    # Then
+    assert np.allclose(output, expected)
+
+
+def test_percentile_histogram():
+    """Test histogram percentiles stay within one bin width."""
+    # Given
+    data = np.random.normal(size=100000)
+    q = [2.5, 97.5]
+    bins = 1024
+    expected = np.percentile(data, q)
+    # When
+    output = percentile(data, q, method='histogram', bins=bins)
+    # Then
+    assert np.all(np.abs(output - expected) <= np.ptp(data) / bins)
+
+
+def test_percentile_histogram_mask():
+    """Test masked histogram percentiles ignore NaNs and masked values."""
+    # Given
+    data = np.random.normal(size=(300, 400))
+    data[::5] = np.nan
+    mask = np.random.random(data.shape) < 0.5
+    data[~mask] = 1000.
+    q = [2.5, 50., 97.5]
+    bins = 1024
+    valid = data[mask & ~np.isnan(data)]
+    expected = np.percentile(valid, q)
+    # When
+    output = percentile(data, q, mask=mask, method='histogram', bins=bins)
+    # Then
+    assert np.all(np.abs(output - expected) <= np.ptp(valid) / bins)
+
+
+def test_channel_percentiles():
+    """Test batched percentiles against nanpercentile of each channel."""
+    # Given
+    data = np.random.random((50, 20, 3))
+    data[np.random.random(data.shape) < 0.1] = np.nan
+    mask = np.random.random(data.shape) < 0.7
+    mask[..., 2] = False
+    q = [0., 1., 50., 99.5, 100.]
+    expected = [np.nanpercentile(data[..., d][mask[..., d]], q)
+                for d in range(2)]
+    # When
+    output = channel_percentiles(data, q, mask=mask)
+    # Then
+    assert output.shape == (3, len(q))
+    assert np.allclose(output[:2], expected)
+    assert np.all(np.isnan(output[2]))
+
+
+def test_quantile_sketch():
+    """Test merged sketches of chunks against the whole data."""
+    # Given
+    data = np.random.exponential(size=(20, 5000))
+    q = [1., 99.]
+    bins = 1024
+    expected = np.percentile(data, q)
+    # When
+    sketch_1 = QuantileSketch(bins=bins, exact_size=1000)
+    sketch_2 = QuantileSketch(bins=bins, exact_size=1000)
+    for chunk in data[:10]:
+        sketch_1.update(chunk)
+    for chunk in data[10:]:
+        sketch_2.update(chunk)
+    sketch_1.merge(sketch_2)
+    output = sketch_1.percentile(q)
+    # Then
+    assert sketch_1.count == data.size
+    assert np.all(np.abs(output - expected) <= 4 * np.ptp(data) / bins)
+
+
+def test_quantile_sketch_merge_into_empty():
+    """Test merging histograms into a fresh sketch, as in reductions."""
+    # Given
+    data = np.random.exponential(size=(4, 5000))
+    q = [1., 50., 99.]
+    bins = 1024
+    expected = np.percentile(data, q)
+    chunks = []
+    for chunk in data:
+        sketch = QuantileSketch(bins=bins, exact_size=100)
+        sketch.update(chunk)
+        chunks.append(sketch)
+    # When
+    total = QuantileSketch(bins=bins, exact_size=100)
+    for sketch in chunks:
+        total.merge(sketch)
+    output = total.percentile(q)
+    # Then
+    assert total.count == data.size
+    assert np.all(np.abs(output - expected) <= 4 * np.ptp(data) / bins)
+
+
+def test_percentile_cache():
+    """Test cached percentiles are reused until invalidated."""
+    # Given
+    data = np.random.random(100)
+    cache = PercentileCache()
+    # When
+    first = percentile(data, [5., 95.], cache=cache)
+    second = percentile(data, [5., 95.], cache=cache)
+    cache.invalidate(data)
+    percentile(data, [5., 95.], cache=cache)
+    # Then
+    assert second is first
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_temporal_percentile_cache():
+    """Test percentiles are smoothed and reused across frames."""
+    # Given
+    frames = [np.full(100, v, dtype=float) for v in [10., 20., 30., 40.]]
+    cache = TemporalPercentileCache(alpha=0.5, interval=2)
+    # When
+    output = []
+    for frame in frames:
+        output.append(percentile(frame, 50., cache=cache))
+        cache.clear()
+    # Then
+    # Computed on frames 0 and 2, reused on frames 1 and 3
+    assert output == [10., 10., 20., 20.]
+
+
+def test_percentile_unknown_method():
+    """Test unknown percentile method is rejected."""
+    with pytest.raises(ValueError):
+        percentile(np.zeros(10), 50, method='median')
@@ -0,0 +1,101 @@
+"""Test server mode."""
+
+import io
+import json
+import threading
+import numpy as np
+import cv2
+from iphigen import server
+from iphigen.client import send_request
+from iphigen.resources import Resources
+import iphigen.config as cfg
+
+
+def test_handle_request(tmpdir):
+    """Test jobs run with their own arguments and leave config untouched."""
+    # Given
+    cv2.imwrite(str(tmpdir.join('a.png')),
+                (np.random.random((16, 16, 3)) * 255).astype('uint8'))
+    request = {'id': 1, 'command': 'iphigen', 'cwd': str(tmpdir),
+               'args': ['a.png', '--simplest_color_balance']}
+    # When
+    response = server.handle_request(request)
+    invalid = server.handle_request({'command': 'iphigen',
+                                     'args': ['--unknown']})
+    # Then
+    assert response['ok'] and response['id'] == 1
+    assert response['outputs'] == ['a_SimplestCB.png']
+    assert tmpdir.join('a_SimplestCB.png').check()
+    assert 'Finished.' in response['log']
+    assert not invalid['ok']
+    assert cfg.simplest_color_balance is False and cfg.filename is None
+
+
+def test_handle_request_resources(tmpdir):
+    """Test jobs share the disk cache and worker processes."""
+    # Given
+    for name in ['a.png', 'b.png']:
+        cv2.imwrite(str(tmpdir.join(name)),
+                    (np.random.random((16, 16, 3)) * 255).astype('uint8'))
+    cache_dir = str(tmpdir.join('cache'))
+    resources = Resources()
+    args = ['a.png', '--retinex', '--scales', '2', '--cache_dir', cache_dir]
+    jobs_args = ['a.png', 'b.png', '--simplest_color_balance', '--jobs', '2']
+    # When
+    try:
+        first = server.handle_request(
+            {'command': 'iphigen', 'cwd': str(tmpdir), 'args': args},
+            resources)
+        second = server.handle_request(
+            {'command': 'iphigen', 'cwd': str(tmpdir), 'args': args},
+            resources)
+        pools = []
+        for _ in range(2):
+            jobs = server.handle_request(
+                {'command': 'iphigen', 'cwd': str(tmpdir),
+                 'args': jobs_args}, resources)
+            assert jobs['ok'], jobs['errors']
+            pools.append(list(resources._pools.values()))
+    finally:
+        resources.close()
+    # Then
+    assert first['ok'] and second['ok']
+    cache, = resources._disk_caches.values()
+    # Retinex output and surround missed, then the output hit
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert len(pools[0]) == 1 and pools[0] == pools[1]
+    assert tmpdir.join('b_SimplestCB.png').check()
+
+
+def test_serve_stdio():
+    """Test JSON lines in, JSON lines out."""
+    # Given
+    stdin = io.StringIO('{"command": "ping", "id": 7}\n\nnot json\n')
+    stdout = io.StringIO()
+    # When
+    server.serve_stdio(stdin, stdout)
+    # Then
+    responses = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert responses[0]['ok'] and responses[0]['id'] == 7
+    assert not responses[1]['ok']
+
+
+def test_serve_socket(tmpdir):
+    """Test client requests over a Unix socket."""
+    # Given
+    path = str(tmpdir.join('s.sock'))
+    thread = threading.Thread(target=server.serve_socket, args=(path,))
+    thread.start()
+    # When
+    for _ in range(100):
+        try:
+            response = send_request({'command': 'ping', 'id': 3}, path)
+            break
+        except OSError:
+            thread.join(0.05)
+    send_request({'command': 'shutdown'}, path)
+    thread.join(5)
+    # Then
+    assert response['ok'] and response['id'] == 3
+    assert not thread.is_alive()
+    assert not tmpdir.join('s.sock').check()
@@ -0,0 +1,23 @@
+"""Test tiled 2D image processing."""
+
+import numpy as np
+import pytest
+from iphigen.pipeline import Pipeline
+from iphigen.tiled import process_image_tiled
+
+
+@pytest.mark.parametrize('retinex', [True, False])
+def test_process_image_tiled(retinex):
+    """Test tiled processing against whole image processing."""
+    # Given
+    image = (np.random.random((120, 160, 3)) * 255).astype(np.uint8)
+    scales = [1, 2]
+    data = Pipeline(intensity_balance=True, retinex=retinex, scales=scales,
+                    simplest_color_balance=True, verbose=False).run(image)
+    expected = np.clip(np.rint(np.nan_to_num(data)), 0, 255)
+    # When
+    output = process_image_tiled(image, tile_size=16, intensity_balance=True,
+                                 retinex=retinex, scales=scales,
+                                 simplest_color_balance=True)
+    # Then
+    assert np.array_equal(output, expected)
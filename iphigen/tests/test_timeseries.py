@@ -0,0 +1,27 @@
+"""Test volume by volume processing of 4D images."""
+
+import numpy as np
+import nibabel as nb
+from iphigen.pipeline import Pipeline
+from iphigen.timeseries import process_nifti_series
+
+
+def test_process_nifti_series(tmpdir):
+    """Test each volume matches processing it on its own."""
+    # Given
+    data = [np.random.random((12, 10, 8, 4)) * 100 for _ in range(2)]
+    in_paths = [str(tmpdir.join('echo{}.nii'.format(i))) for i in range(2)]
+    out_paths = [str(tmpdir.join('out{}.nii.gz'.format(i))) for i in range(2)]
+    for d, f in zip(data, in_paths):
+        nb.save(nb.Nifti1Image(d, np.eye(4)), f)
+    pipeline = Pipeline(retinex=True, scales=[1, 2],
+                        simplest_color_balance=True, verbose=False)
+    # When
+    nr_volumes = process_nifti_series(in_paths, out_paths, pipeline, jobs=2)
+    # Then
+    assert nr_volumes == 4
+    output = [nb.load(f).get_fdata() for f in out_paths]
+    for t in range(4):
+        expected = pipeline.run(np.stack([d[..., t] for d in data], axis=-1))
+        for i in range(2):
+            assert np.allclose(output[i][..., t], expected[..., i])
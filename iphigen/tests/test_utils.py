@@ -2,7 +2,8 @@
 
 import pytest
 import numpy as np
-from iphigen.utils import truncate_range, set_range, parse_filepath
+from iphigen.utils import (truncate_range, set_range, foreground_mask,
+                           parse_filepath)
 
 
 def test_truncate_range():
@@ -35,6 +36,35 @@ def test_set_range():
                 np.nanmax(output) == pytest.approx(expected[1])])
 
 
+def test_truncate_range_mask():
+    """Test range truncation inside a mask."""
+    # Given
+    data = np.random.random((20, 20)) + 1
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[5:15, 5:15] = True
+    data[~mask] = 100.
+    expected = np.percentile(data[mask], [5, 95])
+    # When
+    output = truncate_range(data, pmin=5, pmax=95, mask=mask)
+    # Then
+    assert np.allclose([output[mask].min(), output[mask].max()], expected)
+    assert np.all(output[~mask] == 0)
+
+
+def test_foreground_mask():
+    """Test foreground detection."""
+    # Given
+    grid = np.mgrid[:40, :40, :40] - 20
+    inside = np.sum(grid**2, axis=0) < 15**2
+    data = np.random.random(inside.shape) * 10
+    data[inside] += 100
+    data[20, 20, 20] = 0  # hole
+    # When
+    mask = foreground_mask(data)
+    # Then
+    assert np.array_equal(mask, inside)
+
+
 def test_parse_filepath():
     """Test file path parsing."""
     # Given
@@ -0,0 +1,30 @@
+"""Test video and image sequence streaming."""
+
+import os
+import numpy as np
+import cv2
+from iphigen.pipeline import Pipeline
+from iphigen.video import process_video
+
+
+def test_process_video_sequence(tmpdir):
+    """Test streamed frames match frames processed one by one."""
+    # Given
+    frames = [(np.random.random((24, 32, 3)) * 255).astype('uint8')
+              for _ in range(5)]
+    for i, frame in enumerate(frames):
+        cv2.imwrite(str(tmpdir.join('in_{:03d}.png'.format(i))), frame)
+    pipeline = Pipeline(retinex=True, scales=[2, 5],
+                        simplest_color_balance=True, verbose=False)
+    # When
+    nr_frames = process_video(str(tmpdir.join('in_%03d.png')),
+                              str(tmpdir.join('out_%03d.png')), pipeline,
+                              prefetch=2)
+    # Then
+    assert nr_frames == 5
+    for i, frame in enumerate(frames):
+        expected = np.clip(np.rint(np.nan_to_num(pipeline.run(frame))),
+                           0, 255)
+        output = cv2.imread(os.path.join(str(tmpdir),
+                                         'out_{:03d}.png'.format(i)))
+        assert np.array_equal(output, expected)
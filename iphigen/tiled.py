@@ -0,0 +1,164 @@
+"""Tiled processing of large 2D images."""
+
+from __future__ import division
+import os
+import tempfile
+import numpy as np
+from iphigen import core, quantiles, utils
+
+
+def process_image_tiled(image, tile_size=4096, intensity_balance=False,
+                        int_bal_perc=(1., 99.), retinex=False, scales=None,
+                        blur='exact', cascade=False, workers=1,
+                        simplest_color_balance=False, simplest_perc=(1., 99.),
+                        tmp_dir=None, exact_size=10**7, dtype=np.float64):
+    """Intensity balance, retinex and simplest color balance in tiles.
+
+    Only the 8 bit input and output images are kept in memory. All floating
+    point work is done on tiles of `tile_size` x `tile_size` pixels. Retinex
+    tiles are extended by a halo of 4 times the largest scale, which is the
+    radius of the exact Gaussian kernel, so tile interiors are identical to
+    whole-image processing and no seams need to be blended. Approximate blur
+    engines differ at tile borders only within their error bounds.
+
+    Global statistics (percentiles for intensity balance, `scale_approx`
+    and simplest color balance) are collected in mergeable percentile
+    sketches in streaming passes over the tiles before the output is
+    written.
+
+    Parameters
+    ----------
+    image: np.ndarray
+        Image with channels in the last dimension (eg. BGR from cv2).
+    tile_size: int
+        Tile size in pixels, without halo.
+    intensity_balance: bool
+        Apply intensity balance.
+    int_bal_perc: list
+        Percentiles for intensity balance.
+    retinex: bool
+        Apply multi-scale retinex with barycenter preservation.
+    scales: list
+        Retinex scales, see `core.multi_scale_retinex`.
+    blur: string
+        Gaussian blur engine, see `core.multi_scale_retinex`.
+    cascade: bool
+        Cascaded surrounds, see `core.multi_scale_retinex`.
+    workers: int
+        Number of threads, see `core.multi_scale_retinex`.
+    simplest_color_balance: bool
+        Apply simplest color balance.
+    simplest_perc: list
+        Percentiles for simplest color balance.
+    tmp_dir: string
+        Directory for the temporary retinex intensity image.
+    exact_size: int
+        Percentiles are exact up to this many pixels, and are estimated with
+        bounded error beyond, see `quantiles.QuantileSketch`.
+    dtype: numpy dtype
+        Floating point type of tiles and of the temporary retinex image.
+
+    Returns
+    -------
+    out: np.ndarray, uint8
+        Processed image.
+
+    """
+    if scales is None:
+        scales = [15, 80, 250]
+    nr_rows, nr_cols = image.shape[:2]
+    tiles = [(r0, min(r0 + tile_size, nr_rows), c0,
+              min(c0 + tile_size, nr_cols))
+             for r0 in range(0, nr_rows, tile_size)
+             for c0 in range(0, nr_cols, tile_size)]
+    zero_to = 255 * image.shape[-1]
+
+    int_thr = None
+    if intensity_balance:
+        print('  Intensity balance statistics pass...')
+        sketch = quantiles.QuantileSketch(exact_size=exact_size)
+        for r0, r1, c0, c1 in tiles:
+            inten = np.sum(image[r0:r1, c0:c1], axis=-1, dtype=dtype)
+            sketch.update(inten[quantiles.nonzero_mask(inten)])
+        int_thr = sketch.percentile(int_bal_perc)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        new_inten, scale_factor = None, None
+        if retinex:
+            print('  Retinex pass...')
+            new_inten = np.memmap(os.path.join(tmp, 'msr.dat'), mode='w+',
+                                  dtype=dtype, shape=(nr_rows, nr_cols))
+            halo = int(4 * max(scales) + 0.5)
+            old_sketch = quantiles.QuantileSketch(exact_size=exact_size)
+            new_sketch = quantiles.QuantileSketch(exact_size=exact_size)
+            for i, (r0, r1, c0, c1) in enumerate(tiles):
+                print('    Tile {}/{}'.format(i+1, len(tiles)))
+                hr0, hr1 = max(r0 - halo, 0), min(r1 + halo, nr_rows)
+                hc0, hc1 = max(c0 - halo, 0), min(c1 + halo, nr_cols)
+                inten = _intensity(image[hr0:hr1, hc0:hc1], int_thr, zero_to,
+                                   dtype)
+                msr = core.multi_scale_retinex(
+                    inten, scales=scales, verbose=False, dtype=dtype,
+                    blur=blur, cascade=cascade, workers=workers)
+                crop = (slice(r0 - hr0, r1 - hr0), slice(c0 - hc0, c1 - hc0))
+                new_inten[r0:r1, c0:c1] = msr[crop]
+                old_sketch.update(inten[crop])
+                new_sketch.update(msr[crop])
+            scale_factor = core.scale_approx_factor(
+                new_sketch.percentile(core.SCALE_APPROX_PERC),
+                old_sketch.percentile(core.SCALE_APPROX_PERC))
+
+        thresholds = None
+        if simplest_color_balance:
+            print('  Color balance statistics pass...')
+            sketches = [quantiles.QuantileSketch(exact_size=exact_size)
+                        for _ in range(image.shape[-1])]
+            for tile in tiles:
+                data = _compose_tile(image, int_thr, zero_to, new_inten,
+                                     scale_factor, dtype, *tile)
+                for d, sketch in enumerate(sketches):
+                    temp = data[..., d]
+                    sketch.update(temp[quantiles.nonzero_mask(temp)])
+            thresholds = [s.percentile(simplest_perc) for s in sketches]
+
+        print('  Writing pass...')
+        out = np.zeros(image.shape, dtype=np.uint8)
+        for r0, r1, c0, c1 in tiles:
+            data = _compose_tile(image, int_thr, zero_to, new_inten,
+                                 scale_factor, dtype, r0, r1, c0, c1)
+            if thresholds is not None:
+                for d in range(data.shape[-1]):
+                    data[..., d] = utils.clip_and_scale(data[..., d],
+                                                        *thresholds[d])
+            # Same rounding and saturation as writing floats with cv2
+            data = np.clip(np.rint(np.nan_to_num(data)), 0, 255)
+            out[r0:r1, c0:c1] = data
+        new_inten = None
+    return out
+
+
+def _intensity(data, int_thr, zero_to, dtype=np.float64):
+    """Intensity of a tile, intensity balanced if thresholds are given."""
+    inten = np.sum(data, axis=-1, dtype=dtype)
+    if int_thr is not None:
+        inten = utils.clip_and_scale(inten, int_thr[0], int_thr[1],
+                                     zero_to=zero_to)
+    return inten
+
+
+def _compose_tile(image, int_thr, zero_to, new_inten, scale_factor, dtype,
+                  r0, r1, c0, c1):
+    """Channels of a tile with the processed intensity put back in."""
+    data = np.asarray(image[r0:r1, c0:c1], dtype=dtype)
+    inten = np.sum(data, axis=-1)
+    # Compute barycentic coordinates
+    data /= inten[..., None]
+    if int_thr is not None:
+        inten = utils.clip_and_scale(inten, int_thr[0], int_thr[1],
+                                     zero_to=zero_to)
+        # Barycentric coordinates are undefined where intensity is 0
+        data[inten == 0] = np.nan
+    if new_inten is not None:
+        inten = new_inten[r0:r1, c0:c1] * scale_factor
+    data *= inten[..., None]
+    return data
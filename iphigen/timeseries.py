@@ -0,0 +1,109 @@
+"""Processing of 4D NIfTI images volume by volume."""
+
+from __future__ import division
+import os
+import time
+import tempfile
+import multiprocessing
+import numpy as np
+import nibabel as nb
+from iphigen import metrics
+from iphigen.chunked import (_compress_outputs, _create_nifti_memmap,
+                             _uncompressed_path)
+
+# Inputs and pipeline of the current (worker) process
+_state = {}
+
+
+def process_nifti_series(in_paths, out_paths, pipeline, jobs=1,
+                         tmp_dir=None, compresslevel=6):
+    """Apply a pipeline to every volume of 4D images.
+
+    The fourth dimension is treated as time (or echoes): each volume is
+    processed on its own, with the inputs as channels. Volumes are read
+    lazily from the nibabel proxies by up to `jobs` worker processes and
+    written in order into memory-mapped outputs as they arrive, so memory
+    use does not depend on the number of volumes.
+
+    Parameters
+    ----------
+    in_paths: list of strings
+        4D NIfTI images, treated as channels. Should have the same shape.
+    out_paths: list of strings
+        Output paths, one for each input. '.nii.gz' outputs are written
+        uncompressed first and then compressed.
+    pipeline: iphigen.pipeline.Pipeline
+        Processing applied to each volume. Output dtype is `pipeline.dtype`.
+    jobs: int
+        Number of worker processes.
+    tmp_dir: string
+        Directory for temporary uncompressed outputs. Defaults to the
+        directory of the first output.
+    compresslevel: int
+        gzip compression level of '.nii.gz' outputs, 1 to 9.
+
+    Returns
+    -------
+    nr_volumes: int
+        Number of processed volumes.
+
+    """
+    niis = [nb.load(f, mmap=True) for f in in_paths]
+    shape = niis[0].shape
+    for nii, f in zip(niis, in_paths):
+        if nii.shape != shape or len(shape) != 4:
+            raise ValueError('{} should be a 4D image of shape {}.'.format(
+                f, shape))
+    nr_volumes = shape[3]
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(out_paths[0]))
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        outputs = [_create_nifti_memmap(_uncompressed_path(f, tmp), shape,
+                                        nii.affine, pipeline.dtype)
+                   for f, nii in zip(out_paths, niis)]
+        with metrics.measure('series', volumes=nr_volumes,
+                             jobs=jobs) as record:
+            if jobs > 1:
+                pool = multiprocessing.Pool(
+                    jobs, initializer=_init_worker,
+                    initargs=(in_paths, pipeline))
+                results = pool.imap(_process_volume, range(nr_volumes))
+            else:
+                pool = None
+                _init_worker(in_paths, pipeline)
+                results = map(_process_volume, range(nr_volumes))
+            start = time.time()
+            try:
+                for t, data in enumerate(results):
+                    for d, out in enumerate(outputs):
+                        out[..., t] = data[..., d]
+                    duration = time.time() - start
+                    print('    Volume {}/{} ({:.2f} volumes/s)'.format(
+                        t+1, nr_volumes, (t+1) / max(duration, 1e-9)))
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+                _state.clear()
+        print('  {} volumes in {:.1f} seconds, {:.2f} volumes/s.'.format(
+            nr_volumes, record['wall'], nr_volumes / record['wall']))
+        for out in outputs:
+            out.flush()
+        outputs = None
+        _compress_outputs(out_paths, tmp, compresslevel)
+    return nr_volumes
+
+
+def _init_worker(in_paths, pipeline):
+    """Open the inputs once per process."""
+    _state['niis'] = [nb.load(f, mmap=True) for f in in_paths]
+    _state['pipeline'] = pipeline
+
+
+def _process_volume(t):
+    """Process volume t of the inputs, channels in the last dimension."""
+    pipeline = _state['pipeline']
+    data = np.stack([np.asarray(nii.dataobj[..., t], dtype=pipeline.dtype)
+                     for nii in _state['niis']], axis=-1)
+    return pipeline.run(data)
@@ -4,6 +4,10 @@ import os
 import argparse
 import iphigen.config as cfg
 from iphigen import __package__, __version__
+from iphigen.diskcache import default_cache_dir
+from iphigen.filters import BLUR_METHODS
+from iphigen.output import OUTPUT_DTYPES
+from iphigen.quantiles import PERCENTILE_METHODS
 
 
 def display_welcome_message(package=__package__, version=__version__):
@@ -13,8 +17,15 @@ def display_welcome_message(package=__package__, version=__version__):
     print('{}\n{}\n{}'.format(welcome_decor, welcome_str, welcome_decor))
 
 
-def user_interface():
-    """Commandline interface."""
+def user_interface(argv=None):
+    """Commandline interface.
+
+    Parameters
+    ----------
+    argv: list of strings, optional
+        Arguments to parse instead of `sys.argv`, eg. from the server.
+
+    """
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -29,6 +40,100 @@ def user_interface():
         help="Absolute path of output directory. If not provided, processed \
         images will be saved in the input image path."
         )
+    parser.add_argument(
+        '--jobs', type=int, metavar='N', default=cfg.jobs,
+        help="Number of 2D images, or volumes with --series, processed in \
+        parallel. Each is processed in its own worker process."
+        )
+    parser.add_argument(
+        '--read_ahead', type=int, metavar='N', default=cfg.read_ahead,
+        help="Number of inputs read and decoded in background threads ahead \
+        of processing (2D images with --jobs 1, or the channel images of \
+        nifti inputs). Deeper queues hide slow (eg. network) storage at the \
+        cost of memory. Default: %(default)s"
+        )
+    parser.add_argument(
+        '--write_behind', type=int, metavar='N', default=cfg.write_behind,
+        help="Maximum number of outputs waiting to be saved in background \
+        threads while processing continues. Queue occupancy and stall times \
+        are reported to tune both depths. Default: %(default)s"
+        )
+    parser.add_argument(
+        '--chunk_size', type=int, metavar='N', default=cfg.chunk_size,
+        help="Nifti images only. Process the volume out-of-core in slabs of \
+        N slices along the third axis. Inputs and outputs are memory mapped, \
+        so memory use depends on N instead of the volume size. Supports \
+        retinex and simplest color balance."
+        )
+    parser.add_argument(
+        "--series", action='store_true',
+        help="Nifti images only. Treat the fourth dimension as time (or \
+        echoes) and process each volume separately, with --jobs volumes in \
+        parallel. Volumes are read and written one at a time."
+        )
+    parser.add_argument(
+        '--mask', type=str, metavar='path', default=cfg.mask,
+        help="Nifti images only. Foreground (eg. brain or head) mask image, \
+        or 'auto' for an Otsu threshold of the intensity. Retinex only \
+        processes the bounding box of the mask and ignores background in its \
+        surrounds, percentiles are computed inside the mask and the output \
+        is 0 outside it. Not available with --chunk_size."
+        )
+    parser.add_argument(
+        '--tile_size', type=int, metavar='N', default=cfg.tile_size,
+        help="2D images only. Process the image in tiles of NxN pixels to \
+        limit memory use for very large images. Supports intensity balance, \
+        retinex and simplest color balance."
+        )
+    parser.add_argument(
+        "--stream", action='store_true',
+        help="2D only. Inputs are videos, or numbered image sequences like \
+        frames/img_%%04d.png. Frames are decoded ahead in the background \
+        and written to a video (or sequence) of the same format."
+        )
+    parser.add_argument(
+        '--prefetch', type=int, metavar='N', default=cfg.prefetch,
+        help="Stream mode. Maximum number of decoded frames held in memory."
+        )
+    parser.add_argument(
+        '--temporal_smoothing', type=float, metavar='alpha',
+        default=cfg.temporal_smoothing,
+        help="Stream mode. Smooth percentiles over frames with an \
+        exponential moving average giving weight alpha (0-1] to the current \
+        frame. Reduces flicker."
+        )
+    parser.add_argument(
+        '--stats_interval', type=int, metavar='N', default=cfg.stats_interval,
+        help="Stream mode. Compute percentiles only every N frames and reuse \
+        them in between."
+        )
+    parser.add_argument(
+        "--profile", action='store_true',
+        help="Print wall time, CPU time, peak memory growth and array size \
+        of every processing stage and retinex scale."
+        )
+    parser.add_argument(
+        '--metrics_json', type=str, metavar='path', default=cfg.metrics_json,
+        help="Write the per-stage measurements of --profile, and per-file \
+        totals, to this JSON file."
+        )
+    parser.add_argument(
+        '--cache_dir', type=str, metavar='path', default=cfg.cache_dir,
+        help="Cache retinex surrounds and outputs in this directory (eg. \
+        {}), so that runs on the same image with other balance options skip \
+        retinex. Entries take about 8 bytes per pixel and scale. Not used \
+        with --stream or --series. Default: no cache".format(
+            default_cache_dir().replace('%', '%%'))
+        )
+    parser.add_argument(
+        '--cache_size', type=int, metavar='MB', default=cfg.cache_size,
+        help="Size bound of the cache directory in megabytes. Least recently \
+        used entries are removed beyond it."
+        )
+    parser.add_argument(
+        "--no_cache", action='store_true',
+        help="Do not read or write the retinex cache, even with --cache_dir."
+        )
     parser.add_argument(
         "--retinex", action='store_true',
         help="Apply retinex image enhancement."
@@ -41,10 +146,79 @@ def user_interface():
         determine/optimize the scales can be found in Jobson, Rahman, Woodell \
         (1997)."
         )
+    parser.add_argument(
+        "--scales_mm", action='store_true',
+        help="Nifti images only. Scales are in millimetres and converted to \
+        voxels along each axis with the voxel size of the header, so \
+        anisotropic images are blurred isotropically in space. Axes where a \
+        scale is below 0.3 voxels are not filtered."
+        )
+    parser.add_argument(
+        '--sweep_scales', nargs='+', type=str, metavar='s1,s2,...',
+        default=cfg.sweep_scales,
+        help="Compare several sets of retinex scales, eg. 15,80,250 5,20. \
+        Surrounds of repeated scales are computed once. Outputs are saved as \
+        one labelled image grid (2D) or one multi-volume image (nifti), with \
+        the parameters of each output in a .json file next to it."
+        )
+    parser.add_argument(
+        '--sweep_perc', nargs='+', type=str, metavar='min,max',
+        default=cfg.sweep_perc,
+        help="Compare several simplest color balance percentile pairs, eg. \
+        1,99 0.5,99.5. Combined with every set of --sweep_scales."
+        )
+    parser.add_argument(
+        '--blur', type=str, choices=BLUR_METHODS, default=cfg.blur,
+        help="Gaussian blur engine for retinex surrounds. 'exact' is the \
+        reference filter, 'iir', 'box' and 'fft' are faster approximations \
+        whose cost does not grow with the scale."
+        )
+    parser.add_argument(
+        "--cascade", action='store_true',
+        help="Compute each retinex surround from the previous (smaller) scale \
+        using the incremental kernel. Numerically almost identical. Only \
+        faster for closely spaced scales (eg. 80 90 100), as widely spaced \
+        ones like the default need almost the full kernel anyway, and costs \
+        an extra image-sized buffer."
+        )
+    parser.add_argument(
+        '--workers', type=int, metavar='N', default=cfg.workers,
+        help="Number of threads used for retinex filtering of each image. \
+        Results are identical to single threaded processing. When combined \
+        with --jobs, up to jobs x workers threads are used."
+        )
+    parser.add_argument(
+        '--precision', type=str, choices=('float64', 'float32'),
+        default=cfg.precision,
+        help="Floating point precision of all processing steps and of nifti \
+        outputs. float32 halves memory use and is faster, with deviations \
+        far below one gray level for 8 bit images."
+        )
+    parser.add_argument(
+        '--output_dtype', type=str, choices=OUTPUT_DTYPES,
+        default=cfg.output_dtype,
+        help="Data type of saved images. Nifti outputs in uint8 or uint16 are \
+        scaled to the full integer range with scl_slope and scl_inter set \
+        accordingly. 2D outputs in uint16 are stretched to 0-65535. Default: \
+        uint8 for 2D images, the --precision type for nifti images."
+        )
+    parser.add_argument(
+        '--compress_level', type=int, metavar='1-9',
+        default=cfg.compress_level,
+        help="gzip compression level of .nii.gz outputs, from 1 (fastest) to \
+        9 (smallest). Default: %(default)s"
+        )
     parser.add_argument(
         "--intensity_balance", action='store_true',
         help="Balance intensiy using percentile thresholding."
         )
+    parser.add_argument(
+        '--percentile_method', type=str, choices=PERCENTILE_METHODS,
+        default=cfg.percentile_method,
+        help="How percentiles for balancing and scaling are computed. \
+        'histogram' takes about half the time of 'exact' on large images, \
+        with an error of at most 1/65536 of the data range."
+        )
     parser.add_argument(
         "--simplest_color_balance", action='store_true',
         help="Apply simplest color balance, see Limare et al (2011)."
@@ -62,11 +236,42 @@ def user_interface():
         help="Highly experimental feature. Work in progress."
         )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     cfg.filename = args.filename
     cfg.out_dir = args.out_dir
+    cfg.jobs = args.jobs
+    cfg.read_ahead = args.read_ahead
+    cfg.write_behind = args.write_behind
+    cfg.chunk_size = args.chunk_size
+    cfg.series = args.series
+    cfg.mask = args.mask
+    cfg.tile_size = args.tile_size
+    cfg.stream = args.stream
+    cfg.prefetch = args.prefetch
+    cfg.temporal_smoothing = args.temporal_smoothing
+    cfg.stats_interval = args.stats_interval
+    cfg.profile = args.profile
+    cfg.metrics_json = args.metrics_json
+    cfg.cache_dir = None if args.no_cache else args.cache_dir
+    cfg.cache_size = args.cache_size
     cfg.scales = args.scales
     cfg.scales_nifti = args.scales
+    cfg.scales_mm = args.scales_mm
+    cfg.blur = args.blur
+    cfg.cascade = args.cascade
+    cfg.workers = args.workers
+    cfg.percentile_method = args.percentile_method
+    cfg.precision = args.precision
+    cfg.output_dtype = args.output_dtype
+    cfg.compress_level = args.compress_level
+    cfg.sweep_scales = None
+    if args.sweep_scales:
+        cfg.sweep_scales = [[int(s) for s in e.split(',')]
+                            for e in args.sweep_scales]
+    cfg.sweep_perc = None
+    if args.sweep_perc:
+        cfg.sweep_perc = [[float(p) for p in e.split(',')]
+                          for e in args.sweep_perc]
 
     cfg.retinex = args.retinex
     cfg.intensity_balance = args.intensity_balance
@@ -76,7 +281,7 @@ def user_interface():
     # cfg.int_bal_perc = args.int_bal_perc
 
     for f in cfg.filename:
-        if os.path.isfile(f):
+        if os.path.isfile(f) or (cfg.stream and '%' in f):
             pass
         else:
             raise ValueError('{} cannot be read.'.format(f))
@@ -87,5 +292,41 @@ def user_interface():
         else:
             os.mkdir(cfg.out_dir)
 
+    if cfg.jobs < 1:
+        raise ValueError('Number of jobs should be at least 1.')
+    if cfg.read_ahead < 1 or cfg.write_behind < 1:
+        raise ValueError('Read-ahead and write-behind should be at least 1.')
+    if cfg.workers < 1:
+        raise ValueError('Number of workers should be at least 1.')
+    if cfg.chunk_size is not None and cfg.chunk_size < 1:
+        raise ValueError('Chunk size should be at least 1.')
+    if cfg.mask not in (None, 'auto') and not os.path.isfile(cfg.mask):
+        raise ValueError('{} cannot be read.'.format(cfg.mask))
+    if cfg.tile_size is not None and cfg.tile_size < 1:
+        raise ValueError('Tile size should be at least 1.')
+    if cfg.output_dtype not in (None, cfg.precision) and (
+            cfg.chunk_size or cfg.series):
+        raise ValueError('With --chunk_size or --series outputs are saved in '
+                         'the --precision type.')
+    if not 1 <= cfg.compress_level <= 9:
+        raise ValueError('Compression level should be between 1 and 9.')
+    if cfg.prefetch < 1 or cfg.stats_interval < 1:
+        raise ValueError('Prefetch and stats interval should be at least 1.')
+    if cfg.temporal_smoothing is not None and not (
+            0 < cfg.temporal_smoothing <= 1):
+        raise ValueError('Temporal smoothing should be in (0, 1].')
+
+    if cfg.sweep_scales and not cfg.retinex:
+        raise ValueError('--sweep_scales needs --retinex.')
+    if cfg.sweep_perc and (not cfg.simplest_color_balance or any(
+            len(p) != 2 for p in cfg.sweep_perc)):
+        raise ValueError('--sweep_perc needs --simplest_color_balance and '
+                         'pairs of percentiles.')
+    if (cfg.sweep_scales or cfg.sweep_perc) and (
+            cfg.tile_size or cfg.chunk_size or cfg.stream or cfg.series
+            or cfg.mask):
+        raise ValueError('Sweeps are not available with --tile_size, '
+                         '--chunk_size, --stream, --series or --mask.')
+
     if cfg.simplest_color_balance and cfg.simplex_color_balance:
         raise ValueError('Please only select one color balance method.')
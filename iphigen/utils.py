@@ -2,9 +2,11 @@
 
 import os
 import numpy as np
+from iphigen import quantiles
 
 
-def truncate_range(data, pmin=0.25, pmax=99.75, discard_zeros=True):
+def truncate_range(data, pmin=0.25, pmax=99.75, discard_zeros=True,
+                   method='exact', cache=None, mask=None):
     """Truncate too low and too high values.
 
     Parameters
@@ -17,27 +19,35 @@ def truncate_range(data, pmin=0.25, pmax=99.75, discard_zeros=True):
         Percentile maximum.
     discard_zeros : bool
         Discard voxels with value 0 from truncation.
+    method : string
+        Percentile method, see `quantiles.percentile`.
+    cache : quantiles.PercentileCache, optional
+        Percentile results of the current run.
+    mask : np.ndarray, optional
+        Boolean foreground mask, used instead of the non-zero voxels. Voxels
+        outside are set to 0.
 
     Returns
     -------
     data : np.ndarray
 
     """
-    if discard_zeros:
-        msk = ~np.isclose(data, 0)
-        thr_min, thr_max = np.nanpercentile(data[msk], [pmin, pmax])
+    if mask is not None:
+        msk, discard_zeros = mask, True
     else:
-        thr_min, thr_max = np.nanpercentile(data, [pmin, pmax])
-    temp = data[~np.isnan(data)]
-    # truncate min and max
-    temp[temp < thr_min], temp[temp > thr_max] = thr_min, thr_max
-    data[~np.isnan(data)] = temp
+        msk = quantiles.nonzero_mask(data) if discard_zeros else None
+    thr_min, thr_max = quantiles.percentile(data, [pmin, pmax], mask=msk,
+                                            method=method, cache=cache)
+    # truncate min and max, NaNs are kept
+    np.clip(data, thr_min, thr_max, out=data)
     if discard_zeros:
         data[~msk] = 0  # put back masked out voxels
+    if cache is not None:
+        cache.invalidate(data)
     return data
 
 
-def set_range(data, zero_to=255, discard_zeros=True):
+def set_range(data, zero_to=255, discard_zeros=True, mask=None):
     """Scale values as a preprocessing step.
 
     Parameters
@@ -48,6 +58,9 @@ def set_range(data, zero_to=255, discard_zeros=True):
         TODO
     discard_zeros : bool
         Discard voxels with value 0 from truncation.
+    mask : np.ndarray, optional
+        Boolean foreground mask, used instead of the non-zero voxels. Voxels
+        outside are set to 0.
 
     Returns
     -------
@@ -55,7 +68,9 @@ def set_range(data, zero_to=255, discard_zeros=True):
         Scaled image.
 
     """
-    if discard_zeros:
+    if mask is not None:
+        msk, discard_zeros = mask, True
+    elif discard_zeros:
         msk = ~np.isclose(data, 0)
     else:
         msk = np.ones(data.shape, dtype=bool)
@@ -66,6 +81,82 @@ def set_range(data, zero_to=255, discard_zeros=True):
     return data
 
 
+def clip_and_scale(data, thr_min, thr_max, zero_to=255, discard_zeros=True):
+    """Truncate and scale with precomputed thresholds.
+
+    Equivalent to `truncate_range` followed by `set_range` when the
+    thresholds are percentiles of the whole image. Useful when an image is
+    processed in pieces and the percentiles are computed beforehand.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image (or part of an image) to be truncated and scaled.
+    thr_min : float
+        Lower threshold, mapped to 0.
+    thr_max : float
+        Upper threshold, mapped to `zero_to`.
+    zero_to : float
+        Maximum of the scaled range.
+    discard_zeros : bool
+        Keep voxels with value 0 at 0.
+
+    Returns
+    -------
+    data : np.ndarray
+
+    """
+    if discard_zeros:
+        msk = ~np.isclose(data, 0)
+    data = np.clip(data, thr_min, thr_max)
+    data -= thr_min
+    data *= zero_to / (thr_max - thr_min)
+    if discard_zeros:
+        data[~msk] = 0  # put back masked out voxels
+    return data
+
+
+def foreground_mask(data, bins=256, fill_holes=True):
+    """Foreground mask (eg. head in MRI) by Otsu thresholding.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image, eg. intensity. NaNs are background.
+    bins : int
+        Number of histogram bins for the threshold search.
+    fill_holes : bool
+        Fill background regions enclosed by foreground.
+
+    Returns
+    -------
+    mask : np.ndarray, bool
+
+    Reference
+    ---------
+    Otsu, N. (1979). A threshold selection method from gray-level
+    histograms. IEEE Transactions on Systems, Man, and Cybernetics, 9(1),
+    62-66. DOI: 10.1109/TSMC.1979.4310076
+
+    """
+    valid = np.isfinite(data)
+    counts, edges = np.histogram(data[valid], bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    # Between-class variance of every split point
+    w0 = np.cumsum(counts, dtype=float)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(counts * centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = w0 * w1 * (m0 / w0 - (m0[-1] - m0) / w1)**2
+    threshold = centers[np.nanargmax(between)]
+    mask = valid
+    mask &= data > threshold
+    if fill_holes:
+        from scipy.ndimage import binary_fill_holes
+        mask = binary_fill_holes(mask)
+    return mask
+
+
 def parse_filepath(filepath):
     """Load images with different extensions.
 
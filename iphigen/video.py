@@ -0,0 +1,115 @@
+"""Streaming of videos and numbered image sequences through a pipeline."""
+
+from __future__ import division
+import queue
+import threading
+import numpy as np
+import cv2
+
+FOURCC = {'avi': 'MJPG', 'mp4': 'mp4v', 'm4v': 'mp4v', 'mov': 'mp4v',
+          'mkv': 'mp4v'}
+
+
+def process_video(in_path, out_path, pipeline, prefetch=8, fps=None,
+                  fourcc=None):
+    """Process every frame of a video or an image sequence.
+
+    Frames are decoded in a background thread into a queue of at most
+    `prefetch` frames, so decoding overlaps with processing while memory
+    stays bounded. Processed frames are rounded and saturated to 8 bit like
+    `cv2.imwrite` does with floating point images.
+
+    Parameters
+    ----------
+    in_path: string
+        Video file, or numbered image sequence pattern such as
+        'frames/img_%04d.png', anything `cv2.VideoCapture` opens.
+    out_path: string
+        Output video file, or image sequence pattern.
+    pipeline: iphigen.pipeline.Pipeline
+        Processing applied to each frame. Give it a
+        `quantiles.TemporalPercentileCache` to smooth percentiles over
+        frames.
+    prefetch: int
+        Maximum number of decoded frames waiting to be processed.
+    fps: float, optional
+        Output frame rate. Defaults to the input frame rate, or 25.
+    fourcc: string, optional
+        Output video codec. Defaults to one matching the output extension.
+        Image sequences (patterns with '%') are written with `cv2.imwrite`,
+        numbered from 0.
+
+    Returns
+    -------
+    nr_frames: int
+        Number of processed frames.
+
+    """
+    capture = cv2.VideoCapture(in_path)
+    if not capture.isOpened():
+        raise ValueError('{} cannot be read.'.format(in_path))
+    if fps is None:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.
+    if fourcc is None:
+        fourcc = FOURCC.get(out_path.rsplit('.', 1)[-1].lower(), 'mp4v')
+
+    frames = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_frames,
+                              args=(capture, frames, stop))
+    reader.daemon = True
+    reader.start()
+
+    writer, nr_frames = None, 0
+    try:
+        while True:
+            frame = frames.get()
+            if frame is None:
+                break
+            data = pipeline.run(frame)
+            data = np.clip(np.rint(np.nan_to_num(data)), 0, 255)
+            data = data.astype(np.uint8)
+            if '%' in out_path:
+                # Image sequence, numbered from 0
+                if not cv2.imwrite(out_path % nr_frames, data):
+                    raise ValueError('{} cannot be written.'.format(
+                        out_path % nr_frames))
+            else:
+                if writer is None:
+                    writer = cv2.VideoWriter(
+                        out_path, cv2.VideoWriter_fourcc(*fourcc), fps,
+                        (data.shape[1], data.shape[0]))
+                    if not writer.isOpened():
+                        raise ValueError('{} cannot be written.'.format(
+                            out_path))
+                writer.write(data)
+            nr_frames += 1
+    finally:
+        stop.set()
+        reader.join()
+        capture.release()
+        if writer is not None:
+            writer.release()
+    return nr_frames
+
+
+def _read_frames(capture, frames, stop):
+    """Decode frames into the queue until the end or until stopped."""
+    while not stop.is_set():
+        ok, frame = capture.read()
+        if not ok:
+            break
+        while not stop.is_set():
+            try:
+                frames.put(frame, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+    # End of stream marker, the queue has room once the consumer stopped
+    while True:
+        try:
+            frames.put(None, timeout=0.1)
+            return
+        except queue.Full:
+            if stop.is_set():
+                return
@@ -23,9 +23,11 @@ setup(name='iphigen',
       author_email='faruk.gulban@maastrichtuniversity.nl',
       license='BSD-3-Clause',
       packages=['iphigen'],
-      install_requires=['compoda', 'numpy', 'scipy'],
+      install_requires=['compoda', 'numpy', 'scipy>=1.6'],
       keywords=['mri', 'retinex', 'color', 'color balance'],
       entry_points={'console_scripts': [
           'iphigen = iphigen.iphigen_2d:main',
-          'iphigen_nifti = iphigen.iphigen_nifti:main']},
+          'iphigen_nifti = iphigen.iphigen_nifti:main',
+          'iphigen_server = iphigen.server:main',
+          'iphigen_client = iphigen.client:main']},
       zip_safe=True)